@@ -0,0 +1,24 @@
+"""
+Shared code for the ABIDE brain age projects: data loading, preprocessing and lazy classifier and backend registries.
+
+Submodules are imported when one of their functions is first accessed, e.g., ``abide.load_data`` only imports ``abide.data`` (numpy and pandas), while ``abide.preproc_data`` also imports scikit-learn.
+"""
+
+import importlib
+
+_LAZY_ATTRIBUTES = {
+    "load_data": "data", "load_descriptor_store": "data", "save_descriptor_store": "data", "create_descriptor_store": "data", "save_descriptor_store_index": "data", "descriptor_store_index_file": "data", "add_covariates": "data", "check_data": "data",
+    "preproc_data": "preprocessing", "build_preprocessor": "preprocessing", "build_pca": "preprocessing", "fit_preprocessing": "preprocessing", "transform_data": "preprocessing", "save_model": "preprocessing",
+    "write_dataset": "synthetic",
+    "SparseGaussianProcessClassifier": "kernel_approximation",
+    "PersistentKNeighborsClassifier": "knn_index", "build_index": "knn_index", "load_index": "knn_index", "add_to_index": "knn_index", "query_index": "knn_index", "default_index_dir": "knn_index", "prune_index_dir": "knn_index",
+    "register_classifier": "registry", "classifier_names": "registry", "make_classifier": "registry", "get_classifiers": "registry", "register_backend": "registry", "get_backend": "registry",
+}
+
+__all__ = sorted(_LAZY_ATTRIBUTES.keys())
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        return getattr(importlib.import_module("." + _LAZY_ATTRIBUTES[name], __name__), name)
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
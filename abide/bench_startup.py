@@ -0,0 +1,73 @@
+"""
+Startup-time benchmark for the shared ABIDE code.
+
+Each statement is run in a fresh Python interpreter several times, and the median wall time is reported together with the heavy modules it imported. Run from the repository root with:
+
+    python -m abide.bench_startup
+"""
+
+import os
+import sys
+import time
+import json
+import subprocess
+import numpy as np
+
+
+STATEMENTS = [
+    ("python interpreter", "pass"),
+    ("import abide", "import abide"),
+    ("data loading", "from abide.data import load_data, check_data"),
+    ("registry", "from abide.registry import classifier_names; classifier_names()"),
+    ("one classifier", "from abide.registry import make_classifier; make_classifier('KNN')"),
+    ("all classifiers", "from abide.registry import get_classifiers; get_classifiers()"),
+    ("preprocessing", "from abide.preprocessing import preproc_data"),
+]
+
+HEAVY_MODULES = ["pandas", "sklearn", "scipy", "tensorflow", "keras"]
+
+
+def time_statement(statement, repeats=5):
+    """
+    Run a statement in fresh interpreters and measure the wall time.
+
+    Parameters
+    ----------
+    statement: str
+        Python code to run.
+
+    repeats: int
+        Number of runs.
+
+    Returns
+    -------
+    median_time: float
+        Median wall time over the runs, in seconds.
+
+    heavy_modules: list of str
+        The modules from HEAVY_MODULES which were imported by the statement.
+    """
+    code = "%s\nimport sys, json\nprint(json.dumps([m for m in %s if m in sys.modules]))" % (statement, repr(HEAVY_MODULES))
+    repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    times = []
+    heavy_modules = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", code], cwd=repo_dir, check=True, capture_output=True, text=True).stdout
+        times.append(time.perf_counter() - start)
+        heavy_modules = json.loads(output.strip().splitlines()[-1])
+    return float(np.median(times)), heavy_modules
+
+
+def run_benchmark(repeats=5):
+    """
+    Time all statements in STATEMENTS and print a table.
+    """
+    print("%-20s %10s   %s" % ("stage", "median [s]", "heavy modules imported"))
+    for name, statement in STATEMENTS:
+        median_time, heavy_modules = time_statement(statement, repeats=repeats)
+        print("%-20s %10.3f   %s" % (name, median_time, ", ".join(heavy_modules) if heavy_modules else "-"))
+
+
+if __name__ == "__main__":
+    run_benchmark()
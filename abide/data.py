@@ -0,0 +1,241 @@
+"""
+Loading of ABIDE brain descriptors and metadata.
+
+This module only depends on numpy and pandas, so quick jobs like data checks do not pay for importing scikit-learn.
+"""
+
+import os
+import json
+import logging
+import numpy as np
+import pandas as pd
+from instrumentation import instrument
+
+
+@instrument()
+def load_data(descriptors_file, subjects_file, metadata_file, descriptor_families=None, dtype=None):
+    """
+    Load data and merge it.
+
+    Parameters
+    ----------
+    descriptors_file: str
+        Path to a file containing brain descriptor values. Either a binary descriptor store written by gen_braindescriptors.py (file extension '.npy', see load_descriptor_store), or a file in CSV format. In a CSV file, each line should contain data on a single subject, and can have an arbitrary number of columns (descriptor values). All lines must have identical length, though. Must have a header line.
+
+    subject_file: str
+        Path to subjects text file, each line contains a single subject ID, no header. Ignored for a binary descriptor store, which contains the subject IDs.
+
+    metadata_file: str
+        Path to metadata CSV file from ABIDE data. The required file is named 'Phenotypic_V1_0b_preprocessed1.csv' when downloaded from ABIDE.
+
+    descriptor_families: list of str, optional
+        Descriptor name prefixes, like 'aparc_thickness' or 'stats_aseg'. If given, only the descriptor columns starting with one of them are loaded. Only supported for a binary descriptor store. Defaults to all columns.
+
+    dtype: str or numpy dtype, optional
+        The float type of the descriptor values, e.g., 'float32' to halve the memory. The values are converted while reading, without a float64 copy of the whole matrix. Defaults to the type in the file (float64 for CSV files).
+
+    Returns
+    -------
+    descriptors: dataframe
+        Dataframe containing descriptor data, one subject per row.
+
+    metadata: dataframe
+        Dataframe containing metadata, one subject per row.
+    """
+    if descriptors_file.endswith(".npy"):
+        logging.info("Reading brain descriptor data and subject order from binary descriptor store '%s'." % (descriptors_file))
+        descriptors, subjects_list = load_descriptor_store(descriptors_file, descriptor_families=descriptor_families, dtype=dtype)
+        subjects = pd.DataFrame({"subject_id": subjects_list})
+    else:
+        if descriptor_families is not None:
+            raise ValueError("Loading only some descriptor families is only supported for binary descriptor stores, not for CSV file '%s'." % (descriptors_file))
+        logging.info("Reading brain descriptor data from file '%s', subject order from file '%s'." % (descriptors_file, subjects_file))
+        descriptors = pd.read_csv(descriptors_file, header=0, dtype=dtype)
+        subjects = pd.read_csv(subjects_file, header=None, names=["subject_id"])
+    logging.debug("Descriptor data shape: %s" % (str(descriptors.shape)))
+    logging.debug("Subject data shape: %s" % (str(subjects.shape)))
+
+    #logging.debug("Descriptors:")
+    #logging.debug(descriptors.head())
+
+    #descriptors["subject_id"] = subjects["subject_id"]    # add subject IDs to descriptors dataframe
+    logging.debug("Merged descriptor data shape (with subject ID field): %s" % (str(descriptors.shape)))
+
+    logging.debug("Reading ABIDE metadata on subjects from file '%s'." % (metadata_file))
+    metadata = pd.read_csv(metadata_file, header=0)
+    logging.debug("Full metadata shape: %s" % (str(metadata.shape)))
+
+
+    logging.debug("Descriptors:")
+    logging.debug(descriptors.head())
+
+    # Drop all columns (descriptors) for which ALL subjects have NaN values. These are completely useless.
+    descriptors.dropna(axis='columns', how='all', inplace=True)
+
+    # Filter metadata: keep only the data on our subjects
+    filtered_metadata = pd.merge(subjects, metadata, how='left', left_on="subject_id", right_on="FILE_ID")
+    logging.debug("Filtered metadata shape after removing subjects which we have no descriptor data on: %s" % (str(filtered_metadata.shape)))
+    return descriptors, filtered_metadata
+
+
+def load_descriptor_store(store_file, descriptor_families=None, dtype=None):
+    """
+    Load descriptors from a binary descriptor store written by gen_braindescriptors.py.
+
+    The matrix is memory-mapped, so only the pages of the selected columns are read from disk. Columns which are NaN for all subjects are skipped based on the index, without reading them.
+
+    Parameters
+    ----------
+    store_file: str
+        Path to the .npy file of the store. The JSON index file is expected next to it, with the same base name and suffix '_index.json'.
+
+    descriptor_families: list of str, optional
+        Descriptor name prefixes. If given, only columns whose name starts with one of them are loaded.
+
+    dtype: str or numpy dtype, optional
+        The float type of the loaded values. Defaults to the type in the store. If it differs, the selected columns are converted while reading them from the memory map.
+
+    Returns
+    -------
+    descriptors: dataframe
+        Dataframe containing the selected descriptor data, one subject per row.
+
+    subjects: list of str
+        The subject IDs, in row order.
+    """
+    with open(descriptor_store_index_file(store_file), "r") as fh:
+        index = json.load(fh)
+    all_nan_columns = set(index["all_nan_columns"])
+    column_indices = [idx for idx, name in enumerate(index["columns"]) if name not in all_nan_columns and (descriptor_families is None or name.startswith(tuple(descriptor_families)))]
+    if not column_indices:
+        raise ValueError("No descriptor columns in store '%s' match the descriptor families %s." % (store_file, str(descriptor_families)))
+
+    values = np.load(store_file, mmap_mode='r')
+    if len(column_indices) == values.shape[1]:
+        selected_values = np.asarray(values, dtype=dtype)
+    elif column_indices == list(range(column_indices[0], column_indices[-1] + 1)):
+        selected_values = np.asarray(values[:, column_indices[0]:column_indices[-1] + 1], dtype=dtype)    # contiguous columns: a view, no copy unless converted
+    else:
+        selected_values = values[:, column_indices]    # reads only the selected columns
+        if dtype is not None:
+            selected_values = selected_values.astype(dtype, copy=False)
+    logging.debug("Loaded %d of %d descriptor columns from store '%s'." % (len(column_indices), len(index["columns"]), store_file))
+    descriptors = pd.DataFrame(selected_values, columns=[index["columns"][idx] for idx in column_indices], copy=False)
+    return descriptors, index["subjects"]
+
+
+def descriptor_store_index_file(store_file):
+    """
+    Get the path of the JSON index file which belongs to a binary descriptor store.
+    """
+    return os.path.splitext(store_file)[0] + "_index.json"
+
+
+def save_descriptor_store(store_file, descriptor_names, descriptor_values, subjects_list):
+    """
+    Save descriptors in a binary, memory-mappable columnar format.
+
+    The values are written as a column-major (Fortran order) numpy matrix, so that each descriptor column is contiguous on disk and can be read on its own. The descriptor names, the subject IDs in row order, and the columns which are NaN for all subjects are written to a JSON index file next to it, see descriptor_store_index_file.
+
+    Parameters
+    ----------
+    store_file: str
+        Path of the .npy file to write.
+
+    descriptor_names: list of str
+        The column names.
+
+    descriptor_values: numpy 2D array
+        The descriptor values, one row per subject.
+
+    subjects_list: list of str
+        The subject IDs, in row order.
+    """
+    descriptor_values = np.asfortranarray(descriptor_values)
+    np.save(store_file, descriptor_values)
+    save_descriptor_store_index(store_file, descriptor_names, subjects_list, [name for name, all_nan in zip(descriptor_names, np.all(np.isnan(descriptor_values), axis=0)) if all_nan])
+
+
+def create_descriptor_store(store_file, num_subjects, num_descriptors, dtype=np.float64):
+    """
+    Create an empty binary descriptor store to be filled in chunks of rows, for matrices which do not fit into memory. The index file must be written with save_descriptor_store_index once all rows are filled.
+
+    Parameters
+    ----------
+    store_file: str
+        Path of the .npy file to write.
+
+    num_subjects: int
+        Number of rows.
+
+    num_descriptors: int
+        Number of columns.
+
+    dtype: numpy dtype
+        The float type of the values.
+
+    Returns
+    -------
+    numpy memmap
+        The writable, column-major matrix. Flush and delete it when done.
+    """
+    return np.lib.format.open_memmap(store_file, mode="w+", dtype=dtype, shape=(num_subjects, num_descriptors), fortran_order=True)
+
+
+def save_descriptor_store_index(store_file, descriptor_names, subjects_list, all_nan_columns):
+    """
+    Write the JSON index file of a binary descriptor store, see save_descriptor_store.
+    """
+    index = {"columns": list(descriptor_names),
+             "subjects": list(subjects_list),
+             "all_nan_columns": list(all_nan_columns)}
+    with open(descriptor_store_index_file(store_file), "w") as fh:
+        json.dump(index, fh)
+
+
+def add_covariates(descriptors, metadata, dtype=None):
+    """
+    Add the covariates from the metadata to the descriptors dataframe, in place.
+
+    Parameters
+    ----------
+    descriptors: dataframe
+        Descriptor data, one subject per row.
+
+    metadata: dataframe
+        Metadata, one subject per row.
+
+    dtype: str or numpy dtype, optional
+        The float type of the numerical covariates, which should match the descriptors, so the preprocessed matrix is not upcast. Defaults to the type in the metadata.
+
+    Returns
+    -------
+    numerical_covariates: list of str
+        The names of the numerical covariates, which the preprocessor passes through.
+
+    categorical_covariates: list of str
+        The names of the categorical covariates, which need special encoding.
+    """
+    ## Add covariates to descriptors. Some are numerical (which is fine), but some are categorical and need special encoding.
+
+    ## Add numerical covariates to descriptors:
+    numerical_covariates = ["AGE_AT_SCAN"]
+    for cov in numerical_covariates:
+        descriptors[cov] = metadata[cov] if dtype is None else metadata[cov].astype(dtype)
+
+    ## Add categorial covariates
+    categorical_covariates = ["SEX", "SITE_ID"]
+    for cov in categorical_covariates:
+        descriptors[cov] = metadata[cov]
+    return numerical_covariates, categorical_covariates
+
+
+def check_data(data):
+    """
+    Check whether the number of descriptors in the training and test data is equal. If not, the one-hot-encoding of categorial features may have caused issues (i.e., some values occur only in the training data or only in the test data).
+    """
+    X_train, X_test, y_train, y_test = data
+    num_features_train = X_train.shape[1]
+    num_features_test = X_test.shape[1]
+    if num_features_train != num_features_test:
+        logging.error("Mismatch between descriptor count in training and test data: %d versus %d. There may be categorical columns which lack column values in one of the two sets." % (num_features_train, num_features_test))
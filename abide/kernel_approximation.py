@@ -0,0 +1,125 @@
+"""
+Scalable approximations of the kernel classifiers in the comparison: an inducing-point Gaussian process classifier, and the factories for Nystroem and random Fourier feature pipelines registered in abide.registry.
+
+The exact RBF SVM scales quadratically and the exact Gaussian process classifier cubically with the number of subjects. The approximations map the data to a fixed number of kernel features and fit a linear model on them, which scales linearly.
+"""
+
+import numpy as np
+from scipy.special import expit
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.kernel_approximation import Nystroem
+from sklearn.linear_model import LogisticRegression
+from sklearn.utils.validation import check_is_fitted
+
+
+def median_length_scale(X, num_samples=1000, random_state=0):
+    """
+    Estimate an RBF length scale as the median distance between pairs of observations (median heuristic).
+
+    Parameters
+    ----------
+    X: numpy 2D array
+        The observations.
+
+    num_samples: int
+        Number of random observations used for the pairwise distances.
+
+    random_state: int
+        Seed for the sample.
+
+    Returns
+    -------
+    float
+        The median pairwise distance, or 1.0 if all sampled observations are equal.
+    """
+    rng = np.random.RandomState(random_state)
+    sample = X[rng.choice(X.shape[0], size=min(num_samples, X.shape[0]), replace=False)]
+    sq_norms = np.einsum("ij,ij->i", sample, sample)
+    sq_dists = sq_norms[:, np.newaxis] + sq_norms[np.newaxis, :] - 2.0 * (sample @ sample.T)
+    dists = np.sqrt(np.maximum(sq_dists[np.triu_indices(sample.shape[0], k=1)], 0.0))
+    median = np.median(dists) if dists.size > 0 else 0.0
+    return float(median) if median > 0 else 1.0
+
+
+class SparseGaussianProcessClassifier(ClassifierMixin, BaseEstimator):
+    """
+    Gaussian process classifier with an RBF kernel and the subset-of-regressors (inducing point) approximation, fitted with the Laplace approximation.
+
+    The latent function is f(x) = phi(x) w with w ~ N(0, amplitude * I), where phi are the Nystroem features of n_inducing inducing points (random training observations). The posterior mode of w is found by L2-regularized logistic regression, and the predictive probabilities use the Laplace approximation of the posterior variance with the probit approximation, as GaussianProcessClassifier does. Fitting costs O(n m^2) instead of O(n^3) for n observations and m inducing points. More than two classes are handled one-vs-rest.
+
+    Parameters
+    ----------
+    n_inducing: int
+        Number of inducing points.
+
+    length_scale: float, optional
+        Length scale of the RBF kernel. Defaults to the median distance between training observations. Unlike GaussianProcessClassifier, the kernel parameters are not optimized.
+
+    amplitude: float
+        Prior variance of the latent function.
+
+    random_state: int
+        Seed for the choice of inducing points.
+    """
+    def __init__(self, n_inducing=500, length_scale=None, amplitude=1.0, random_state=0):
+        self.n_inducing = n_inducing
+        self.length_scale = length_scale
+        self.amplitude = amplitude
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y)
+        self.classes_ = np.unique(y)
+        if len(self.classes_) < 2:
+            raise ValueError("SparseGaussianProcessClassifier needs at least 2 classes, got %d." % (len(self.classes_)))
+        self.length_scale_ = self.length_scale if self.length_scale is not None else median_length_scale(X, random_state=self.random_state)
+        self.feature_map_ = Nystroem(kernel="rbf", gamma=0.5 / self.length_scale_ ** 2, n_components=min(self.n_inducing, X.shape[0]), random_state=self.random_state)
+        Phi = self.feature_map_.fit_transform(X)
+
+        targets = [self.classes_[1]] if len(self.classes_) == 2 else list(self.classes_)
+        self.weights_ = np.empty((Phi.shape[1], len(targets)))
+        self.covariances_ = np.empty((len(targets), Phi.shape[1], Phi.shape[1]))
+        for idx, target in enumerate(targets):
+            y_binary = (y == target).astype(np.int64)
+            model = LogisticRegression(C=self.amplitude, fit_intercept=False, max_iter=1000)    # the L2 penalty is the Gaussian prior on w
+            model.fit(Phi, y_binary)
+            w = model.coef_[0]
+            p = expit(Phi @ w)
+            hessian = (Phi * (p * (1.0 - p))[:, np.newaxis]).T @ Phi + np.eye(Phi.shape[1]) / self.amplitude
+            self.weights_[:, idx] = w
+            self.covariances_[idx] = np.linalg.inv(hessian)
+        return self
+
+    def _latent_probabilities(self, X):
+        check_is_fitted(self, "weights_")
+        Phi = self.feature_map_.transform(np.asarray(X, dtype=np.float64))
+        mean = Phi @ self.weights_
+        variance = np.stack([np.einsum("ij,ij->i", Phi @ covariance, Phi) for covariance in self.covariances_], axis=1)
+        return expit(mean / np.sqrt(1.0 + np.pi * variance / 8.0))    # probit approximation of the predictive probability
+
+    def predict_proba(self, X):
+        probabilities = self._latent_probabilities(X)
+        if len(self.classes_) == 2:
+            return np.hstack([1.0 - probabilities, probabilities])
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+
+def nystroem_svm_params(gamma=2, C=1, n_components=500):
+    """
+    Parameters for a sklearn Pipeline of Nystroem features and a linear SVM, approximating SVC(gamma=gamma, C=C).
+    """
+    from sklearn.svm import LinearSVC
+    return {"steps": [("features", Nystroem(kernel="rbf", gamma=gamma, n_components=n_components, random_state=0)), ("svm", LinearSVC(C=C, loss="hinge", max_iter=5000))]}
+
+
+def random_fourier_svm_params(gamma=2, alpha=1e-4, n_components=2000):
+    """
+    Parameters for a sklearn Pipeline of random Fourier features and a linear SVM trained by SGD, approximating an RBF SVM. SGD keeps the cost per epoch linear in the number of subjects, and the pipeline could be fitted out of core with partial_fit.
+    """
+    from sklearn.kernel_approximation import RBFSampler
+    from sklearn.linear_model import SGDClassifier
+    return {"steps": [("features", RBFSampler(gamma=gamma, n_components=n_components, random_state=0)), ("svm", SGDClassifier(loss="hinge", alpha=alpha, max_iter=50, tol=1e-3, random_state=0))]}
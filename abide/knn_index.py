@@ -0,0 +1,380 @@
+"""
+Persisted tree index for k-nearest-neighbor classification of PCA-projected subjects.
+
+An index is a directory with a KD-tree or ball tree over the indexed points, their labels, and a small buffer of subjects added later. Index directories are named by a hash of their content and never change once written: adding subjects writes a new directory which refers to the tree of the old one, and only rebuilds the tree once the buffer exceeds a fraction of the indexed points. The tree arrays are memory-mapped when loaded, so an index is built once and then opened cheaply by every CV fold, test run and prediction server.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import logging
+import numpy as np
+import joblib
+import sklearn
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.neighbors import KDTree, BallTree
+from sklearn.utils.validation import check_is_fitted
+
+TREE_CLASSES = {"kd_tree": KDTree, "ball_tree": BallTree}
+INDEX_META_FILE = "index.json"
+CACHE_MAX_MB = 2048         # limits for the default index directory, see prune_index_dir
+CACHE_MAX_AGE_DAYS = 30
+
+
+def default_index_dir():
+    """
+    Get the default directory for the index directories: 'abide/knn_index' in the user cache directory ($XDG_CACHE_HOME, or ~/.cache), so the indexes do not end up in the working directory. PersistentKNeighborsClassifier prunes it to CACHE_MAX_MB and CACHE_MAX_AGE_DAYS, see prune_index_dir.
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "abide", "knn_index")
+
+
+def index_key(X, y, algorithm, leaf_size):
+    """
+    Compute the name of the index directory for points, labels and tree parameters.
+    """
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(X, dtype=np.float64).tobytes())
+    h.update(np.asarray(y).astype(str).tobytes())
+    h.update(repr((np.shape(X), algorithm, leaf_size, sklearn.__version__)).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _write_index_dir(index_dir, write_files):
+    """
+    Write an index directory atomically: the files are written to a temporary directory next to it, which is then renamed. If another process wrote the same index meanwhile, its directory is kept.
+    """
+    parent_dir = os.path.dirname(os.path.abspath(index_dir))
+    os.makedirs(parent_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir, prefix=".tmp_")
+    try:
+        write_files(tmp_dir)
+        os.rename(tmp_dir, index_dir)
+    except OSError:
+        if not os.path.isfile(os.path.join(index_dir, INDEX_META_FILE)):
+            raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def build_index(index_dir, X, y, algorithm="kd_tree", leaf_size=40):
+    """
+    Build a tree index over points and save it.
+
+    Parameters
+    ----------
+    index_dir: str
+        The index directory to write. Nothing is written if it exists already.
+
+    X: numpy 2D array
+        The points, e.g., the PCA projection of the training subjects.
+
+    y: numpy 1D array
+        The labels of the points.
+
+    algorithm: str
+        'kd_tree' or 'ball_tree'. KD-trees are faster for few dimensions (up to about 20); with more, both approach a linear scan, and a truncated PCA helps more than the choice of tree.
+
+    leaf_size: int
+        Number of points per leaf, see sklearn.neighbors.KDTree.
+
+    Returns
+    -------
+    str
+        The index directory.
+    """
+    if algorithm not in TREE_CLASSES:
+        raise ValueError("Invalid index algorithm '%s', must be one of %s." % (algorithm, ", ".join(TREE_CLASSES)))
+    if os.path.isfile(os.path.join(index_dir, INDEX_META_FILE)):
+        os.utime(index_dir)    # marks the index as used, see prune_index_dir
+        return index_dir
+    start = time.perf_counter()
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    tree = TREE_CLASSES[algorithm](X, leaf_size=leaf_size)
+
+    def write_files(tmp_dir):
+        joblib.dump(tree, os.path.join(tmp_dir, "tree.joblib"))    # numpy arrays are stored raw, so they can be memory-mapped
+        np.save(os.path.join(tmp_dir, "labels.npy"), np.asarray(y))
+        np.save(os.path.join(tmp_dir, "added_points.npy"), np.empty((0, X.shape[1])))
+        np.save(os.path.join(tmp_dir, "added_labels.npy"), np.asarray(y)[:0])
+        with open(os.path.join(tmp_dir, INDEX_META_FILE), "w") as fh:
+            json.dump({"tree_dir": None, "algorithm": algorithm, "leaf_size": leaf_size, "num_indexed": X.shape[0], "num_added": 0}, fh)
+
+    _write_index_dir(index_dir, write_files)
+    logging.info("Built %s index over %d points with %d dimensions in %.2f seconds, saved to directory '%s'." % (algorithm, X.shape[0], X.shape[1], time.perf_counter() - start, index_dir))
+    return index_dir
+
+
+def load_index(index_dir, mmap=True):
+    """
+    Open a saved index.
+
+    Parameters
+    ----------
+    index_dir: str
+        The index directory, see build_index and add_to_index.
+
+    mmap: bool
+        Whether to memory-map the tree arrays and labels instead of reading them.
+
+    Returns
+    -------
+    dict
+        With keys 'tree', 'labels', 'added_points', 'added_labels' and 'meta' (the parsed index.json).
+    """
+    with open(os.path.join(index_dir, INDEX_META_FILE), "r") as fh:
+        meta = json.load(fh)
+    tree_dir = index_dir if meta["tree_dir"] is None else os.path.join(os.path.dirname(os.path.abspath(index_dir)), meta["tree_dir"])
+    for used_dir in {index_dir, tree_dir}:
+        os.utime(used_dir)    # marks the index as used, see prune_index_dir
+    mmap_mode = 'r' if mmap else None
+    return {"tree": joblib.load(os.path.join(tree_dir, "tree.joblib"), mmap_mode=mmap_mode),
+            "labels": np.load(os.path.join(tree_dir, "labels.npy"), mmap_mode=mmap_mode, allow_pickle=False),
+            "added_points": np.load(os.path.join(index_dir, "added_points.npy")),
+            "added_labels": np.load(os.path.join(index_dir, "added_labels.npy"), allow_pickle=False),
+            "meta": meta}
+
+
+def add_to_index(index_dir, X, y, rebuild_fraction=0.25):
+    """
+    Add points to an index without a full rebuild.
+
+    The points are appended to the buffer of the index, which is searched by brute force. Once the buffer holds more than rebuild_fraction of the points in the tree, the tree is rebuilt over all points.
+
+    Parameters
+    ----------
+    index_dir: str
+        The existing index directory. It is not changed.
+
+    X: numpy 2D array
+        The new points.
+
+    y: numpy 1D array
+        Their labels.
+
+    rebuild_fraction: float
+        Buffer size relative to the tree size which triggers a rebuild.
+
+    Returns
+    -------
+    str
+        The directory of the new index, next to the old one.
+    """
+    index = load_index(index_dir, mmap=True)
+    meta = index["meta"]
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    added_points = np.vstack([index["added_points"], X])
+    added_labels = np.concatenate([index["added_labels"], np.asarray(y)])
+    h = hashlib.sha1()
+    h.update(os.path.basename(os.path.normpath(index_dir)).encode("utf-8"))
+    h.update(X.tobytes())
+    h.update(np.asarray(y).astype(str).tobytes())
+    new_index_dir = os.path.join(os.path.dirname(os.path.abspath(index_dir)), h.hexdigest())
+
+    if added_points.shape[0] > rebuild_fraction * meta["num_indexed"]:
+        logging.info("Rebuilding index with %d added points." % (added_points.shape[0]))
+        all_points = np.vstack([np.asarray(index["tree"].get_arrays()[0]), added_points])
+        return build_index(new_index_dir, all_points, np.concatenate([np.asarray(index["labels"]), added_labels]), algorithm=meta["algorithm"], leaf_size=meta["leaf_size"])
+
+    def write_files(tmp_dir):
+        np.save(os.path.join(tmp_dir, "added_points.npy"), added_points)
+        np.save(os.path.join(tmp_dir, "added_labels.npy"), added_labels)
+        new_meta = dict(meta, tree_dir=meta["tree_dir"] if meta["tree_dir"] is not None else os.path.basename(os.path.normpath(index_dir)), num_added=added_points.shape[0])
+        with open(os.path.join(tmp_dir, INDEX_META_FILE), "w") as fh:
+            json.dump(new_meta, fh)
+
+    if not os.path.isfile(os.path.join(new_index_dir, INDEX_META_FILE)):
+        _write_index_dir(new_index_dir, write_files)
+    logging.info("Added %d points to the index buffer (now %d, tree has %d), saved to directory '%s'." % (X.shape[0], added_points.shape[0], meta["num_indexed"], new_index_dir))
+    return new_index_dir
+
+
+def prune_index_dir(index_dir, max_size_mb=CACHE_MAX_MB, max_age_days=CACHE_MAX_AGE_DAYS, min_age_seconds=3600):
+    """
+    Delete the least recently used index directories in a directory of indexes, to bound its disk usage.
+
+    Index directories are deleted, oldest use first, if they were not used for max_age_days, or while the total size is above max_size_mb. Directories used within the last min_age_seconds are kept, as other processes (e.g., parallel CV folds) may still open them, and so are tree directories which a kept index refers to. Building and opening an index counts as a use.
+
+    Parameters
+    ----------
+    index_dir: str
+        The directory which contains the index directories, e.g., default_index_dir().
+
+    max_size_mb: float
+        Size limit in MB.
+
+    max_age_days: float
+        Age limit in days since the last use.
+
+    min_age_seconds: float
+        Indexes used more recently than this are never deleted.
+
+    Returns
+    -------
+    list of str
+        The deleted index directories.
+    """
+    if not os.path.isdir(index_dir):
+        return []
+    entries = []
+    for name in os.listdir(index_dir):
+        path = os.path.join(index_dir, name)
+        if name.startswith(".") or not os.path.isfile(os.path.join(path, INDEX_META_FILE)):
+            continue    # temporary directories of writers in progress
+        with open(os.path.join(path, INDEX_META_FILE), "r") as fh:
+            tree_dir = json.load(fh)["tree_dir"]
+        size = sum(os.path.getsize(os.path.join(path, file_name)) for file_name in os.listdir(path))
+        entries.append({"name": name, "path": path, "mtime": os.path.getmtime(path), "size": size, "tree_dir": tree_dir})
+    entries.sort(key=lambda entry: entry["mtime"])
+
+    now = time.time()
+    total_size = sum(entry["size"] for entry in entries)
+    deleted = set()
+    deleted_in_pass = True
+    while deleted_in_pass:    # a tree directory can be deleted once the indexes which refer to it are gone
+        deleted_in_pass = False
+        for entry in [entry for entry in entries if entry["name"] not in deleted]:
+            if now - entry["mtime"] < min_age_seconds:
+                break
+            if now - entry["mtime"] < max_age_days * 86400.0 and total_size <= max_size_mb * 1024.0 * 1024.0:
+                break
+            if any(other["tree_dir"] == entry["name"] for other in entries if other["name"] not in deleted and other is not entry):
+                continue
+            shutil.rmtree(entry["path"], ignore_errors=True)
+            deleted.add(entry["name"])
+            total_size -= entry["size"]
+            deleted_in_pass = True
+    if deleted:
+        logging.info("Deleted %d unused index directories from '%s', %.1f MB left." % (len(deleted), index_dir, total_size / 1024.0 / 1024.0))
+    return [os.path.join(index_dir, name) for name in sorted(deleted)]
+
+
+def query_index(index, X, n_neighbors, batch_size=1024):
+    """
+    Find the nearest indexed points of query points, in batches.
+
+    Parameters
+    ----------
+    index: dict
+        The opened index, see load_index.
+
+    X: numpy 2D array
+        The query points.
+
+    n_neighbors: int
+        Number of neighbors per query point.
+
+    batch_size: int
+        Number of query points per batch. Bounds the memory of the brute-force search in the buffer.
+
+    Returns
+    -------
+    distances: numpy 2D array
+        The distances to the neighbors, one row per query point, sorted ascending.
+
+    labels: numpy 2D array
+        The labels of the neighbors, in the same order.
+    """
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    tree, labels = index["tree"], index["labels"]
+    added_points, added_labels = index["added_points"], index["added_labels"]
+    k_tree = min(n_neighbors, index["meta"]["num_indexed"])
+    k_added = min(n_neighbors, added_points.shape[0])
+    added_sq_norms = np.einsum("ij,ij->i", added_points, added_points)
+    all_distances, all_labels = [], []
+    for start in range(0, X.shape[0], batch_size):
+        batch = X[start:start + batch_size]
+        distances, indices = tree.query(batch, k=k_tree)
+        neighbor_labels = labels[indices]
+        if k_added > 0:
+            sq_dists = np.maximum(np.einsum("ij,ij->i", batch, batch)[:, np.newaxis] + added_sq_norms[np.newaxis, :] - 2.0 * (batch @ added_points.T), 0.0)
+            nearest = np.argpartition(sq_dists, k_added - 1, axis=1)[:, :k_added]
+            distances = np.hstack([distances, np.sqrt(np.take_along_axis(sq_dists, nearest, axis=1))])
+            neighbor_labels = np.hstack([neighbor_labels, added_labels[nearest]])
+            order = np.argsort(distances, axis=1, kind="stable")[:, :n_neighbors]
+            distances = np.take_along_axis(distances, order, axis=1)
+            neighbor_labels = np.take_along_axis(neighbor_labels, order, axis=1)
+        all_distances.append(distances)
+        all_labels.append(neighbor_labels)
+    return np.vstack(all_distances), np.vstack(all_labels)
+
+
+class PersistentKNeighborsClassifier(ClassifierMixin, BaseEstimator):
+    """
+    k-nearest-neighbor classifier with uniform weights, like KNeighborsClassifier, which keeps its tree index on disk.
+
+    Fitting looks up the index of the training data in index_dir and only builds it if it does not exist yet, so repeated runs and identical CV folds do not rebuild the tree. The index is memory-mapped on first use, and pickling the classifier (e.g., with save_model) stores only the index path, so a prediction server opens the same index. New subjects can be added with add, without a full rebuild.
+
+    Parameters
+    ----------
+    n_neighbors: int
+        Number of neighbors which vote.
+
+    algorithm: str
+        'kd_tree' or 'ball_tree', see build_index.
+
+    leaf_size: int
+        Number of points per tree leaf.
+
+    index_dir: str, optional
+        Directory for the index directories, which are named by the hash of their content. Defaults to default_index_dir(), resolved when fitting, which is pruned after each fit, see prune_index_dir. Other directories are never pruned; pass one next to a saved model, so the model does not depend on the cache.
+
+    batch_size: int
+        Number of query points per batch, see query_index.
+
+    rebuild_fraction: float
+        Buffer size relative to the tree size which triggers a rebuild in add, see add_to_index.
+    """
+    def __init__(self, n_neighbors=3, algorithm="kd_tree", leaf_size=40, index_dir=None, batch_size=1024, rebuild_fraction=0.25):
+        self.n_neighbors = n_neighbors
+        self.algorithm = algorithm
+        self.leaf_size = leaf_size
+        self.index_dir = index_dir
+        self.batch_size = batch_size
+        self.rebuild_fraction = rebuild_fraction
+
+    def fit(self, X, y):
+        y = np.asarray(y)
+        self.classes_ = np.unique(y)
+        index_dir = self.index_dir if self.index_dir is not None else default_index_dir()
+        self.index_path_ = os.path.abspath(os.path.join(index_dir, index_key(X, y, self.algorithm, self.leaf_size)))
+        build_index(self.index_path_, X, y, algorithm=self.algorithm, leaf_size=self.leaf_size)
+        if self.index_dir is None:
+            prune_index_dir(index_dir)
+        self._index = None
+        return self
+
+    def add(self, X, y):
+        """
+        Add subjects to the index of this classifier, see add_to_index. Labels not seen in fit are added to the classes.
+        """
+        check_is_fitted(self, "index_path_")
+        self.index_path_ = add_to_index(self.index_path_, X, y, rebuild_fraction=self.rebuild_fraction)
+        self.classes_ = np.union1d(self.classes_, np.asarray(y))
+        self._index = None
+        return self
+
+    def kneighbors(self, X):
+        """
+        Get the distances and labels of the nearest training subjects, see query_index.
+        """
+        check_is_fitted(self, "index_path_")
+        if getattr(self, "_index", None) is None:
+            self._index = load_index(self.index_path_, mmap=True)
+        return query_index(self._index, X, self.n_neighbors, batch_size=self.batch_size)
+
+    def predict_proba(self, X):
+        _, neighbor_labels = self.kneighbors(X)
+        votes = np.stack([np.sum(neighbor_labels == label, axis=1) for label in self.classes_], axis=1)
+        return votes / neighbor_labels.shape[1]
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]    # ties go to the smallest label, as in KNeighborsClassifier
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_index"] = None    # the memory-mapped index is reopened from index_path_
+        return state
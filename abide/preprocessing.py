@@ -0,0 +1,474 @@
+"""
+Preprocessing of ABIDE data: covariates, train/test split, imputation, scaling, one-hot encoding and PCA.
+"""
+
+import os
+import json
+import hashlib
+import tracemalloc
+import time
+import logging
+import numpy as np
+import pandas as pd
+import joblib
+import sklearn
+from sklearn.model_selection import train_test_split
+from sklearn.preprocessing import OneHotEncoder
+from sklearn.compose import ColumnTransformer
+from sklearn.pipeline import Pipeline
+from sklearn.impute import SimpleImputer
+from sklearn.preprocessing import MinMaxScaler
+from sklearn.decomposition import PCA, IncrementalPCA
+from .data import add_covariates
+from instrumentation import instrument, stage
+
+
+@instrument()
+def preproc_data(descriptors, metadata, labels, cache_dir="preproc_cache", pca_mode="full", pca_components=None, pca_variance=0.95, pca_batch_size=1000, return_transformers=False, feature_filter=None, measure_filter_savings=False, dtype=None):
+    """
+    Add covariates, split the data into training and test sets, and scale and PCA-transform both.
+
+    The preprocessor and PCA are fitted on the training set only and then applied to both sets. The fitted transformers are cached on disk, see fit_preprocessing.
+
+    Parameters
+    ----------
+    descriptors: dataframe
+        Descriptor data, one subject per row. The covariates are added to it in place.
+
+    metadata: dataframe
+        Metadata, one subject per row.
+
+    labels: series
+        The labels, one per subject.
+
+    cache_dir: str or None
+        Directory for the fitted transformers cache. Pass None to disable the cache.
+
+    pca_mode: str, one of 'full', 'randomized', 'variance' or 'incremental'
+        The PCA strategy, see build_pca.
+
+    pca_components: int, optional
+        Number of principal components to keep for the 'randomized' and 'incremental' modes, see build_pca.
+
+    pca_variance: float
+        Target explained variance ratio for the 'variance' mode.
+
+    pca_batch_size: int
+        Number of rows per batch for the 'incremental' mode.
+
+    return_transformers: bool
+        Whether to also return the fitted preprocessor and PCA, e.g., to save them together with a trained model.
+
+    feature_filter: dict, optional
+        If given, descriptor columns are pre-filtered on the training rows before the preprocessor and PCA are fitted, see fit_feature_filter, which receives the dict as keyword arguments. E.g., {"max_nan_share": 0.5, "min_variance": 0.0, "max_correlation": 0.98}. Defaults to no filtering.
+
+    measure_filter_savings: bool
+        If True and feature_filter is given, the preprocessor and PCA are additionally fitted on the unfiltered training data to report how much time the filter saved. Both fits bypass the cache then, so they are timed under the same conditions. Only meant for benchmarking.
+
+    dtype: str or numpy dtype, optional
+        The float type of the preprocessed data and PCA, e.g., 'float32' to halve the memory of all stages. Descriptors of another type are converted first, so pass the same dtype to load_data to avoid that copy. Defaults to float64.
+
+    Returns
+    -------
+    X_train, X_test, y_train, y_test
+        The transformed training and test data and the labels.
+
+    preprocessor, pca
+        The fitted transformers. Only returned if return_transformers is True.
+    """
+    logging.info("Scaling data, creating training and test sets.")
+
+    if descriptors.shape[0] != metadata.shape[0]:
+        logging.error("Mismatch in size of descriptors and metadata: %d versus %d, but both should be for the same number of observations/subjects." % (descriptors.shape[0], metadata.shape[0]))
+
+    if descriptors.shape[0] != labels.shape[0]:
+        logging.error("Mismatch in size of descriptors and labels: %d versus %d, but both should be for the same number of observations/subjects." % (descriptors.shape[0], labels.shape[0]))
+
+    if dtype is not None and any(column_dtype != np.dtype(dtype) for column_dtype in descriptors.dtypes):
+        logging.debug("Converting descriptors to %s." % (np.dtype(dtype).name))
+        descriptors = descriptors.astype(dtype)
+
+    numeric_features = list(descriptors.columns) # set to list of all column names from current dataframe
+    numerical_covariates, categorical_features = add_covariates(descriptors, metadata, dtype=dtype)   # The only categorial features in the dataframe are the covariates we just added.
+
+    # prepare data for classification task:
+    X_train, X_test, y_train, y_test = train_test_split(descriptors, labels, test_size=.4, random_state=42)
+
+    logging.debug("Received training data: descriptor shape is %s, and %d labels for it." % (str(X_train.shape), y_train.shape[0]))
+    logging.debug("Received test data: descriptor shape is %s, and %d labels for it." % (str(X_test.shape), y_test.shape[0]))
+
+    if feature_filter is not None:
+        with stage("feature_filter") as current:
+            kept_features, filter_report = fit_feature_filter(X_train, numeric_features, **feature_filter)
+            current.set(**filter_report)
+        kept_columns = kept_features + numerical_covariates + categorical_features    # the numerical covariates reach the model through the passthrough remainder
+        X_train_unfiltered = X_train
+        X_train, X_test = X_train[kept_columns], X_test[kept_columns]
+
+    pca = build_pca(pca_mode, n_components=pca_components, target_variance=pca_variance, batch_size=pca_batch_size)
+    measure_savings = feature_filter is not None and measure_filter_savings
+    start = time.perf_counter()
+    preprocessor, pca = fit_preprocessing(X_train, kept_features if feature_filter is not None else numeric_features, categorical_features, pca=pca, cache_dir=None if measure_savings else cache_dir, dtype=dtype)    # a cache hit would make the timed fits incomparable
+    fit_time = time.perf_counter() - start
+
+    if measure_savings:
+        start = time.perf_counter()
+        fit_preprocessing(X_train_unfiltered, numeric_features, categorical_features, pca=build_pca(pca_mode, n_components=pca_components, target_variance=pca_variance, batch_size=pca_batch_size), cache_dir=None, dtype=dtype)
+        unfiltered_fit_time = time.perf_counter() - start
+        filter_report["time_saved"] = unfiltered_fit_time - fit_time - filter_report["filter_time"]
+        logging.info("Feature filter saved %.2f seconds: fitting took %.2f seconds on %d columns instead of %.2f seconds on %d columns, the filter itself took %.2f seconds." % (unfiltered_fit_time - fit_time - filter_report["filter_time"], fit_time, filter_report["columns_after"], unfiltered_fit_time, filter_report["columns_before"], filter_report["filter_time"]))
+    X_train = transform_data(preprocessor, pca, X_train)
+    X_test = transform_data(preprocessor, pca, X_test)
+
+    for pc in range(min(10, pca.n_components_)):
+        logging.info("  PCA principal component #%d explained variance: %f" % (pc, pca.explained_variance_ratio_[pc]))
+
+    logging.debug("After PCA: Training data shape is %s (%s, %.1f MB), with %d labels for it." % (str(X_train.shape), X_train.dtype.name, X_train.nbytes / 1024.0 / 1024.0, y_train.shape[0]))
+    logging.debug("After PCA: Test data shape is %s, with %d labels for it." % (str(X_test.shape), y_test.shape[0]))
+
+    if return_transformers:
+        return X_train, X_test, y_train, y_test, preprocessor, pca
+    return X_train, X_test, y_train, y_test
+
+
+def fit_feature_filter(X_train, columns=None, max_nan_share=0.5, min_variance=0.0, max_correlation=None, chunk_size=4096, correlation_rows=5000, correlation_block_size=512, random_state=42):
+    """
+    Select the descriptor columns worth preprocessing, based on the training rows only.
+
+    NaN share and variance of all columns are computed in one streaming pass over row chunks, so a memory-mapped descriptor store is read chunk by chunk and no float copy of the whole matrix is made. Columns with too many NaN values or too little variance are dropped. Optionally, columns which are highly correlated with an earlier kept column are dropped as well. The correlations are estimated on a random subset of the training rows, in column blocks.
+
+    Parameters
+    ----------
+    X_train: dataframe
+        The training data.
+
+    columns: list of str, optional
+        The columns to filter, typically the numeric descriptor columns. Defaults to all columns of X_train.
+
+    max_nan_share: float
+        Drop columns in which a larger share of the training values is NaN.
+
+    min_variance: float
+        Drop columns whose variance (over the non-NaN training values) is not larger than this. The default only drops constant columns. The variance is computed on the unscaled values, so larger thresholds depend on the descriptor units.
+
+    max_correlation: float, optional
+        If given, drop columns whose absolute Pearson correlation with an earlier kept column is larger than this, e.g., 0.98. NaN values are replaced with the column mean for this.
+
+    chunk_size: int
+        Number of rows per chunk in the streaming pass.
+
+    correlation_rows: int
+        Maximal number of training rows used to estimate the correlations.
+
+    correlation_block_size: int
+        Number of columns compared with the kept columns at once.
+
+    random_state: int
+        Seed for the selection of the correlation rows.
+
+    Returns
+    -------
+    kept_columns: list of str
+        The columns to keep, in their original order.
+
+    report: dict
+        With keys 'columns_before', 'columns_after', 'dropped_nan', 'dropped_variance', 'dropped_correlation', 'mb_before', 'mb_after' (size of the training matrix in the dtypes of its columns) and 'filter_time' in seconds.
+    """
+    start = time.perf_counter()
+    columns = list(X_train.columns) if columns is None else list(columns)
+    positions = X_train.columns.get_indexer(columns)
+    num_rows, num_cols = X_train.shape[0], len(columns)
+    count = np.zeros(num_cols)
+    mean = np.zeros(num_cols)
+    m2 = np.zeros(num_cols)
+    for chunk_start in range(0, num_rows, chunk_size):
+        chunk = X_train.iloc[chunk_start:chunk_start + chunk_size, positions].to_numpy(dtype=np.float64)
+        chunk_count = np.sum(~np.isnan(chunk), axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            chunk_mean = np.where(chunk_count > 0, np.nansum(chunk, axis=0) / chunk_count, 0.0)
+        chunk_m2 = np.nansum((chunk - chunk_mean) ** 2, axis=0)
+        total = count + chunk_count    # merge the chunk statistics (Chan et al.)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = chunk_mean - mean
+            mean = np.where(total > 0, mean + delta * chunk_count / total, 0.0)
+            m2 = np.where(total > 0, m2 + chunk_m2 + delta ** 2 * count * chunk_count / total, 0.0)
+        count = total
+    nan_share = 1.0 - count / max(num_rows, 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        variance = np.where(count > 0, m2 / count, 0.0)
+
+    drop_nan = nan_share > max_nan_share
+    drop_variance = ~drop_nan & (variance <= min_variance)
+    keep = ~drop_nan & ~drop_variance
+
+    drop_correlation = np.zeros(num_cols, dtype=bool)
+    if max_correlation is not None and np.sum(keep) > 1:
+        candidates = np.flatnonzero(keep)
+        rows = np.sort(np.random.RandomState(random_state).choice(num_rows, size=min(num_rows, correlation_rows), replace=False))
+        Z = X_train.iloc[rows, positions[candidates]].to_numpy(dtype=np.float32)
+        Z = np.where(np.isnan(Z), mean[candidates].astype(np.float32), Z)
+        Z -= Z.mean(axis=0)
+        norms = np.linalg.norm(Z, axis=0)
+        Z /= np.where(norms > 0, norms, 1.0)    # unit columns, so dot products are correlations
+        kept = np.zeros(candidates.shape[0], dtype=bool)
+        for block_start in range(0, candidates.shape[0], correlation_block_size):
+            block = np.arange(block_start, min(block_start + correlation_block_size, candidates.shape[0]))
+            block_keep = np.ones(block.shape[0], dtype=bool)
+            if np.any(kept):
+                block_keep &= np.max(np.abs(Z[:, kept].T @ Z[:, block]), axis=0) <= max_correlation
+            within = np.abs(Z[:, block].T @ Z[:, block])
+            for j in range(block.shape[0]):    # greedy in column order within the block
+                if block_keep[j] and j > 0 and np.any(within[j, :j][block_keep[:j]] > max_correlation):
+                    block_keep[j] = False
+            kept[block] = block_keep
+        drop_correlation[candidates[~kept]] = True
+        keep &= ~drop_correlation
+
+    kept_columns = [columns[idx] for idx in np.flatnonzero(keep)]
+    itemsizes = np.array([X_train.dtypes.iloc[position].itemsize for position in positions], dtype=np.float64)    # float32 columns take half the memory of float64 ones
+    report = {"columns_before": num_cols, "columns_after": len(kept_columns), "dropped_nan": int(np.sum(drop_nan)), "dropped_variance": int(np.sum(drop_variance)), "dropped_correlation": int(np.sum(drop_correlation)),
+              "mb_before": num_rows * np.sum(itemsizes) / 1024.0 / 1024.0, "mb_after": num_rows * np.sum(itemsizes[keep]) / 1024.0 / 1024.0, "filter_time": time.perf_counter() - start}
+    logging.info("Feature filter kept %d of %d columns (dropped %d for NaN share > %.2f, %d for variance <= %g, %d for correlation > %s), training matrix shrank from %.1f MB to %.1f MB, in %.2f seconds." % (report["columns_after"], num_cols, report["dropped_nan"], max_nan_share, report["dropped_variance"], min_variance, report["dropped_correlation"], str(max_correlation), report["mb_before"], report["mb_after"], report["filter_time"]))
+    return kept_columns, report
+
+
+def build_preprocessor(numeric_features, categorical_features, dtype=None):
+    """
+    Create the unfitted preprocessor: median imputation and min-max scaling for numeric features, most-frequent imputation and one-hot encoding for categorical features.
+
+    Categories which do not occur in the training data are encoded as all zeros, so that data of new subjects can be transformed with a preprocessor fitted earlier.
+
+    The scaler works in place on the copy made by the imputer, and the one-hot block stays sparse until the blocks are stacked, so the only full-size copies are the imputed matrix and the stacked output. Both keep the float type of the input; dtype sets the type of the one-hot block to match, as it would upcast the stacked output otherwise.
+    """
+    numeric_transformer = Pipeline(steps=[
+    ('imputer', SimpleImputer(strategy='median')),
+    ('scaler', MinMaxScaler(copy=False))])
+
+    categorical_transformer = Pipeline(steps=[
+    ('imputer', SimpleImputer(strategy='most_frequent')),
+    ('onehot', OneHotEncoder(handle_unknown='ignore', dtype=dtype if dtype is not None else np.float64))])
+
+    features_to_be_removed = [] # No need to drop stuff so far. (Most important: the label is not part of the descriptors, as it comes from the metadata. So no need to remove the label.)
+
+    preprocessor = ColumnTransformer(
+    remainder = 'passthrough',
+    transformers=[
+        ('numeric', numeric_transformer, numeric_features),
+        ('categorical', categorical_transformer, categorical_features),
+        ('remove', 'drop', features_to_be_removed)
+    ])
+    return preprocessor
+
+
+def preprocessing_cache_key(X_train, preprocessor, pca):
+    """
+    Compute a key which identifies fitted transformers by the training data and the transformer configuration.
+
+    Parameters
+    ----------
+    X_train: dataframe
+        The training data the transformers are fitted on.
+
+    preprocessor: ColumnTransformer
+        The unfitted preprocessor.
+
+    pca: PCA
+        The unfitted PCA.
+
+    Returns
+    -------
+    str
+        Hex digest over the column names, index, values, the transformer parameters and the scikit-learn version.
+    """
+    h = hashlib.sha1()
+    h.update(json.dumps([str(c) for c in X_train.columns]).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(X_train, index=True).values.tobytes())
+    h.update(repr(preprocessor.get_params(deep=True)).encode("utf-8"))
+    h.update(repr(pca.get_params(deep=True)).encode("utf-8"))
+    h.update(sklearn.__version__.encode("utf-8"))
+    return h.hexdigest()
+
+
+def build_pca(mode="full", n_components=None, target_variance=0.95, batch_size=1000):
+    """
+    Create an unfitted PCA for one of the supported strategies.
+
+    Parameters
+    ----------
+    mode: str
+        One of 'full' (exact PCA keeping all components), 'randomized' (randomized truncated SVD keeping n_components components, defaults to 100), 'variance' (exact PCA keeping the smallest number of components which explain target_variance of the variance) or 'incremental' (IncrementalPCA fitted in row batches of batch_size on the preprocessed data, keeping n_components components, defaults to batch_size).
+
+    n_components: int, optional
+        Number of components for the 'randomized' and 'incremental' modes. Capped at the number of samples and preprocessed features when fitting, and for 'incremental' also at batch_size.
+
+    target_variance: float
+        Explained variance ratio between 0 and 1 for the 'variance' mode.
+
+    batch_size: int
+        Rows per batch for the 'incremental' mode.
+
+    Returns
+    -------
+    PCA or IncrementalPCA
+        The unfitted PCA.
+    """
+    if mode == "full":
+        return PCA()
+    elif mode == "randomized":
+        return PCA(n_components=n_components if n_components is not None else 100, svd_solver='randomized', random_state=42)
+    elif mode == "variance":
+        return PCA(n_components=target_variance, svd_solver='full')
+    elif mode == "incremental":
+        return IncrementalPCA(n_components=n_components if n_components is not None else batch_size, batch_size=batch_size)
+    raise ValueError("Invalid PCA mode '%s', must be one of 'full', 'randomized', 'variance' or 'incremental'." % (mode))
+
+
+@instrument()
+def fit_preprocessing(X_train, numeric_features, categorical_features, pca=None, cache_dir="preproc_cache", dtype=None):
+    """
+    Fit the preprocessor and PCA on the training data, or load them from the cache.
+
+    Parameters
+    ----------
+    X_train: dataframe
+        The training data, including the covariate columns.
+
+    numeric_features: list of str
+        The numeric column names.
+
+    categorical_features: list of str
+        The categorical column names.
+
+    pca: PCA or IncrementalPCA, optional
+        The unfitted PCA, see build_pca. Defaults to a full PCA.
+
+    cache_dir: str or None
+        Directory in which fitted transformers are stored, keyed by preprocessing_cache_key. Pass None to always fit.
+
+    dtype: str or numpy dtype, optional
+        The float type of the preprocessed data, see build_preprocessor. The PCA is fitted in the same type. Defaults to float64.
+
+    Returns
+    -------
+    preprocessor: ColumnTransformer
+        The fitted preprocessor.
+
+    pca: PCA
+        The fitted PCA.
+    """
+    preprocessor = build_preprocessor(numeric_features, categorical_features, dtype=dtype)
+    if pca is None:
+        pca = PCA()
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, "%s.joblib" % (preprocessing_cache_key(X_train, preprocessor, pca)))
+        if os.path.isfile(cache_file):
+            logging.info("Loading fitted preprocessor and PCA from cache file '%s'." % (cache_file))
+            return joblib.load(cache_file)
+
+    logging.info("Fitting preprocessor.")
+    if isinstance(pca, IncrementalPCA):
+        preprocessor.fit(X_train)
+    else:
+        X_train = preprocessor.fit_transform(X_train)
+        logging.debug("After pre-proc: Training data shape is %s." % (str(X_train.shape)))
+
+    logging.info("Running dimensionality reduction (%s)." % (type(pca).__name__))
+    tracemalloc.start()
+    start = time.perf_counter()
+    if isinstance(pca, IncrementalPCA):
+        _fit_incremental_pca(pca, preprocessor, X_train)
+    else:
+        if pca.svd_solver == 'randomized':
+            pca.set_params(n_components=min(pca.n_components, X_train.shape[0], X_train.shape[1]))
+        pca.fit(X_train)
+    pca_time = time.perf_counter() - start
+    _, pca_peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    logging.info("PCA fit took %.2f seconds with %.1f MB peak memory, keeping %d components which explain %f of the variance." % (pca_time, pca_peak_memory / 1024.0 / 1024.0, pca.n_components_, np.sum(pca.explained_variance_ratio_)))
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = cache_file + ".tmp"
+        joblib.dump((preprocessor, pca), tmp_file)
+        os.replace(tmp_file, cache_file)
+        logging.info("Saved fitted preprocessor and PCA to cache file '%s'." % (cache_file))
+    return preprocessor, pca
+
+
+def _fit_incremental_pca(pca, preprocessor, X_train):
+    """
+    Fit an IncrementalPCA in row batches, so the preprocessed (imputed, scaled and one-hot encoded) training matrix is never materialized as a whole. This only bounds the memory of the PCA input: X_train itself is in memory, and the preprocessor is fitted on it in one go.
+
+    The number of components is capped at the batch size, the number of rows and the number of preprocessed features.
+    """
+    num_rows = X_train.shape[0]
+    batch_size = pca.batch_size
+    num_features = len(preprocessor.get_feature_names_out())
+    n_components = min(pca.n_components, batch_size, num_rows, num_features)
+    pca.set_params(n_components=n_components)
+    batch_starts = list(range(0, num_rows, batch_size))
+    if len(batch_starts) > 1 and num_rows - batch_starts[-1] < n_components:
+        batch_starts.pop()    # the last batch would be too small for partial_fit, merge it into the previous one
+    batch_ends = batch_starts[1:] + [num_rows]
+    for batch_start, batch_end in zip(batch_starts, batch_ends):
+        pca.partial_fit(preprocessor.transform(X_train.iloc[batch_start:batch_end]))
+
+
+def transform_data(preprocessor, pca, X):
+    """
+    Transform data with a fitted preprocessor and PCA, e.g., the test set or data of new subjects.
+
+    Parameters
+    ----------
+    preprocessor: ColumnTransformer
+        The fitted preprocessor, see fit_preprocessing.
+
+    pca: PCA
+        The fitted PCA.
+
+    X: dataframe
+        The data, with the same columns as the training data.
+
+    Returns
+    -------
+    numpy 2D array
+        The transformed data, one row per subject.
+    """
+    return pca.transform(preprocessor.transform(X))
+
+
+def save_model(model_file, preprocessor, pca, classifier, name=None, classes=None):
+    """
+    Save a fitted prediction pipeline (preprocessor, PCA and classifier) to a single file.
+
+    Parameters
+    ----------
+    model_file: str
+        Path of the output file, written with joblib.
+
+    preprocessor: ColumnTransformer
+        The fitted preprocessor. Its input columns define the expected input rows.
+
+    pca: PCA
+        The fitted PCA.
+
+    classifier: sklearn estimator or str
+        The fitted classifier, or the path to a saved Keras model file. Keras models are only loaded when the bundle is loaded.
+
+    name: str, optional
+        Display name of the classifier.
+
+    classes: array-like, optional
+        The labels of the output units of a Keras model, in order, so predicted class indices can be mapped back to labels. Not needed for sklearn classifiers, which predict labels.
+    """
+    bundle = {"preprocessor": preprocessor, "pca": pca, "columns": list(preprocessor.feature_names_in_), "name": name}
+    if classes is not None:
+        bundle["classes"] = np.asarray(classes)
+    if isinstance(classifier, str):
+        bundle["keras_model_file"] = classifier
+    else:
+        bundle["classifier"] = classifier
+    joblib.dump(bundle, model_file)
+    logging.info("Saved prediction pipeline '%s' to file '%s'." % (name, model_file))
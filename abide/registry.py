@@ -0,0 +1,160 @@
+"""
+Lazy registries for classifiers and deep learning backends.
+
+Estimator classes and backends are registered by module and class name, and only imported when an instance is first requested. This keeps the startup time of scripts low which never use most of them.
+"""
+
+import importlib
+import logging
+
+
+_CLASSIFIERS = dict()    # name -> (module name, class name, function returning the default parameters)
+_OPTIONAL_CLASSIFIERS = set()    # names which are not compared by default
+_BACKENDS = dict()       # name -> module name
+_loaded_backends = dict()
+
+
+def register_classifier(name, module_name, class_name, default_params=None, optional=False):
+    """
+    Register a classifier, without importing it.
+
+    Parameters
+    ----------
+    name: str
+        Display name of the classifier, e.g., 'RBF SVM'. Registering a name again replaces the previous entry.
+
+    module_name: str
+        The module which contains the estimator class, e.g., 'sklearn.svm'.
+
+    class_name: str
+        The name of the estimator class in that module, e.g., 'SVC'.
+
+    default_params: dict or callable, optional
+        The constructor parameters. If callable, it is called without arguments when an instance is created, which allows parameters that need imports themselves (like kernels).
+
+    optional: bool
+        If True, the classifier is only created when requested by name, and not part of the default set of get_classifiers. For classifiers with side effects, like writing files.
+    """
+    _CLASSIFIERS[name] = (module_name, class_name, default_params)
+    if optional:
+        _OPTIONAL_CLASSIFIERS.add(name)
+    else:
+        _OPTIONAL_CLASSIFIERS.discard(name)
+
+
+def classifier_names(include_optional=False):
+    """
+    Get the names of the registered classifiers, in registration order. Optional classifiers are only included if include_optional is True.
+    """
+    return [name for name in _CLASSIFIERS if include_optional or name not in _OPTIONAL_CLASSIFIERS]
+
+
+def make_classifier(name, **params):
+    """
+    Create an unfitted instance of a registered classifier, importing its module on first use.
+
+    Parameters
+    ----------
+    name: str
+        The registered name.
+
+    params: keyword arguments
+        Parameters which override the registered default parameters.
+
+    Returns
+    -------
+    sklearn estimator
+        The new instance.
+    """
+    if name not in _CLASSIFIERS:
+        raise ValueError("Unknown classifier '%s', registered are: %s" % (name, ", ".join(classifier_names(include_optional=True))))
+    module_name, class_name, default_params = _CLASSIFIERS[name]
+    estimator_class = getattr(importlib.import_module(module_name), class_name)
+    all_params = dict(default_params() if callable(default_params) else (default_params or {}))
+    all_params.update(params)
+    return estimator_class(**all_params)
+
+
+def get_classifiers(names=None):
+    """
+    Get the classifiers to compare, with hard-coded parameters.
+
+    Parameters
+    ----------
+    names: list of str, optional
+        The classifiers to create. Defaults to all registered ones except the optional ones.
+
+    Returns
+    -------
+    classifier_names: list of str
+        Display names of the classifiers.
+
+    classifiers: list of sklearn estimators
+        The unfitted classifiers, in the same order as the names.
+    """
+    if names is None:
+        names = classifier_names()
+    return list(names), [make_classifier(name) for name in names]
+
+
+def register_backend(name, module_name):
+    """
+    Register a deep learning backend, like 'keras' or 'tensorflow', without importing it.
+    """
+    _BACKENDS[name] = module_name
+
+
+def get_backend(name):
+    """
+    Get a registered backend module, importing it on first use.
+
+    Parameters
+    ----------
+    name: str
+        The registered backend name.
+
+    Returns
+    -------
+    module
+        The imported backend module.
+    """
+    if name not in _loaded_backends:
+        if name not in _BACKENDS:
+            raise ValueError("Unknown backend '%s', registered are: %s" % (name, ", ".join(_BACKENDS.keys())))
+        logging.debug("Importing backend '%s' from module '%s'." % (name, _BACKENDS[name]))
+        _loaded_backends[name] = importlib.import_module(_BACKENDS[name])
+    return _loaded_backends[name]
+
+
+def _gaussian_process_params():
+    from sklearn.gaussian_process.kernels import RBF
+    return {"kernel": 1.0 * RBF(1.0)}
+
+
+def _nystroem_svm_params():
+    from .kernel_approximation import nystroem_svm_params
+    return nystroem_svm_params()
+
+
+def _random_fourier_svm_params():
+    from .kernel_approximation import random_fourier_svm_params
+    return random_fourier_svm_params()
+
+
+register_classifier("KNN", "sklearn.neighbors", "KNeighborsClassifier", {"n_neighbors": 3})
+register_classifier("Persistent KNN", "abide.knn_index", "PersistentKNeighborsClassifier", {"n_neighbors": 3}, optional=True)    # same predictions as KNN, opt-in as it writes index directories
+register_classifier("Linear SVM", "sklearn.svm", "SVC", {"kernel": "linear", "C": 0.025})
+register_classifier("RBF SVM", "sklearn.svm", "SVC", {"gamma": 2, "C": 1})
+register_classifier("Gaussian Process", "sklearn.gaussian_process", "GaussianProcessClassifier", _gaussian_process_params)
+register_classifier("Nystroem SVM", "sklearn.pipeline", "Pipeline", _nystroem_svm_params)    # scalable approximations of the two above, see kernel_approximation
+register_classifier("Random Fourier SVM", "sklearn.pipeline", "Pipeline", _random_fourier_svm_params)
+register_classifier("Sparse Gaussian Process", "abide.kernel_approximation", "SparseGaussianProcessClassifier", {"n_inducing": 500})
+register_classifier("Decision Tree", "sklearn.tree", "DecisionTreeClassifier", {"max_depth": 5})
+register_classifier("Random Forest", "sklearn.ensemble", "RandomForestClassifier", {"max_depth": 5, "n_estimators": 10, "max_features": 1})
+register_classifier("Neural Net", "sklearn.neural_network", "MLPClassifier", {"alpha": 1, "max_iter": 2000})
+register_classifier("AdaBoost", "sklearn.ensemble", "AdaBoostClassifier")
+register_classifier("Naive Bayes", "sklearn.naive_bayes", "GaussianNB")
+register_classifier("QDA", "sklearn.discriminant_analysis", "QuadraticDiscriminantAnalysis")
+
+register_backend("keras", "keras")
+register_backend("tensorflow", "tensorflow")
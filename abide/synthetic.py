@@ -0,0 +1,243 @@
+"""
+Synthetic ABIDE-shaped data, to test and benchmark the pipelines without the private ABIDE FreeSurfer outputs.
+
+Writes the same files as gen_braindescriptors.py and the ABIDE download: a descriptor CSV (or binary descriptor store), a subjects file and a phenotypic CSV with the columns used by the pipelines (FILE_ID, SUB_ID, SITE_ID, SEX, AGE_AT_SCAN, DX_GROUP). Run from the repository root with:
+
+    python -m abide.synthetic --subjects 1000 --descriptors 5000 --output-dir synthetic_data
+"""
+
+import os
+import argparse
+import logging
+import numpy as np
+import pandas as pd
+
+from .data import create_descriptor_store, save_descriptor_store_index
+
+# Site names as in the ABIDE phenotypic file, with the number of subjects at each site as relative weights.
+SITES = {"CALTECH": 38, "CMU": 27, "KKI": 55, "LEUVEN_1": 29, "LEUVEN_2": 35, "MAX_MUN": 57, "NYU": 184, "OHSU": 28, "OLIN": 36, "PITT": 57,
+         "SBL": 30, "SDSU": 36, "STANFORD": 40, "TRINITY": 49, "UCLA_1": 82, "UCLA_2": 27, "UM_1": 110, "UM_2": 35, "USM": 101, "YALE": 56}
+
+DESCRIPTOR_FAMILIES = ["aparc_thickness", "aparc_area", "aparc_volume", "aparc.a2009s_thickness", "aparc.a2009s_area", "aparc_sulc", "aparc_curv", "stats_aseg"]
+
+METADATA_FILE_NAME = "Phenotypic_V1_0b_preprocessed1.csv"
+
+
+def descriptor_names(num_descriptors):
+    """
+    Create descriptor names in the style of gen_braindescriptors.py, cycling over DESCRIPTOR_FAMILIES and the hemispheres.
+    """
+    names = []
+    for idx in range(num_descriptors):
+        family = DESCRIPTOR_FAMILIES[idx % len(DESCRIPTOR_FAMILIES)]
+        hemi = "lh" if (idx // len(DESCRIPTOR_FAMILIES)) % 2 == 0 else "rh"
+        names.append("%s_%s_region%d" % (family, hemi, idx // (2 * len(DESCRIPTOR_FAMILIES))))
+    return names
+
+
+def generate_metadata(num_subjects, seed=0, age_nan_fraction=0.0):
+    """
+    Create a synthetic phenotypic table.
+
+    Parameters
+    ----------
+    num_subjects: int
+        Number of subjects.
+
+    seed: int
+        Seed for the random numbers.
+
+    age_nan_fraction: float
+        Fraction of subjects without AGE_AT_SCAN. The real phenotypic file has the age of all subjects, and preproc_data does not impute covariates.
+
+    Returns
+    -------
+    dataframe
+        One row per subject, with columns SUB_ID, FILE_ID, SITE_ID, SEX (1 male, 2 female, about 85% male as in ABIDE), AGE_AT_SCAN and DX_GROUP (1 autism, 2 control, about balanced).
+    """
+    rng = np.random.RandomState(seed)
+    site_names = np.array(sorted(SITES))
+    site_weights = np.array([SITES[site] for site in site_names], dtype=np.float64)
+    sites = site_names[rng.choice(len(site_names), size=num_subjects, p=site_weights / site_weights.sum())]
+    sub_ids = 50001 + np.arange(num_subjects)
+    file_ids = np.array(["%s_%07d" % (site.title(), sub_id) for site, sub_id in zip(sites, sub_ids)])
+    age = np.clip(rng.gamma(4.0, 4.0, size=num_subjects) + 6.0, 6.0, 65.0)
+    age[rng.rand(num_subjects) < age_nan_fraction] = np.nan
+    return pd.DataFrame({"SUB_ID": sub_ids, "FILE_ID": file_ids, "SITE_ID": sites,
+                         "SEX": np.where(rng.rand(num_subjects) < 0.85, 1, 2),
+                         "AGE_AT_SCAN": np.round(age, 2),
+                         "DX_GROUP": rng.randint(1, 3, size=num_subjects)})
+
+
+def iter_descriptor_chunks(metadata, num_descriptors, seed=0, nan_fraction=0.001, failed_family_fraction=0.02, all_nan_fraction=0.005, effect_size=0.15, chunk_size=None):
+    """
+    Create a synthetic descriptor matrix for the subjects in a phenotypic table, in chunks of rows.
+
+    The values are positive and roughly log-normal, with a per-site offset (scanner effect), a weak age trend and a weak diagnosis effect on a tenth of the descriptors, so classifiers have something to find. The NaN patterns follow the real data: a few random values, whole descriptor families missing for some subjects (failed FreeSurfer stats), and some columns which are NaN for all subjects. Only one chunk of values and its NaN mask are in memory at a time, so large matrices can be streamed to disk, see write_dataset.
+
+    Parameters
+    ----------
+    metadata: dataframe
+        As returned by generate_metadata.
+
+    num_descriptors: int
+        Number of descriptor columns.
+
+    seed: int
+        Seed for the random numbers. The values also depend on chunk_size.
+
+    nan_fraction: float
+        Fraction of random NaN values.
+
+    failed_family_fraction: float
+        Fraction of subjects for which one whole descriptor family is NaN.
+
+    all_nan_fraction: float
+        Fraction of columns which are NaN for all subjects.
+
+    effect_size: float
+        Diagnosis effect on the affected descriptors, in standard deviations.
+
+    chunk_size: int, optional
+        Number of rows per chunk. Defaults to about 2^22 values (32 MB) per chunk.
+
+    Yields
+    ------
+    start: int
+        Index of the first row of the chunk.
+
+    chunk: numpy 2D float64 array
+        The descriptor values of the chunk, one row per subject.
+    """
+    rng = np.random.RandomState(seed + 1)
+    num_subjects = metadata.shape[0]
+    site_codes = pd.Categorical(metadata["SITE_ID"]).codes
+    site_offsets = rng.normal(0.0, 0.3, size=(site_codes.max() + 1, num_descriptors))
+    base = rng.uniform(0.5, 8.0, size=num_descriptors)
+    age = np.nan_to_num(metadata["AGE_AT_SCAN"].values, nan=np.nanmean(metadata["AGE_AT_SCAN"].values))
+    diagnosis = metadata["DX_GROUP"].values
+    affected = rng.rand(num_descriptors) < 0.1
+    all_nan_columns = rng.rand(num_descriptors) < all_nan_fraction
+    family_of_column = np.arange(num_descriptors) % len(DESCRIPTOR_FAMILIES)
+
+    if chunk_size is None:
+        chunk_size = max(1, 2 ** 22 // max(1, num_descriptors))
+    for start in range(0, num_subjects, chunk_size):
+        rows = slice(start, min(start + chunk_size, num_subjects))
+        chunk = rng.standard_normal((rows.stop - rows.start, num_descriptors))
+        chunk += site_offsets[site_codes[rows]]
+        chunk -= 0.01 * (age[rows, np.newaxis] - 20.0)
+        chunk[:, affected] += effect_size * (diagnosis[rows, np.newaxis] == 1)
+        np.multiply(chunk, 0.15, out=chunk)
+        np.exp(chunk, out=chunk)
+        chunk *= base
+
+        chunk[rng.rand(*chunk.shape) < nan_fraction] = np.nan
+        for subject in np.flatnonzero(rng.rand(chunk.shape[0]) < failed_family_fraction):
+            chunk[subject, family_of_column == rng.randint(len(DESCRIPTOR_FAMILIES))] = np.nan
+        chunk[:, all_nan_columns] = np.nan
+        yield start, chunk
+
+
+def generate_descriptors(metadata, num_descriptors, seed=0, **kwargs):
+    """
+    Create a synthetic descriptor matrix for the subjects in a phenotypic table, in memory. For large matrices, use write_dataset, which streams the chunks to disk.
+
+    Parameters
+    ----------
+    metadata: dataframe
+        As returned by generate_metadata.
+
+    num_descriptors: int
+        Number of descriptor columns.
+
+    seed: int
+        Seed for the random numbers.
+
+    kwargs:
+        Passed on to iter_descriptor_chunks, e.g., the NaN fractions.
+
+    Returns
+    -------
+    numpy 2D float64 array
+        The descriptor values, one row per subject.
+    """
+    values = np.empty((metadata.shape[0], num_descriptors), dtype=np.float64)
+    for start, chunk in iter_descriptor_chunks(metadata, num_descriptors, seed=seed, **kwargs):
+        values[start:start + chunk.shape[0]] = chunk
+    return values
+
+
+def write_dataset(output_dir, num_subjects, num_descriptors, seed=0, file_format="csv"):
+    """
+    Generate a synthetic dataset and write it in the layout of the ABIDE project directory.
+
+    Parameters
+    ----------
+    output_dir: str
+        Output directory. Receives 'braindescriptors.csv' or 'braindescriptors.npy' (with index, see save_descriptor_store), 'subjects.txt' and 'tools/Phenotypic_V1_0b_preprocessed1.csv'.
+
+    num_subjects: int
+        Number of subjects (rows).
+
+    num_descriptors: int
+        Number of descriptors (columns).
+
+    seed: int
+        Seed for the random numbers.
+
+    file_format: str
+        'csv' for a descriptor CSV like bdi.save writes it, 'npy' for a binary descriptor store, or 'both'.
+
+    Returns
+    -------
+    tuple of str
+        The descriptors file (the store if both are written), the subjects file and the metadata file.
+    """
+    if file_format not in ["csv", "npy", "both"]:
+        raise ValueError("Invalid file format '%s', must be one of 'csv', 'npy' or 'both'." % (file_format))
+    os.makedirs(os.path.join(output_dir, "tools"), exist_ok=True)
+    metadata = generate_metadata(num_subjects, seed=seed)
+    names = descriptor_names(num_descriptors)
+    subjects = metadata["FILE_ID"].tolist()
+
+    metadata_file = os.path.join(output_dir, "tools", METADATA_FILE_NAME)
+    metadata.to_csv(metadata_file, index=False)
+    subjects_file = os.path.join(output_dir, "subjects.txt")
+    with open(subjects_file, "w") as fh:
+        fh.write("\n".join(subjects) + "\n")
+
+    csv_fh = open(os.path.join(output_dir, "braindescriptors.csv"), "w") if file_format in ["csv", "both"] else None
+    if csv_fh is not None:
+        csv_fh.write(",".join(names) + "\n")
+    store_file = os.path.join(output_dir, "braindescriptors.npy")
+    store = create_descriptor_store(store_file, num_subjects, num_descriptors) if file_format in ["npy", "both"] else None
+    all_nan = np.ones(num_descriptors, dtype=bool)
+    for start, chunk in iter_descriptor_chunks(metadata, num_descriptors, seed=seed):    # each chunk goes to the outputs, the full matrix is never in memory
+        if csv_fh is not None:
+            np.savetxt(csv_fh, chunk, delimiter=",", fmt="%.6g")    # pandas' to_csv would format the whole chunk as strings first
+        if store is not None:
+            store[start:start + chunk.shape[0]] = chunk
+            all_nan &= np.all(np.isnan(chunk), axis=0)
+    if csv_fh is not None:
+        csv_fh.close()
+        descriptors_file = csv_fh.name
+    if store is not None:
+        store.flush()
+        del store
+        save_descriptor_store_index(store_file, names, subjects, [name for name, column_all_nan in zip(names, all_nan) if column_all_nan])
+        descriptors_file = store_file
+    logging.info("Wrote synthetic data on %d subjects with %d descriptors to directory '%s'." % (num_subjects, num_descriptors, output_dir))
+    return descriptors_file, subjects_file, metadata_file
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Write a synthetic ABIDE-shaped dataset.")
+    parser.add_argument("--subjects", type=int, default=1000, help="Number of subjects.")
+    parser.add_argument("--descriptors", type=int, default=5000, help="Number of descriptors.")
+    parser.add_argument("--output-dir", default="synthetic_data", help="Output directory.")
+    parser.add_argument("--format", default="csv", choices=["csv", "npy", "both"], help="Descriptor file format.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    args = parser.parse_args()
+    write_dataset(args.output_dir, args.subjects, args.descriptors, seed=args.seed, file_format=args.format)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#
+# Speed and accuracy of the scalable kernel approximations (see abide/kernel_approximation.py) against the exact RBF SVM
+# and Gaussian process classifier, on synthetic ABIDE-shaped data (see abide/synthetic.py) of increasing size:
+#
+#    python bench_kernel_approximation.py --subjects 500 1000 2000 5000 20000 --exact-max-subjects 5000
+
+import os
+import sys
+import argparse
+import logging
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))    # for the shared abide package
+from abide.data import load_data
+from abide.preprocessing import preproc_data
+from abide.registry import make_classifier
+from abide.synthetic import write_dataset
+from predict_abide_brainage import evaluate_on_test_set
+
+# Exact classifier -> its approximations, all registered in abide.registry.
+APPROXIMATIONS = {"RBF SVM": ["Nystroem SVM", "Random Fourier SVM"], "Gaussian Process": ["Sparse Gaussian Process"]}
+
+
+def run_benchmark(subject_counts=(500, 1000, 2000, 5000), num_descriptors=1000, exact_max_subjects=2000, pca_components=100, data_dir="synthetic_data", output_file="bench_kernel_approximation.csv"):
+    """
+    Fit the exact kernel classifiers and their approximations on synthetic data of increasing size and record fit time, predict time and test accuracy.
+
+    Parameters
+    ----------
+    subject_counts: sequence of int
+        The numbers of subjects. 40% of them are the test set, see preproc_data.
+
+    num_descriptors: int
+        Number of descriptors of the synthetic data.
+
+    exact_max_subjects: int
+        The exact classifiers are skipped for larger subject counts, as they would take hours.
+
+    pca_components: int
+        Number of PCA components (randomized PCA), to keep the preprocessing fast for large subject counts.
+
+    data_dir: str
+        Directory for the generated datasets, one subdirectory per configuration. Existing datasets are reused.
+
+    output_file: str
+        The result CSV file, rewritten after every configuration.
+
+    Returns
+    -------
+    dataframe
+        One row per subject count and classifier, with columns 'subjects', 'classifier', 'exact' (name of the exact classifier), 'status', 'fit_time', 'predict_time', 'test_score' and 'agreement' (share of test predictions equal to those of the exact classifier, NaN if it was skipped).
+    """
+    rows = []
+    for num_subjects in subject_counts:
+        dataset_dir = os.path.join(data_dir, "s%d_d%d" % (num_subjects, num_descriptors))
+        descriptors_file = os.path.join(dataset_dir, "braindescriptors.npy")
+        if not os.path.isfile(descriptors_file):
+            write_dataset(dataset_dir, num_subjects, num_descriptors, file_format="npy")
+        descriptors, metadata = load_data(descriptors_file, os.path.join(dataset_dir, "subjects.txt"), os.path.join(dataset_dir, "tools", "Phenotypic_V1_0b_preprocessed1.csv"))
+        X_train, X_test, y_train, y_test = preproc_data(descriptors, metadata, metadata["DX_GROUP"], cache_dir=None, pca_mode="randomized", pca_components=min(pca_components, descriptors.shape[1]))
+        y_train, y_test = np.asarray(y_train), np.asarray(y_test)
+
+        for exact, approximations in APPROXIMATIONS.items():
+            exact_predictions = None
+            for name in [exact] + approximations:
+                row = {"subjects": num_subjects, "classifier": name, "exact": exact, "status": "ok", "fit_time": np.nan, "predict_time": np.nan, "test_score": np.nan, "agreement": np.nan}
+                if name == exact and num_subjects > exact_max_subjects:
+                    row["status"] = "skipped"
+                else:
+                    clf = make_classifier(name)
+                    row["test_score"], _, row["fit_time"], row["predict_time"], predictions = evaluate_on_test_set(clf, X_train, y_train, X_test, y_test, return_predictions=True)
+                    if name == exact:
+                        exact_predictions = predictions
+                    elif exact_predictions is not None:
+                        row["agreement"] = np.mean(predictions == exact_predictions)
+                logging.info("%d subjects, %-25s %s: fit time %9.2f sec, predict time %7.3f sec, test accuracy %.3f, agreement with exact %.3f." % (num_subjects, name, row["status"], row["fit_time"], row["predict_time"], row["test_score"], row["agreement"]))
+                rows.append(row)
+        pd.DataFrame(rows).to_csv(output_file, index=False)
+    logging.info("Wrote benchmark results to file '%s'." % (output_file))
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Compare the exact kernel classifiers with their scalable approximations on synthetic data of increasing size.")
+    parser.add_argument("--subjects", type=int, nargs="+", default=[500, 1000, 2000, 5000], help="Subject counts.")
+    parser.add_argument("--descriptors", type=int, default=1000, help="Descriptor count.")
+    parser.add_argument("--exact-max-subjects", type=int, default=2000, help="Skip the exact classifiers above this subject count.")
+    parser.add_argument("--pca-components", type=int, default=100, help="Number of PCA components.")
+    parser.add_argument("--data-dir", default="synthetic_data", help="Directory for the generated datasets.")
+    parser.add_argument("--output-file", default="bench_kernel_approximation.csv", help="Result CSV file.")
+    args = parser.parse_args()
+    run_benchmark(args.subjects, args.descriptors, exact_max_subjects=args.exact_max_subjects, pca_components=args.pca_components, data_dir=args.data_dir, output_file=args.output_file)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# Query latency of the persisted kNN tree index (see abide/knn_index.py) against brute-force search, on the PCA
+# projection of synthetic ABIDE-shaped data (see abide/synthetic.py) of increasing size:
+#
+#    python bench_knn_index.py --subjects 1000 10000 100000 --pca-components 20
+
+import os
+import sys
+import time
+import argparse
+import logging
+import tempfile
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import NearestNeighbors
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))    # for the shared abide package
+from abide.data import load_data
+from abide.preprocessing import preproc_data
+from abide.synthetic import write_dataset
+from abide.knn_index import build_index, load_index, query_index, index_key
+
+ALGORITHMS = ["kd_tree", "ball_tree"]
+
+
+def run_benchmark(subject_counts=(1000, 5000, 20000), num_descriptors=200, pca_components=20, n_neighbors=3, batch_size=1024, data_dir="synthetic_data", output_file="bench_knn_index.csv"):
+    """
+    Build the tree indexes over the training projection and time batched queries of the test set, compared with a brute-force search.
+
+    Parameters
+    ----------
+    subject_counts: sequence of int
+        The numbers of subjects. The test set is split off by preproc_data.
+
+    num_descriptors: int
+        Number of descriptors of the synthetic data.
+
+    pca_components: int
+        Number of PCA components (randomized PCA), i.e., the dimension of the indexed points. Trees only beat a linear scan for a few dozen dimensions at most.
+
+    n_neighbors: int
+        Number of neighbors per query.
+
+    batch_size: int
+        Number of query points per batch.
+
+    data_dir: str
+        Directory for the generated datasets, one subdirectory per configuration. Existing datasets are reused.
+
+    output_file: str
+        The result CSV file, rewritten after every configuration.
+
+    Returns
+    -------
+    dataframe
+        One row per subject count and algorithm ('brute', 'kd_tree', 'ball_tree'), with columns 'subjects', 'algorithm', 'build_time', 'open_time' (memory-mapping the saved index), 'query_time' (all test queries), 'latency_ms' (per query point) and 'recall' (share of the brute-force neighbors found).
+    """
+    rows = []
+    for num_subjects in subject_counts:
+        dataset_dir = os.path.join(data_dir, "s%d_d%d" % (num_subjects, num_descriptors))
+        descriptors_file = os.path.join(dataset_dir, "braindescriptors.npy")
+        if not os.path.isfile(descriptors_file):
+            write_dataset(dataset_dir, num_subjects, num_descriptors, file_format="npy")
+        descriptors, metadata = load_data(descriptors_file, os.path.join(dataset_dir, "subjects.txt"), os.path.join(dataset_dir, "tools", "Phenotypic_V1_0b_preprocessed1.csv"))
+        X_train, X_test, y_train, _ = preproc_data(descriptors, metadata, metadata["DX_GROUP"], cache_dir=None, pca_mode="randomized", pca_components=pca_components)
+        y_train = np.asarray(y_train)
+
+        start = time.perf_counter()
+        brute = NearestNeighbors(n_neighbors=n_neighbors, algorithm="brute").fit(X_train)
+        build_time = time.perf_counter() - start
+        start = time.perf_counter()
+        _, reference = brute.kneighbors(X_test)
+        query_time = time.perf_counter() - start
+        reference_labels = y_train[reference]
+        rows.append({"subjects": num_subjects, "algorithm": "brute", "build_time": build_time, "open_time": 0.0, "query_time": query_time, "latency_ms": 1000.0 * query_time / X_test.shape[0], "recall": 1.0})
+
+        with tempfile.TemporaryDirectory() as index_root:
+            for algorithm in ALGORITHMS:
+                index_dir = os.path.join(index_root, index_key(X_train, y_train, algorithm, 40))
+                start = time.perf_counter()
+                build_index(index_dir, X_train, y_train, algorithm=algorithm)
+                build_time = time.perf_counter() - start
+                start = time.perf_counter()
+                index = load_index(index_dir, mmap=True)
+                open_time = time.perf_counter() - start
+                start = time.perf_counter()
+                distances, _ = query_index(index, X_test, n_neighbors, batch_size=batch_size)
+                query_time = time.perf_counter() - start
+                reference_distances = np.linalg.norm(X_test[:, np.newaxis, :] - X_train[reference], axis=2)
+                recall = np.mean(np.isclose(np.sort(distances, axis=1), np.sort(reference_distances, axis=1)))    # compared by distance, as ties may swap indices
+                rows.append({"subjects": num_subjects, "algorithm": algorithm, "build_time": build_time, "open_time": open_time, "query_time": query_time, "latency_ms": 1000.0 * query_time / X_test.shape[0], "recall": recall})
+        for row in rows[-len(ALGORITHMS) - 1:]:
+            logging.info("%d subjects, %-9s: build %8.3f sec, open %6.3f sec, query %8.3f sec (%.4f ms per subject), recall %.3f." % (num_subjects, row["algorithm"], row["build_time"], row["open_time"], row["query_time"], row["latency_ms"], row["recall"]))
+        pd.DataFrame(rows).to_csv(output_file, index=False)
+    logging.info("Wrote benchmark results to file '%s'." % (output_file))
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Compare the kNN tree index with brute-force search on synthetic data of increasing size.")
+    parser.add_argument("--subjects", type=int, nargs="+", default=[1000, 5000, 20000], help="Subject counts.")
+    parser.add_argument("--descriptors", type=int, default=200, help="Descriptor count.")
+    parser.add_argument("--pca-components", type=int, default=20, help="Dimension of the indexed PCA projection.")
+    parser.add_argument("--neighbors", type=int, default=3, help="Number of neighbors.")
+    parser.add_argument("--batch-size", type=int, default=1024, help="Query points per batch.")
+    parser.add_argument("--data-dir", default="synthetic_data", help="Directory for the generated datasets.")
+    parser.add_argument("--output-file", default="bench_knn_index.csv", help="Result CSV file.")
+    args = parser.parse_args()
+    run_benchmark(args.subjects, args.descriptors, pca_components=args.pca_components, n_neighbors=args.neighbors, batch_size=args.batch_size, data_dir=args.data_dir, output_file=args.output_file)
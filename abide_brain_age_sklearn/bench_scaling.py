@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+# Scaling benchmark of the classification pipeline on synthetic ABIDE-shaped data (see abide/synthetic.py).
+#
+# For every combination of subject count and descriptor count, a synthetic dataset is generated (once, reused in later
+# runs), and load_data, preproc_data and compare_classifiers are run in a fresh process with stage tracing enabled
+# (see ../instrumentation). The wall time, CPU time and peak RSS of each stage are collected in a CSV file:
+#
+#    python bench_scaling.py --subjects 1000 10000 100000 --descriptors 1000 20000 --time-budget 600
+#
+# With --precisions float64 float32, every configuration is run in both float types, to compare memory, runtime and accuracy.
+
+import os
+import sys
+import json
+import argparse
+import logging
+import subprocess
+import tempfile
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))    # for the shared abide package
+from abide.synthetic import write_dataset
+
+STAGES = ["load_data", "preproc_data", "compare_classifiers"]
+
+
+def _run_pipeline(descriptors_file, subjects_file, metadata_file, num_workers, time_budget, stages, feature_filter=None, dtype=None):
+    """
+    Run the pipeline stages on one dataset. Meant to run in a fresh process, with tracing enabled by the caller.
+    """
+    from abide.data import load_data
+    from abide.preprocessing import preproc_data
+    from instrumentation import stage
+    from predict_abide_brainage import compare_classifiers
+    descriptors, metadata = load_data(descriptors_file, subjects_file, metadata_file, dtype=dtype)
+    if "preproc_data" not in stages:
+        return
+    data = preproc_data(descriptors, metadata, metadata["DX_GROUP"], cache_dir=None, feature_filter=feature_filter, measure_filter_savings=feature_filter is not None, dtype=dtype)
+    if "compare_classifiers" in stages:
+        results = compare_classifiers(data, num_workers=num_workers, time_budget=time_budget)
+        with stage("test_scores") as current:    # only to pass the accuracy on in the trace
+            current.set(mean_test_score=float(results["test_score"].mean()))
+
+
+def run_configuration(data_dir, num_subjects, num_descriptors, num_workers=1, time_budget=None, stages=STAGES, file_format="csv", feature_filter=None, dtype=None):
+    """
+    Generate (or reuse) the dataset for one configuration and run the pipeline on it in a fresh process.
+
+    Returns
+    -------
+    list of dict
+        One entry per top-level stage with keys 'subjects', 'descriptors', 'precision', 'stage', 'status', 'wall_time', 'cpu_time', 'peak_rss_mb', 'peak_rss_increase_mb', 'columns_after_filter' and 'mean_test_score' (mean test accuracy of all classifiers, only for the 'test_scores' entry). Nested stages are included as well, with their full path as stage name.
+    """
+    dataset_dir = os.path.join(data_dir, "s%d_d%d" % (num_subjects, num_descriptors))
+    descriptors_file = os.path.join(dataset_dir, "braindescriptors.%s" % ("npy" if file_format == "npy" else "csv"))
+    subjects_file = os.path.join(dataset_dir, "subjects.txt")
+    metadata_file = os.path.join(dataset_dir, "tools", "Phenotypic_V1_0b_preprocessed1.csv")
+    if not os.path.isfile(descriptors_file):
+        write_dataset(dataset_dir, num_subjects, num_descriptors, file_format=file_format)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        trace_file = os.path.join(tmp_dir, "trace.json")
+        code = "import sys\nsys.path.insert(0, %s)\nimport bench_scaling\nbench_scaling._run_pipeline(%s, %s, %s, %d, %s, %s, %s, %s)" % (repr(os.path.dirname(os.path.abspath(__file__))), repr(descriptors_file), repr(subjects_file), repr(metadata_file), num_workers, repr(time_budget), repr(list(stages)), repr(feature_filter), repr(dtype))
+        env = dict(os.environ, PIPELINE_TRACE=trace_file)
+        process = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True)
+        if process.returncode != 0:
+            logging.error("Pipeline failed for %d subjects x %d descriptors: %s" % (num_subjects, num_descriptors, process.stderr.strip().splitlines()[-1] if process.stderr.strip() else "no output"))
+        if not os.path.isfile(trace_file):
+            return [{"subjects": num_subjects, "descriptors": num_descriptors, "precision": dtype or "float64", "stage": "all", "status": "failed"}]
+        with open(trace_file, "r") as fh:
+            records = json.load(fh)["stages"]
+    return [{"subjects": num_subjects, "descriptors": num_descriptors, "precision": dtype or "float64", "stage": r["stage"], "status": r["status"], "wall_time": r["wall_time"], "cpu_time": r["cpu_time"], "peak_rss_mb": r["peak_rss_mb"], "peak_rss_increase_mb": r["peak_rss_increase_mb"], "columns_after_filter": r["info"].get("columns_after"), "mean_test_score": r["info"].get("mean_test_score")} for r in records]
+
+
+def run_benchmark(subject_counts=(1000, 10000), descriptor_counts=(1000, 5000), data_dir="synthetic_data", output_file="bench_scaling.csv", num_workers=1, time_budget=None, stages=STAGES, file_format="csv", feature_filter=None, precisions=("float64",)):
+    """
+    Run the pipeline for all combinations of subject and descriptor counts and write the stage measurements to a CSV file.
+
+    Parameters
+    ----------
+    subject_counts: sequence of int
+        The numbers of subjects (rows).
+
+    descriptor_counts: sequence of int
+        The numbers of descriptors (columns).
+
+    data_dir: str
+        Directory for the generated datasets, one subdirectory per configuration. Existing datasets are reused.
+
+    output_file: str
+        The result CSV file, rewritten after every configuration.
+
+    num_workers: int
+        Number of worker processes for compare_classifiers.
+
+    time_budget: float, optional
+        Wall-clock budget in seconds per classifier for compare_classifiers, recommended for large configurations.
+
+    stages: sequence of str
+        The stages to run, a prefix of STAGES.
+
+    file_format: str
+        Descriptor file format, 'csv' or 'npy' (binary descriptor store).
+
+    feature_filter: dict, optional
+        Feature pre-filter settings passed on to preproc_data. If given, preproc_data also fits on the unfiltered data once and logs the time saved by the filter.
+
+    precisions: sequence of str
+        The float types to run every configuration with, e.g., ('float64', 'float32'), see load_data and preproc_data.
+
+    Returns
+    -------
+    dataframe
+        The measurements, see run_configuration.
+    """
+    results = []
+    for num_subjects in subject_counts:
+        for num_descriptors in descriptor_counts:
+            for precision in precisions:
+                logging.info("Running configuration with %d subjects x %d descriptors in %s." % (num_subjects, num_descriptors, precision))
+                records = run_configuration(data_dir, num_subjects, num_descriptors, num_workers=num_workers, time_budget=time_budget, stages=stages, file_format=file_format, feature_filter=feature_filter, dtype=precision)
+                for r in records:
+                    if "wall_time" in r:
+                        logging.info("  %-35s %s: wall time %9.2f sec, CPU time %9.2f sec, peak RSS %9.1f MB." % (r["stage"], r["status"], r["wall_time"], r["cpu_time"], r["peak_rss_mb"]))
+                results.extend(records)
+                pd.DataFrame(results).to_csv(output_file, index=False)
+    logging.info("Wrote benchmark results to file '%s'." % (output_file))
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Benchmark load_data, preproc_data and compare_classifiers on synthetic data of increasing size.")
+    parser.add_argument("--subjects", type=int, nargs="+", default=[1000, 10000], help="Subject counts.")
+    parser.add_argument("--descriptors", type=int, nargs="+", default=[1000, 5000], help="Descriptor counts.")
+    parser.add_argument("--data-dir", default="synthetic_data", help="Directory for the generated datasets.")
+    parser.add_argument("--output-file", default="bench_scaling.csv", help="Result CSV file.")
+    parser.add_argument("--num-workers", type=int, default=1, help="Worker processes for the classifier comparison.")
+    parser.add_argument("--time-budget", type=float, default=None, help="Budget in seconds per classifier.")
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES, help="Stages to run, e.g. only 'load_data preproc_data'.")
+    parser.add_argument("--format", default="csv", choices=["csv", "npy"], help="Descriptor file format.")
+    parser.add_argument("--feature-filter", action="store_true", help="Pre-filter the descriptors before preprocessing, see --max-nan-share and --max-correlation.")
+    parser.add_argument("--max-nan-share", type=float, default=0.5, help="Feature filter: drop columns with a larger NaN share.")
+    parser.add_argument("--max-correlation", type=float, default=None, help="Feature filter: drop columns more correlated with an earlier column.")
+    parser.add_argument("--precisions", nargs="+", default=["float64"], choices=["float64", "float32"], help="Float types to run every configuration with.")
+    args = parser.parse_args()
+    feature_filter = {"max_nan_share": args.max_nan_share, "max_correlation": args.max_correlation} if args.feature_filter else None
+    run_benchmark(args.subjects, args.descriptors, data_dir=args.data_dir, output_file=args.output_file, num_workers=args.num_workers, time_budget=args.time_budget, stages=args.stages, file_format=args.format, feature_filter=feature_filter, precisions=args.precisions)
@@ -1,12 +1,40 @@
 import os
+import sys
+import json
+import hashlib
 import numpy as np
-import brainload as bl
-import brainload.freesurferdata as fsd
 import brainload.braindescriptors as bd
 import brainload.nitools
 import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-def run_desc():
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))    # for the shared abide package
+from abide.data import save_descriptor_store, descriptor_store_index_file
+from instrumentation import instrument
+
+PARCELLATION_ATLASES = ['aparc', 'aparc.a2009s']
+SEGMENTATIONS = ['aseg']
+CUSTOM_MEASURE_ATLASES = ['aparc', 'aparc.a2009s']
+CUSTOM_MEASURES = ['area', 'area.pial', 'curv', 'curv.pial', 'jacobian_white', 'sulc', 'thickness', 'truncation', 'volume']
+HEMIS = ['lh', 'rh']
+
+
+@instrument()
+def run_desc(num_workers=1, shard_size=None, cache_dir="descriptor_cache"):
+    """
+    Compute the brain descriptors for all subjects and save them to CSV and to a binary descriptor store.
+
+    Parameters
+    ----------
+    num_workers: int
+        Number of worker processes. If 1 (the default), all subjects are handled in the current process, one after another. If larger, the subjects list is split into shards which are processed in parallel and merged afterwards.
+
+    shard_size: int, optional
+        Number of subjects per shard. Defaults to an even split of the subjects over the workers.
+
+    cache_dir: str or None
+        Directory for the per-subject descriptor cache. Only subjects which are new or whose FreeSurfer files changed since the last run are recomputed. Pass None to disable the cache.
+    """
     #subjects_list = ['subject1', 'subject2']
     #subjects_dir = os.path.join("tests", "test_data")
 
@@ -18,10 +46,7 @@ def run_desc():
     logging.basicConfig(level=logging.INFO)
 
     bdi = bd.BrainDescriptors(subjects_dir, subjects_list)
-    bdi.add_parcellation_stats(['aparc', 'aparc.a2009s'])
-    bdi.add_segmentation_stats(['aseg'])
-    #bdi.add_custom_measure_stats(['aparc'], ['area'])
-    bdi.add_custom_measure_stats(['aparc', 'aparc.a2009s'], ['area', 'area.pial', 'curv', 'curv.pial', 'jacobian_white', 'sulc', 'thickness', 'truncation', 'volume'])
+    bdi.descriptor_names, bdi.descriptor_values = compute_descriptors_cached(subjects_dir, subjects_list, cache_dir, num_workers=num_workers, shard_size=shard_size)
 
     #bdi.report_descriptors()
 
@@ -38,6 +63,227 @@ def run_desc():
     bdi.save(data_output_file, subjects_file=subjects_output_file)
     logging.info("Saved values of %d descriptors for each of the %d subjects to file '%s'. Subject order for data written to file '%s'." % (len(bdi.descriptor_names), len(bdi.subjects_list), data_output_file, subjects_output_file))
 
+    store_output_file = "braindescriptors.npy"
+    save_descriptor_store(store_output_file, bdi.descriptor_names, bdi.descriptor_values, bdi.subjects_list)
+    logging.info("Saved binary descriptor store to file '%s', index to file '%s'." % (store_output_file, descriptor_store_index_file(store_output_file)))
+
+
+def descriptor_blocks():
+    """
+    List the blocks of descriptors we compute, in output column order.
+
+    Each block is the unit of work for the cache: it is computed by a single BrainDescriptors call and reads a known set of files per subject.
+
+    Returns
+    -------
+    list of tuples (block_key, add_function, files_function)
+        The block_key is a unique str. The add_function takes a BrainDescriptors instance and adds the block's descriptors to it. The files_function takes a subject ID and returns the paths of the files the block reads for that subject, relative to the subject's directory.
+    """
+    blocks = []
+    for hemi in HEMIS:
+        for atlas in PARCELLATION_ATLASES:
+            blocks.append(("parcellation_%s_%s" % (hemi, atlas),
+                           lambda bdi, atlas=atlas, hemi=hemi: bdi._add_single_parcellation_stats(atlas, hemi),
+                           lambda subject_id, atlas=atlas, hemi=hemi: [os.path.join("stats", "%s.%s.stats" % (hemi, atlas))]))
+    for seg in SEGMENTATIONS:
+        blocks.append(("segmentation_%s" % (seg),
+                       lambda bdi, seg=seg: bdi.add_single_segmentation_stats(seg),
+                       lambda subject_id, seg=seg: [os.path.join("stats", "%s.stats" % (seg))]))
+    for hemi in HEMIS:
+        for atlas in CUSTOM_MEASURE_ATLASES:
+            for measure in CUSTOM_MEASURES:
+                blocks.append(("custom_%s_%s_%s" % (hemi, atlas, measure),
+                               lambda bdi, atlas=atlas, measure=measure, hemi=hemi: bdi._add_custom_measure_stats_single(atlas, measure, hemi),
+                               lambda subject_id, atlas=atlas, measure=measure, hemi=hemi: [os.path.join("label", "%s.%s.annot" % (hemi, atlas)), os.path.join("surf", "%s.%s" % (hemi, measure))]))
+    return blocks
+
+
+def split_into_shards(subjects_list, num_workers, shard_size=None):
+    """
+    Split a subjects list into consecutive shards, keeping the subject order.
+
+    Parameters
+    ----------
+    subjects_list: list of str
+        The subject IDs.
+
+    num_workers: int
+        Number of workers, used to determine the shard size if none is given.
+
+    shard_size: int, optional
+        Number of subjects per shard. Defaults to an even split over the workers.
+
+    Returns
+    -------
+    list of list of str
+        The shards. Concatenating them gives the original subjects list.
+    """
+    if shard_size is None:
+        shard_size = int(np.ceil(len(subjects_list) / float(max(num_workers, 1))))
+    shard_size = max(shard_size, 1)
+    return [subjects_list[i:i + shard_size] for i in range(0, len(subjects_list), shard_size)]
+
+
+def _compute_block_shard(subjects_dir, block_idx, shard_subjects):
+    """
+    Compute a single descriptor block for a shard of subjects. Runs in a worker process when parallel.
+    """
+    _, add_function, _ = descriptor_blocks()[block_idx]
+    bdi = bd.BrainDescriptors(subjects_dir, shard_subjects)
+    add_function(bdi)
+    return shard_subjects, bdi.descriptor_names, bdi.descriptor_values
+
+
+def file_fingerprint(subjects_dir, subject_id, relative_files):
+    """
+    Compute a fingerprint of the input files of a subject from their paths, mtimes and sizes.
+
+    Parameters
+    ----------
+    subjects_dir: str
+        Path to the FreeSurfer subjects directory.
+
+    subject_id: str
+        The subject ID.
+
+    relative_files: list of str
+        Paths of the files relative to the subject's directory. Missing files are part of the fingerprint, so a file that appears later invalidates the cache.
+
+    Returns
+    -------
+    str
+        Hex digest identifying the current state of the files.
+    """
+    file_states = []
+    for rel_file in relative_files:
+        abs_file = os.path.join(subjects_dir, subject_id, rel_file)
+        try:
+            st = os.stat(abs_file)
+            file_states.append([abs_file, st.st_mtime_ns, st.st_size])
+        except OSError:
+            file_states.append([abs_file, None, None])
+    return hashlib.sha1(json.dumps(file_states).encode("utf-8")).hexdigest()
+
+
+def _cache_file(cache_dir, block_key, subject_id):
+    return os.path.join(cache_dir, block_key, "%s.npz" % (subject_id))
+
+
+def _load_cached_block(cache_dir, block_key, subject_id, fingerprint):
+    """
+    Load the cached descriptors of a block for a subject. Returns None if there is no valid cache entry.
+    """
+    if cache_dir is None:
+        return None
+    cache_file = _cache_file(cache_dir, block_key, subject_id)
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with np.load(cache_file) as cached:
+            if str(cached["fingerprint"]) != fingerprint:
+                return None
+            return list(cached["names"]), cached["values"]
+    except Exception as e:
+        logging.warning("Ignoring unreadable cache file '%s': %s" % (cache_file, str(e)))
+        return None
+
+
+def _save_cached_block(cache_dir, block_key, subject_id, fingerprint, names, values):
+    """
+    Write the descriptors of a block for a subject to the cache. The file is written to a temporary name and moved into place, so an interrupted run never leaves a broken entry.
+    """
+    cache_file = _cache_file(cache_dir, block_key, subject_id)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = cache_file + ".tmp"
+    with open(tmp_file, "wb") as fh:
+        np.savez(fh, fingerprint=np.array(fingerprint), names=np.array(names), values=values)
+    os.replace(tmp_file, cache_file)
+
+
+@instrument()
+def compute_descriptors_cached(subjects_dir, subjects_list, cache_dir, num_workers=1, shard_size=None):
+    """
+    Compute all descriptors for the subjects, reusing cached results for unchanged subjects.
+
+    The work is split by block (see descriptor_blocks). For each block, only subjects without a valid cache entry are computed, in shards. With several workers, the shards of all blocks are run in a single process pool. Results are written to the cache as soon as a shard finishes, so an interrupted run resumes where it stopped.
+
+    Parameters
+    ----------
+    subjects_dir: str
+        Path to the FreeSurfer subjects directory.
+
+    subjects_list: list of str
+        The subject IDs. Defines the row order of the output.
+
+    cache_dir: str or None
+        The cache directory. If None, nothing is cached and all subjects are computed.
+
+    num_workers: int
+        Number of worker processes.
+
+    shard_size: int, optional
+        Number of subjects per shard, see split_into_shards.
+
+    Returns
+    -------
+    descriptor_names: list of str
+        The descriptor names, in the order produced by a single-process run.
+
+    descriptor_values: numpy 2D array
+        The descriptor values, one row per subject in subjects_list. Empty (and no names) if subjects_list is empty.
+    """
+    if len(subjects_list) == 0:
+        logging.info("No subjects, no descriptors to compute.")
+        return [], np.empty((0, 0))
+
+    blocks = descriptor_blocks()
+    fingerprints = [dict() for _ in blocks]
+    rows = [dict() for _ in blocks]
+    names = [None for _ in blocks]
+    work = []    # (block_idx, shard) for all stale subjects of all blocks
+    for block_idx, (block_key, _, files_function) in enumerate(blocks):
+        for subject_id in subjects_list:
+            fingerprints[block_idx][subject_id] = file_fingerprint(subjects_dir, subject_id, files_function(subject_id))
+            cached = _load_cached_block(cache_dir, block_key, subject_id, fingerprints[block_idx][subject_id])
+            if cached is not None:
+                names[block_idx], rows[block_idx][subject_id] = cached
+        stale_subjects = [s for s in subjects_list if s not in rows[block_idx]]
+        logging.info("Descriptor block '%s': %d subjects cached, %d to compute." % (block_key, len(rows[block_idx]), len(stale_subjects)))
+        work.extend([(block_idx, shard) for shard in split_into_shards(stale_subjects, num_workers, shard_size=shard_size)] if stale_subjects else [])
+
+    if num_workers <= 1:
+        for block_idx, shard in work:
+            names[block_idx] = _collect_block_results([_compute_block_shard(subjects_dir, block_idx, shard)], blocks[block_idx][0], names[block_idx], rows[block_idx], fingerprints[block_idx], cache_dir)
+    elif work:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:    # one pool for the shards of all blocks, so workers stay busy across block boundaries
+            futures = {executor.submit(_compute_block_shard, subjects_dir, block_idx, shard): block_idx for block_idx, shard in work}
+            for future in as_completed(futures):
+                block_idx = futures[future]
+                names[block_idx] = _collect_block_results([future.result()], blocks[block_idx][0], names[block_idx], rows[block_idx], fingerprints[block_idx], cache_dir)
+
+    block_names = []
+    block_values = []
+    for block_idx in range(len(blocks)):
+        block_names.extend(names[block_idx])
+        block_values.append(np.vstack([rows[block_idx][s] for s in subjects_list]))
+    return block_names, np.hstack(block_values)
+
+
+def _collect_block_results(shard_results, block_key, names, rows, fingerprints, cache_dir):
+    """
+    Store the rows of computed shards in the rows dict and the cache. Returns the block's descriptor names.
+    """
+    for shard_subjects, shard_names, shard_values in shard_results:
+        if names is None:
+            names = shard_names
+        elif list(shard_names) != list(names):
+            raise ValueError("Descriptor names for block '%s' computed for the shard starting with subject '%s' differ from those of other subjects, cannot merge." % (block_key, shard_subjects[0]))
+        for row_idx, subject_id in enumerate(shard_subjects):
+            rows[subject_id] = shard_values[row_idx, :]
+            if cache_dir is not None:
+                _save_cached_block(cache_dir, block_key, subject_id, fingerprints[subject_id], shard_names, rows[subject_id])
+    return names
+
 
 def plot_hist(data, title):
     import matplotlib.pyplot as plt
@@ -50,4 +296,5 @@ def plot_hist(data, title):
 
 
 if __name__ == "__main__":
-  run_desc()
+  num_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+  run_desc(num_workers=num_workers)
@@ -1,233 +1,291 @@
-
 import os
+import sys
 import numpy as np
 import pandas as pd
 import logging
-from sklearn.model_selection import train_test_split
-from sklearn.model_selection import cross_val_score
-from sklearn.preprocessing import LabelEncoder
-from sklearn.preprocessing import OneHotEncoder
-from sklearn.preprocessing import StandardScaler
-from sklearn.neural_network import MLPClassifier
-from sklearn.neighbors import KNeighborsClassifier
-from sklearn.svm import SVC
-from sklearn.gaussian_process import GaussianProcessClassifier
-from sklearn.gaussian_process.kernels import RBF
-from sklearn.tree import DecisionTreeClassifier
-from sklearn.ensemble import RandomForestClassifier, AdaBoostClassifier
-from sklearn.naive_bayes import GaussianNB
-from sklearn.discriminant_analysis import QuadraticDiscriminantAnalysis
-from sklearn.compose import ColumnTransformer
-from sklearn.pipeline import Pipeline
-from sklearn.impute import SimpleImputer
-from sklearn.preprocessing import MinMaxScaler
-from sklearn.decomposition import PCA
+import argparse
+import time
+import multiprocessing
+import multiprocessing.connection
+from sklearn.model_selection import StratifiedKFold
+from sklearn.base import clone
 from sklearn.metrics import accuracy_score
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))    # for the shared abide package
+from abide.data import load_data, check_data
+from abide.preprocessing import preproc_data, save_model
+from abide.registry import get_classifiers, make_classifier
+from instrumentation import instrument
+
+
+@instrument()
+def predict_abide_brain_age(num_workers=1, time_budget=None, model_file=None, model_classifier="RBF SVM", dtype=None):
+    """
+    Load the data, preprocess it and compare the classifiers.
+
+    Parameters
+    ----------
+    num_workers: int
+        Number of worker processes for the classifier comparison, see compare_classifiers.
+
+    time_budget: float, optional
+        Wall-clock budget in seconds per classifier, see compare_classifiers.
+
+    model_file: str, optional
+        If given, the classifier named by model_classifier is saved together with the fitted preprocessor and PCA to this file, see save_model. The saved model can be served with serve_abide_model.py. If the classifier is part of the comparison, its fit on the training set from the test set evaluation is saved, otherwise it is fitted once more.
 
-def predict_abide_brain_age():
+    model_classifier: str
+        Name of the classifier to save, any registered name, including optional ones like 'Persistent KNN'. A persistent kNN index is written next to the model file (directory '<model file without extension>_knn_index'), so the model does not depend on the index cache.
+
+    dtype: str, optional
+        The float type of the data in all stages, e.g., 'float32' to halve the memory, see load_data and preproc_data. Defaults to float64.
+    """
 
     logging.basicConfig(level=logging.DEBUG)
 
     ################ Specify data files and load data ####################
 
-    descriptors_file = "braindescriptors.csv"
+    descriptors_file = "braindescriptors.npy"    # binary descriptor store written by gen_braindescriptors.py
+    if not os.path.isfile(descriptors_file):
+        descriptors_file = "braindescriptors.csv"
     subjects_file = "subjects.txt"
     metadata_file = os.path.join("tools", "Phenotypic_V1_0b_preprocessed1.csv")
 
     logging.info("Loading data.")
-    descriptors, metadata = load_data(descriptors_file, subjects_file, metadata_file)
+    descriptors, metadata = load_data(descriptors_file, subjects_file, metadata_file, dtype=dtype)
 
     labels = metadata["DX_GROUP"]
-    X_train, X_test, y_train, y_test = preproc_data(descriptors, metadata, labels)
+    X_train, X_test, y_train, y_test, preprocessor, pca = preproc_data(descriptors, metadata, labels, return_transformers=True, dtype=dtype)
     data = (X_train, X_test, y_train, y_test)
     check_data(data)
-    compare_classifiers(data)
-
-
-def preproc_data(descriptors, metadata, labels):
-    logging.info("Scaling data, creating training and test sets.")
-
-    if descriptors.shape[0] != metadata.shape[0]:
-        logging.error("Mismatch in size of descriptors and metadata: %d versus %d, but both should be for the same number of observations/subjects." % (descriptors.shape[0], metadata.shape[0]))
-
-    if descriptors.shape[0] != labels.shape[0]:
-        logging.error("Mismatch in size of descriptors and labels: %d versus %d, but both should be for the same number of observations/subjects." % (descriptors.shape[0], labels.shape[0]))
-
-    numeric_features = list(descriptors.columns) # set to list of all column names from current dataframe
-
-    numeric_transformer = Pipeline(steps=[
-    ('imputer', SimpleImputer(strategy='median')),
-    ('scaler', MinMaxScaler())])
-
-    categorical_transformer = Pipeline(steps=[
-    ('imputer', SimpleImputer(strategy='most_frequent')),
-    ('onehot', OneHotEncoder())])
-
-    ## Add covariates to descriptors. Some are numerical (which is fine), but some are categorical and need special encoding.
-
-    ## Add numerical covariates to descriptors:
-    numerical_covariates = ["AGE_AT_SCAN"]
-    for cov in numerical_covariates:
-        descriptors[cov] = metadata[cov]
-
-    ## Add categorial covariates
-    categorical_covariates = ["SEX", "SITE_ID"]
-    for cov in categorical_covariates:
-        descriptors[cov] = metadata[cov]
-    categorical_features = categorical_covariates   # The only categorial features in the dataframe are the covariates we just added.
-
-    features_to_be_removed = [] # No need to drop stuff so far. (Most important: the label is not part of the descriptors, as it comes from the metadata. So no need to remove the label.)
-
-    preprocessor = ColumnTransformer(
-    remainder = 'passthrough',
-    transformers=[
-        ('numeric', numeric_transformer, numeric_features),
-        ('categorical', categorical_transformer, categorical_features),
-        ('remove', 'drop', features_to_be_removed)
-    ])
-
-    # prepare data for classification task:
-    X_train, X_test, y_train, y_test = train_test_split(descriptors, labels, test_size=.4, random_state=42)
-
-    logging.debug("Received training data: descriptor shape is %s, and %d labels for it." % (str(X_train.shape), y_train.shape[0]))
-    logging.debug("Received test data: descriptor shape is %s, and %d labels for it." % (str(X_test.shape), y_test.shape[0]))
-
-    X_train = preprocessor.fit_transform(X_train)
-    X_test = preprocessor.fit_transform(X_test)
+    if model_file is None:
+        compare_classifiers(data, num_workers=num_workers, time_budget=time_budget)
+    else:
+        _, clf = compare_classifiers(data, num_workers=num_workers, time_budget=time_budget, return_fitted=model_classifier)
+        if clf is None:    # not part of the comparison (e.g., optional classifiers), or it did not finish there
+            clf = make_classifier(model_classifier)
+            if "index_dir" in clf.get_params():
+                clf.set_params(index_dir=os.path.splitext(os.path.abspath(model_file))[0] + "_knn_index")
+            logging.info("Fitting classifier '%s' to training set for saving." % (model_classifier))
+            clf.fit(X_train, np.asarray(y_train))
+        save_model(model_file, preprocessor, pca, clf, name=model_classifier)
+
+
+@instrument()
+def compare_classifiers(data, num_workers=1, time_budget=None, kfold=3, return_fitted=None):
+    """
+    Quick comparison of different classifiers with hard-coded parameters (no parameter optimization). This is only useful to get a very rough first impression of the performance of the different classifiers.
 
-    logging.debug("After pre-proc: Training data shape is %s, with %d labels for it." % (str(X_train.shape), y_train.shape[0]))
-    logging.debug("After pre-proc: Test data shape is %s, with %d labels for it." % (str(X_test.shape), y_test.shape[0]))
+    Each classifier is fitted kfold + 1 times: once per CV fold and once on the full training set for the test set evaluation. Each fitted classifier predicts its validation or test set once, in a single batch, and the accuracy is computed from these predictions. The CV folds are computed once and shared by all classifiers.
 
-    logging.info("Running dimensionality reduction (PCA).")
-    pca = PCA()
-    X_train = pca.fit_transform(X_train)
-    X_test = pca.transform(X_test)
+    Parameters
+    ----------
+    data: tuple
+        The tuple (X_train, X_test, y_train, y_test), as returned by preproc_data.
 
-    for pc in range(10):
-        logging.info("  PCA principal component #%d explained variance: %f" % (pc, pca.explained_variance_ratio_[pc]))
+    num_workers: int
+        Number of worker processes. The test set evaluation and each cross validation fold of each classifier are separate tasks, which run concurrently if this is larger than 1.
 
-    logging.debug("After PCA: Training data shape is %s, with %d labels for it." % (str(X_train.shape), y_train.shape[0]))
-    logging.debug("After PCA: Test data shape is %s, with %d labels for it." % (str(X_test.shape), y_test.shape[0]))
+    time_budget: float, optional
+        Wall-clock budget in seconds per classifier, counted from the start of its first task. Classifiers which exceed it are cancelled and reported with status 'timeout'. Defaults to no limit.
 
-    return X_train, X_test, y_train, y_test
+    kfold: int
+        Number of cross validation folds.
 
+    return_fitted: str, optional
+        Name of a classifier whose fit on the full training set (from the test set evaluation) is returned as well, e.g., to save it without fitting it again.
 
+    Returns
+    -------
+    results: dataframe
+        One row per classifier with columns 'classifier', 'status' ('ok', 'timeout' or 'error'), 'cv_scores', 'cv_mean', 'cv_std', 'test_score', 'predictions' (for the first 5 test observations), 'fit_time' (seconds to fit on the full training set), 'cv_time' (total seconds to fit and score all CV folds), 'predict_time' (seconds to predict the test set) and 'wall_time' (seconds from start of the first to end of the last task).
 
-def check_data(data):
-    """
-    Check whether the number of descriptors in the training and test data is equal. If not, the one-hot-encoding of categorial features may have caused issues (i.e., some values occur only in the training data or only in the test data).
+    fitted_classifier: sklearn estimator or None
+        The fitted classifier named by return_fitted, or None if it is not part of the comparison or did not finish. Only returned if return_fitted is given.
     """
     X_train, X_test, y_train, y_test = data
-    num_features_train = X_train.shape[1]
-    num_features_test = X_test.shape[1]
-    if num_features_train != num_features_test:
-        logging.error("Mismatch between descriptor count in training and test data: %d versus %d. There may be categorical columns which lack column values in one of the two sets." % (num_features_train, num_features_test))
+    y_train = np.asarray(y_train)
+    y_test = np.asarray(y_test)
 
+    classifier_names, classifiers = get_classifiers()
+    logging.info("Preparing %d different classifiers." % (len(classifier_names)))
 
-def compare_classifiers(data):
+    folds = list(StratifiedKFold(n_splits=kfold).split(X_train, y_train))    # same folds as cross_val_score(cv=kfold), computed once and shared by all classifiers
+    tasks = []
+    for clf_idx in range(len(classifiers)):
+        tasks.append((clf_idx, "test"))
+        for fold_idx in range(kfold):
+            tasks.append((clf_idx, fold_idx))
+
+    def run_task(task):
+        clf_idx, what = task
+        clf = clone(classifiers[clf_idx])
+        if what == "test":
+            result = evaluate_on_test_set(clf, X_train, y_train, X_test, y_test)
+            return result + (clf,) if classifier_names[clf_idx] == return_fitted else result
+        train_idx, val_idx = folds[what]
+        return _evaluate_on_fold(clf, X_train, y_train, train_idx, val_idx)
+
+    logging.info("Running %d tasks (test set and %d CV folds per classifier) using %d worker(s)." % (len(tasks), kfold, num_workers))
+    if num_workers <= 1 and time_budget is None:
+        task_results, task_times, timed_out = _run_tasks_serial(tasks, run_task)
+    else:
+        task_results, task_times, timed_out = _run_tasks_parallel(tasks, run_task, num_workers, time_budget)
+
+    rows = []
+    for clf_idx, name in enumerate(classifier_names):
+        row = {"classifier": name, "status": "ok", "cv_scores": None, "cv_mean": np.nan, "cv_std": np.nan, "test_score": np.nan, "predictions": None, "fit_time": np.nan, "cv_time": np.nan, "predict_time": np.nan, "wall_time": np.nan}
+        clf_tasks = [t for t in tasks if t[0] == clf_idx]
+        clf_times = [task_times[t] for t in clf_tasks if t in task_times]
+        if clf_times:
+            row["wall_time"] = max(end for _, end in clf_times) - min(start for start, _ in clf_times)
+        if clf_idx in timed_out:
+            row["status"] = "timeout"
+        elif any(isinstance(task_results.get(t), Exception) or t not in task_results for t in clf_tasks):
+            row["status"] = "error"
+        else:
+            cv_scores = [task_results[(clf_idx, fold_idx)][0] for fold_idx in range(kfold)]
+            row["cv_scores"] = cv_scores
+            row["cv_mean"] = np.mean(cv_scores)
+            row["cv_std"] = np.std(cv_scores)
+            row["cv_time"] = sum([task_results[(clf_idx, fold_idx)][1] for fold_idx in range(kfold)])
+            row["test_score"], row["predictions"], row["fit_time"], row["predict_time"] = task_results[(clf_idx, "test")][:4]
+        rows.append(row)
+    results = pd.DataFrame(rows)
+
+    logging.info("Classifier comparison done (true labels of the first 5 test observations: %s):\n%s" % (" ".join([str(v) for v in y_test[:5]]), results.to_string()))
+    if return_fitted is not None:
+        fitted = [task_results[(clf_idx, "test")][4] for clf_idx, name in enumerate(classifier_names) if name == return_fitted and results["status"][clf_idx] == "ok"]
+        return results, fitted[0] if fitted else None
+    return results
+
+
+def evaluate_on_test_set(clf, X_train, y_train, X_test, y_test, return_predictions=False):
     """
-    Quick comparison of different classifiers with hard-coded parameters (no parameter optimization). This is only useful to get a very rough first impression of the performance of the different classifiers.
+    Fit a classifier on the full training set, then predict the whole test set in a single batch. Returns the test accuracy, the predictions for the first 5 test observations, the fit time and the predict time, and if return_predictions is True, all test predictions as a fifth value.
     """
-    X_train, X_test, y_train, y_test = data
-
-    # Test a number of classifiers
-    classifier_names = ["KNN", "Linear SVM", "RBF SVM", "Gaussian Process",
-         "Decision Tree", "Random Forest", "Neural Net", "AdaBoost",
-         "Naive Bayes", "QDA"]
-
-    logging.info("Preparing %d different classifiers." % (len(classifier_names)))
-
-    classifiers = [
-    KNeighborsClassifier(3),
-    SVC(kernel="linear", C=0.025),
-    SVC(gamma=2, C=1),
-    GaussianProcessClassifier(1.0 * RBF(1.0)),
-    DecisionTreeClassifier(max_depth=5),
-    RandomForestClassifier(max_depth=5, n_estimators=10, max_features=1),
-    MLPClassifier(alpha=1, max_iter=2000),
-    AdaBoostClassifier(),
-    GaussianNB(),
-    QuadraticDiscriminantAnalysis()]
-
-    for name, clf in zip(classifier_names, classifiers):
-        logging.info("Fitting classifier '%s' to training set." % (name))
-        clf.fit(X_train, y_train)
-
-        kfold = 3
-        logging.info("  Performing %d fold cross validation" % (kfold))
-        cv_scores = cross_val_score(clf, X_train, y_train, cv=kfold, scoring="accuracy")
-        logging.info("  Cross validation scores:")
-        for k in range(kfold):
-            logging.info("    %f" % (cv_scores[k]))
-
-        logging.info("  Evaluating classifier '%s' on test set." % (name))
-        score = clf.score(X_test, y_test)
-        logging.info("  Classifier %s achieved score: %f" % (name, score))
-        logging.info("  Predicting using %s for some observations from test set (true labels are: %d %d %d %d %d):" % (name, y_test.iloc[0], y_test.iloc[1], y_test.iloc[2], y_test.iloc[3], y_test.iloc[4]))
-        pred = clf.predict([X_test[0,:], X_test[1,:], X_test[2,:], X_test[3,:], X_test[4,:]])
-        logging.info("    %d %d %d %d %d" % (pred[0], pred[1], pred[2], pred[3], pred[4]))
-
-
-
-    logging.info("Classifier comparison done.")
-
-
-
-def load_data(descriptors_file, subjects_file, metadata_file):
+    start = time.perf_counter()
+    clf.fit(X_train, y_train)
+    fit_time = time.perf_counter() - start
+    start = time.perf_counter()
+    pred = clf.predict(X_test)
+    predict_time = time.perf_counter() - start
+    if return_predictions:
+        return accuracy_score(y_test, pred), list(pred[:5]), fit_time, predict_time, pred
+    return accuracy_score(y_test, pred), list(pred[:5]), fit_time, predict_time
+
+
+def _evaluate_on_fold(clf, X_train, y_train, train_idx, val_idx):
     """
-    Load data and merge it.
-
-    Parameters
-    ----------
-    descriptors_file: str
-        Path to a file containing brain descriptor values in CSV format. Each line should contain data on a single subject, and can have an arbitrary number of columns (descriptor values). All lines must have identical length, though. Must have a header line.
-
-    subject_file: str
-        Path to subjects text file, each line contains a single subject ID, no header.
-
-    metadata_file: str
-        Path to metadata CSV file from ABIDE data. The required file is named 'Phenotypic_V1_0b_preprocessed1.csv' when downloaded from ABIDE.
-
-    Returns
-    -------
-    descriptors: dataframe
-        Dataframe containing descriptor data, one subject per row.
-
-    metadata: dataframe
-        Dataframe containing metadata, one subject per row.
+    Fit a classifier on the training part of a CV fold and return its accuracy on the validation part and the time this took.
     """
-    logging.info("Reading brain descriptor data from file '%s', subject order from file '%s'." % (descriptors_file, subjects_file))
-
-    descriptors = pd.read_csv(descriptors_file, header=0)
-    logging.debug("Descriptor data shape: %s" % (str(descriptors.shape)))
-    subjects = pd.read_csv(subjects_file, header=None, names=["subject_id"])
-    logging.debug("Subject data shape: %s" % (str(subjects.shape)))
+    start = time.perf_counter()
+    clf.fit(X_train[train_idx], y_train[train_idx])
+    score = accuracy_score(y_train[val_idx], clf.predict(X_train[val_idx]))
+    return score, time.perf_counter() - start
 
-    #logging.debug("Descriptors:")
-    #logging.debug(descriptors.head())
 
-    #descriptors["subject_id"] = subjects["subject_id"]    # add subject IDs to descriptors dataframe
-    logging.debug("Merged descriptor data shape (with subject ID field): %s" % (str(descriptors.shape)))
-
-    logging.debug("Reading ABIDE metadata on subjects from file '%s'." % (metadata_file))
-    metadata = pd.read_csv(metadata_file, header=0)
-    logging.debug("Full metadata shape: %s" % (str(metadata.shape)))
-
-
-    logging.debug("Descriptors:")
-    logging.debug(descriptors.head())
-
-    # Drop all columns (descriptors) for which ALL subjects have NaN values. These are completely useless.
-    descriptors.dropna(axis='columns', how='all', inplace=True)
+def _run_tasks_serial(tasks, run_task):
+    """
+    Run tasks one after another in the current process.
+    """
+    task_results = dict()
+    task_times = dict()
+    for task in tasks:
+        start = time.time()
+        try:
+            task_results[task] = run_task(task)
+        except Exception as e:
+            logging.error("Task %s failed: %s" % (str(task), str(e)))
+            task_results[task] = e
+        task_times[task] = (start, time.time())
+    return task_results, task_times, set()
+
+
+def _task_process_main(task, run_task, conn):
+    try:
+        result = run_task(task)
+    except Exception as e:
+        result = e
+    try:
+        conn.send(result)
+    except Exception as e:    # e.g., the result is not picklable
+        conn.send(RuntimeError("Could not send the result of task %s to the parent process: %s" % (str(task), str(e))))
+    conn.close()
+
+
+def _run_tasks_parallel(tasks, run_task, num_workers, time_budget):
+    """
+    Run tasks in child processes, at most num_workers at a time.
 
-    # Filter metadata: keep only the data on our subjects
-    filtered_metadata = pd.merge(subjects, metadata, how='left', left_on="subject_id", right_on="FILE_ID")
-    logging.debug("Filtered metadata shape after removing subjects which we have no descriptor data on: %s" % (str(filtered_metadata.shape)))
-    return descriptors, filtered_metadata
+    Tasks are tuples whose first element identifies the classifier. All running tasks of a classifier are terminated and its pending tasks are dropped once the classifier exceeds its time budget. Uses the 'fork' start method, so the data referenced by run_task is shared with the children instead of being pickled. Each child sends its result through its own pipe, so terminating a child cannot corrupt the results of others, and a child which exits without sending a result (whatever its exit code) is reported as failed.
+    """
+    ctx = multiprocessing.get_context("fork")
+    pending = list(tasks)
+    running = dict()    # task -> (process, receiving end of its pipe)
+    task_results = dict()
+    task_times = dict()
+    clf_start = dict()
+    timed_out = set()
+
+    def finish(task, result):
+        proc, conn = running.pop(task)
+        conn.close()
+        proc.join()
+        task_results[task] = result
+        task_times[task] = (task_times[task][0], time.time())
+        if isinstance(result, Exception):
+            logging.error("Task %s failed: %s" % (str(task), str(result)))
+
+    while pending or running:
+        while pending and len(running) < num_workers:
+            task = pending.pop(0)
+            parent_conn, child_conn = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=_task_process_main, args=(task, run_task, child_conn))
+            proc.start()
+            child_conn.close()    # only the child writes, so the parent sees EOF once the child is gone
+            running[task] = (proc, parent_conn)
+            task_times[task] = (time.time(), None)
+            clf_start.setdefault(task[0], time.time())
+
+        ready = multiprocessing.connection.wait([conn for _, conn in running.values()], timeout=0.1)
+        for task, (proc, conn) in list(running.items()):
+            if conn in ready or not proc.is_alive():
+                if conn.poll():
+                    try:
+                        finish(task, conn.recv())
+                        continue
+                    except (EOFError, OSError):
+                        pass
+                elif proc.is_alive():
+                    continue
+                proc.join()
+                finish(task, RuntimeError("Worker process exited with code %s without a result." % (str(proc.exitcode))))
+
+        now = time.time()
+        if time_budget is not None:
+            for clf_idx, start in clf_start.items():
+                if clf_idx not in timed_out and now - start > time_budget and (any(t[0] == clf_idx for t in running) or any(t[0] == clf_idx for t in pending)):
+                    logging.warning("Classifier #%d exceeded its time budget of %.1f seconds, cancelling it." % (clf_idx, time_budget))
+                    timed_out.add(clf_idx)
+                    for task in [t for t in running if t[0] == clf_idx]:
+                        proc, conn = running.pop(task)
+                        proc.terminate()
+                        proc.join()
+                        conn.close()
+                        task_times[task] = (task_times[task][0], now)
+                    pending = [t for t in pending if t[0] != clf_idx]
+    return task_results, task_times, timed_out
 
 
 
 
 if __name__ == "__main__":
-  predict_abide_brain_age()
+    parser = argparse.ArgumentParser(description="Compare classifiers on the ABIDE data, and optionally save one of them for serve_abide_model.py.")
+    parser.add_argument("--num-workers", type=int, default=1, help="Worker processes for the classifier comparison.")
+    parser.add_argument("--time-budget", type=float, default=None, help="Budget in seconds per classifier.")
+    parser.add_argument("--model-file", default=None, help="Fit the classifier given by --model-classifier on the training set and save the prediction pipeline to this file.")
+    parser.add_argument("--model-classifier", default="RBF SVM", help="Name of the classifier to save.")
+    parser.add_argument("--dtype", default=None, choices=["float32", "float64"], help="Float type of the data in all stages, defaults to float64.")
+    args = parser.parse_args()
+    predict_abide_brain_age(num_workers=args.num_workers, time_budget=args.time_budget, model_file=args.model_file, model_classifier=args.model_classifier, dtype=args.dtype)
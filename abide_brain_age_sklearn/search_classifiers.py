@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# Hyperparameter search for the classifiers compared in predict_abide_brainage.py, using successive halving.
+#
+# Usage: python search_classifiers.py
+
+import os
+import sys
+import time
+import logging
+import numpy as np
+import pandas as pd
+from scipy.stats import loguniform, randint, uniform
+from sklearn.experimental import enable_halving_search_cv    # noqa: F401, enables HalvingRandomSearchCV
+from sklearn.model_selection import HalvingRandomSearchCV
+from sklearn.model_selection import StratifiedKFold
+from sklearn.gaussian_process.kernels import RBF
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))    # for the shared abide package
+from abide.data import load_data, check_data
+from abide.preprocessing import preproc_data
+from abide.registry import classifier_names as registered_classifier_names, make_classifier
+
+
+def get_search_spaces():
+    """
+    Get the hyperparameter search spaces for the classifiers registered in abide.registry.
+
+    Returns
+    -------
+    dict
+        Maps each classifier name to a dict of parameter distributions or lists, as accepted by HalvingRandomSearchCV.
+    """
+    return {
+        "KNN": {"n_neighbors": randint(1, 30), "weights": ["uniform", "distance"]},
+        "Persistent KNN": {"n_neighbors": randint(1, 30), "leaf_size": [20, 40, 80], "algorithm": ["kd_tree", "ball_tree"]},    # uniform weights only
+        "Linear SVM": {"C": loguniform(1e-4, 1e2)},
+        "RBF SVM": {"C": loguniform(1e-2, 1e3), "gamma": loguniform(1e-4, 1e1)},
+        "Gaussian Process": {"kernel": [1.0 * RBF(length_scale) for length_scale in [0.1, 1.0, 10.0, 100.0]]},
+        "Nystroem SVM": {"features__gamma": loguniform(1e-4, 1e1), "svm__C": loguniform(1e-2, 1e3), "features__n_components": [100, 250, 500, 1000]},
+        "Random Fourier SVM": {"features__gamma": loguniform(1e-4, 1e1), "svm__alpha": loguniform(1e-6, 1e-1), "features__n_components": [500, 1000, 2000, 4000]},
+        "Sparse Gaussian Process": {"length_scale": loguniform(1e-1, 1e2), "amplitude": loguniform(1e-2, 1e2), "n_inducing": [100, 250, 500, 1000]},
+        "Decision Tree": {"max_depth": [2, 3, 5, 8, 12, 20, None], "min_samples_leaf": randint(1, 20)},
+        "Random Forest": {"n_estimators": randint(10, 300), "max_depth": [3, 5, 10, None], "max_features": ["sqrt", "log2", 1, 0.5]},
+        "Neural Net": {"alpha": loguniform(1e-4, 1e1), "hidden_layer_sizes": [(50,), (100,), (100, 50)]},
+        "AdaBoost": {"n_estimators": randint(25, 300), "learning_rate": loguniform(1e-2, 2.0)},
+        "Naive Bayes": {"var_smoothing": loguniform(1e-12, 1e-3)},
+        "QDA": {"reg_param": uniform(0.0, 1.0)},
+    }
+
+
+def search_classifiers(data, classifier_names=None, n_candidates=64, factor=3, kfold=3, n_jobs=-1, random_state=42):
+    """
+    Run a successive halving hyperparameter search for each classifier.
+
+    Each search starts with n_candidates random configurations fitted on a small part of the training data. After each round, only the best 1/factor of the configurations survive and get factor times more training samples, so poor configurations are stopped early. The CV folds are computed once on the preprocessed training data and shared by all searches. The fits of each round run in parallel.
+
+    Parameters
+    ----------
+    data: tuple
+        The tuple (X_train, X_test, y_train, y_test), as returned by preproc_data. Preprocessing results are cached by preproc_data, so repeated searches do not refit the transformers.
+
+    classifier_names: list of str, optional
+        Names of the classifiers to tune, see get_search_spaces. Defaults to all registered classifiers except the optional ones, see register_classifier. Classifiers without a search space are skipped with a warning.
+
+    n_candidates: int
+        Number of random configurations in the first round of each search.
+
+    factor: int
+        Halving factor, see HalvingRandomSearchCV.
+
+    kfold: int
+        Number of CV folds.
+
+    n_jobs: int
+        Number of parallel jobs, -1 means all cores.
+
+    random_state: int
+        Seed for sampling the configurations.
+
+    Returns
+    -------
+    dataframe
+        The leaderboard, one row per configuration which reached the final round of its search, sorted by CV score. Columns are 'classifier', 'params', 'cv_mean', 'cv_std', 'n_resources' (training samples in the final round), 'compute_time' (total fit and score seconds used by this configuration over all rounds and folds), and 'test_score' (only for the best configuration of each classifier).
+    """
+    X_train, X_test, y_train, y_test = data
+    y_train = np.asarray(y_train)
+    y_test = np.asarray(y_test)
+    search_spaces = get_search_spaces()
+    if classifier_names is None:
+        classifier_names = registered_classifier_names()
+
+    folds = list(StratifiedKFold(n_splits=kfold).split(X_train, y_train))
+    leaderboard = []
+    for name in classifier_names:
+        if name not in search_spaces:
+            logging.warning("No search space for classifier '%s', skipping it." % (name))
+            continue
+        clf = make_classifier(name)
+        search = HalvingRandomSearchCV(clf, search_spaces[name], n_candidates=n_candidates, factor=factor, resource="n_samples", min_resources="smallest", cv=folds, scoring="accuracy", n_jobs=n_jobs, random_state=random_state, refit=True, error_score=np.nan)
+        logging.info("Searching hyperparameters for classifier '%s'." % (name))
+        start = time.time()
+        try:
+            search.fit(X_train, y_train)
+        except ValueError as e:
+            logging.error("  Search for '%s' failed, all configurations failed to fit: %s" % (name, str(e)))
+            continue
+        logging.info("  Search for '%s' took %.1f seconds over %d rounds, best CV score %f with %s." % (name, time.time() - start, search.n_iterations_, search.best_score_, str(search.best_params_)))
+
+        cv_results = pd.DataFrame(search.cv_results_)
+        cv_results["params_key"] = cv_results["params"].apply(repr)
+        cv_results["compute_time"] = (cv_results["mean_fit_time"] + cv_results["mean_score_time"]) * kfold
+        compute_time = cv_results.groupby("params_key")["compute_time"].sum()
+        final_round = cv_results[cv_results["iter"] == cv_results["iter"].max()].drop_duplicates("params_key")    # discrete spaces may sample a configuration twice
+        best_key = repr(search.best_params_)
+        test_score = search.score(X_test, y_test)
+        for _, row in final_round.iterrows():
+            leaderboard.append({"classifier": name, "params": row["params"], "cv_mean": row["mean_test_score"], "cv_std": row["std_test_score"], "n_resources": row["n_resources"], "compute_time": compute_time[row["params_key"]], "test_score": test_score if row["params_key"] == best_key else np.nan})
+
+    leaderboard = pd.DataFrame(leaderboard).sort_values("cv_mean", ascending=False).reset_index(drop=True)
+    logging.info("Hyperparameter search done, leaderboard:\n%s" % (leaderboard.to_string()))
+    return leaderboard
+
+
+def run_search():
+    logging.basicConfig(level=logging.INFO)
+
+    descriptors_file = "braindescriptors.npy"    # binary descriptor store written by gen_braindescriptors.py
+    if not os.path.isfile(descriptors_file):
+        descriptors_file = "braindescriptors.csv"
+    subjects_file = "subjects.txt"
+    metadata_file = os.path.join("tools", "Phenotypic_V1_0b_preprocessed1.csv")
+
+    descriptors, metadata = load_data(descriptors_file, subjects_file, metadata_file)
+    labels = metadata["DX_GROUP"]
+    data = preproc_data(descriptors, metadata, labels)
+    check_data(data)
+    leaderboard = search_classifiers(data)
+    leaderboard_file = "search_leaderboard.csv"
+    leaderboard.to_csv(leaderboard_file, index=False)
+    logging.info("Leaderboard written to file '%s'." % (leaderboard_file))
+
+
+if __name__ == "__main__":
+    run_search()
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+#
+# Local prediction server for a saved ABIDE prediction pipeline (see save_model in abide/preprocessing.py).
+#
+# Usage: python serve_abide_model.py model.joblib [--port 8089 | --unix-socket /tmp/abide.sock]
+#
+# Send POST requests to /predict with a JSON body, either {"rows": [{"descriptor_name": value, ...}, ...]} with one
+# object per subject (including the covariates AGE_AT_SCAN, SEX and SITE_ID), or {"subject_ids": ["Caltech_0051456", ...]}
+# if the server was started with --descriptors and --metadata. GET /stats reports throughput and latency percentiles.
+
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+import collections
+import socketserver
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+import joblib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))    # for the shared abide package
+from abide.data import load_data, add_covariates
+from abide.preprocessing import transform_data
+from abide.registry import get_backend
+
+
+class PredictionModel():
+    """
+    A saved prediction pipeline, loaded once.
+
+    Parameters
+    ----------
+    model_file: str
+        Path to a file written by abide.preprocessing.save_model.
+    """
+    def __init__(self, model_file):
+        bundle = joblib.load(model_file)
+        self.preprocessor = bundle["preprocessor"]
+        self.pca = bundle["pca"]
+        self.columns = bundle["columns"]
+        self.name = bundle["name"]
+        if "keras_model_file" in bundle:
+            self.keras_model = get_backend("keras").models.load_model(bundle["keras_model_file"])    # only imports Keras if we serve a Keras model
+            self.classifier = None
+            self.classes = bundle.get("classes")    # older bundles lack it, their networks were trained on the labels as class indices
+        else:
+            self.keras_model = None
+            self.classifier = bundle["classifier"]
+        logging.info("Loaded prediction pipeline '%s' from file '%s', expecting %d input columns." % (self.name, model_file, len(self.columns)))
+
+    def predict(self, rows):
+        """
+        Predict the labels for a batch of subjects.
+
+        Parameters
+        ----------
+        rows: dataframe
+            One row per subject. Missing columns are treated as missing values, additional ones are ignored.
+
+        Returns
+        -------
+        numpy 1D array
+            The predicted labels.
+        """
+        X = transform_data(self.preprocessor, self.pca, rows.reindex(columns=self.columns))
+        if self.keras_model is not None:
+            indices = np.argmax(self.keras_model.predict(X, batch_size=max(X.shape[0], 1), verbose=0), axis=1)
+            return indices if self.classes is None else self.classes[indices]    # same label semantics as sklearn models
+        return self.classifier.predict(X)
+
+
+class MicroBatcher():
+    """
+    Group concurrent prediction requests into micro-batches, which are predicted in a single call by a worker thread.
+
+    Parameters
+    ----------
+    model: PredictionModel
+        The model used for the predictions.
+
+    max_batch_size: int
+        Maximal number of rows per batch. A batch is predicted as soon as it reaches this size.
+
+    max_wait: float
+        Maximal time in seconds that the first request of a batch waits for more requests to arrive.
+    """
+    def __init__(self, model, max_batch_size=256, max_wait=0.005):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.latencies = collections.deque(maxlen=100000)
+        self.num_requests = 0
+        self.num_rows = 0
+        self.num_batches = 0
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def predict(self, rows):
+        """
+        Predict the labels for some rows, blocking until the batch containing them is done.
+        """
+        request = {"rows": rows, "done": threading.Event(), "result": None, "submitted": time.perf_counter()}
+        self.requests.put(request)
+        request["done"].wait()
+        if isinstance(request["result"], Exception):
+            raise request["result"]
+        return request["result"]
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            batch_rows = batch[0]["rows"].shape[0]
+            deadline = time.perf_counter() + self.max_wait
+            while batch_rows < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                batch_rows += request["rows"].shape[0]
+            self._predict_batch(batch)
+
+    def _predict_batch(self, batch):
+        try:
+            predictions = self.model.predict(pd.concat([request["rows"] for request in batch], ignore_index=True))
+            offset = 0
+            for request in batch:
+                num_rows = request["rows"].shape[0]
+                request["result"] = predictions[offset:offset + num_rows]
+                offset += num_rows
+        except Exception as e:
+            logging.error("Predicting batch of %d requests failed: %s" % (len(batch), str(e)))
+            for request in batch:    # predict the requests one by one, so a single invalid request does not fail the others
+                try:
+                    request["result"] = self.model.predict(request["rows"])
+                except Exception as e:
+                    request["result"] = e
+        now = time.perf_counter()
+        with self.lock:
+            self.num_batches += 1
+            for request in batch:
+                self.num_requests += 1
+                self.num_rows += request["rows"].shape[0]
+                self.latencies.append(now - request["submitted"])
+        for request in batch:
+            request["done"].set()
+
+    def stats(self):
+        """
+        Get throughput and latency statistics since the server was started.
+
+        Returns
+        -------
+        dict
+            With keys 'requests', 'rows', 'batches', 'mean_batch_rows', 'uptime_sec', 'rows_per_sec' and 'latency_ms' (a dict with the 50th, 90th, 99th percentile and the maximum over the last 100000 requests).
+        """
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.0
+            uptime = time.time() - self.start_time
+            stats = {"requests": self.num_requests, "rows": self.num_rows, "batches": self.num_batches,
+                     "mean_batch_rows": self.num_rows / float(self.num_batches) if self.num_batches else 0.0,
+                     "uptime_sec": uptime, "rows_per_sec": self.num_rows / uptime if uptime > 0 else 0.0}
+        if latencies.shape[0]:
+            stats["latency_ms"] = {"p50": np.percentile(latencies, 50), "p90": np.percentile(latencies, 90), "p99": np.percentile(latencies, 99), "max": np.max(latencies)}
+        else:
+            stats["latency_ms"] = {}
+        return stats
+
+
+def load_subject_table(descriptors_file, subjects_file, metadata_file):
+    """
+    Load the descriptors and covariates of known subjects, so that requests can refer to subjects by ID.
+
+    Returns
+    -------
+    dataframe
+        One row per subject, indexed by subject ID.
+    """
+    descriptors, metadata = load_data(descriptors_file, subjects_file, metadata_file)
+    add_covariates(descriptors, metadata)
+    descriptors.index = metadata["subject_id"].values
+    return descriptors
+
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler for the prediction server. Expects the server to have the attributes 'batcher' and 'subject_table'.
+    """
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send_json(200, self.server.batcher.stats())
+        else:
+            self._send_json(404, {"error": "Unknown path '%s'." % (self.path)})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self._send_json(404, {"error": "Unknown path '%s'." % (self.path)})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if "subject_ids" in body:
+                if self.server.subject_table is None:
+                    raise ValueError("Server was started without subject data, send 'rows' instead of 'subject_ids'.")
+                missing = [s for s in body["subject_ids"] if s not in self.server.subject_table.index]
+                if missing:
+                    raise ValueError("Unknown subject IDs: %s" % (", ".join(missing)))
+                rows = self.server.subject_table.loc[body["subject_ids"]]
+            else:
+                rows = pd.DataFrame(body["rows"])
+        except Exception as e:
+            self._send_json(400, {"error": "Invalid request: %s" % (str(e))})
+            return
+        if rows.shape[0] == 0:
+            self._send_json(200, {"predictions": []})
+            return
+        try:
+            predictions = self.server.batcher.predict(rows)
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(200, {"predictions": predictions.tolist()})
+
+    def _send_json(self, status, data):
+        payload = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def address_string(self):
+        return str(self.client_address[0]) if self.client_address else "unix-socket"
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s" % (self.address_string(), format % args))
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(model_file, host="127.0.0.1", port=8089, unix_socket=None, descriptors_file=None, subjects_file=None, metadata_file=None, max_batch_size=256, max_wait=0.005):
+    """
+    Load a saved prediction pipeline and serve predictions until interrupted.
+
+    Parameters
+    ----------
+    model_file: str
+        Path to a file written by abide.preprocessing.save_model.
+
+    host: str
+        Host to listen on for HTTP. Defaults to localhost only.
+
+    port: int
+        Port to listen on for HTTP.
+
+    unix_socket: str, optional
+        If given, listen on this Unix socket path instead of a TCP port.
+
+    descriptors_file: str, optional
+        Descriptor file of known subjects, see load_data. Required for requests by subject ID.
+
+    subjects_file: str, optional
+        Subjects file for a CSV descriptors_file, see load_data.
+
+    metadata_file: str, optional
+        ABIDE metadata file, see load_data. Required for requests by subject ID.
+
+    max_batch_size: int
+        Maximal number of rows per micro-batch.
+
+    max_wait: float
+        Maximal time in seconds to wait for more requests before a micro-batch is predicted.
+    """
+    model = PredictionModel(model_file)
+    subject_table = None
+    if descriptors_file is not None:
+        subject_table = load_subject_table(descriptors_file, subjects_file, metadata_file)
+        logging.info("Loaded data on %d known subjects." % (subject_table.shape[0]))
+
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, PredictionRequestHandler)
+        logging.info("Serving predictions on Unix socket '%s'." % (unix_socket))
+    else:
+        server = ThreadingHTTPServer((host, port), PredictionRequestHandler)
+        logging.info("Serving predictions on http://%s:%d/predict" % (host, port))
+    server.batcher = MicroBatcher(model, max_batch_size=max_batch_size, max_wait=max_wait)
+    server.subject_table = subject_table
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info("Server stopped. Statistics: %s" % (json.dumps(server.batcher.stats())))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Serve predictions of a saved ABIDE prediction pipeline.")
+    parser.add_argument("model_file", help="Model file written by abide.preprocessing.save_model.")
+    parser.add_argument("--host", default="127.0.0.1", help="Host to listen on.")
+    parser.add_argument("--port", type=int, default=8089, help="Port to listen on.")
+    parser.add_argument("--unix-socket", default=None, help="Listen on this Unix socket instead of a TCP port.")
+    parser.add_argument("--descriptors", default=None, help="Descriptor file of known subjects, enables requests by subject ID.")
+    parser.add_argument("--subjects", default=None, help="Subjects file, required with a CSV descriptor file.")
+    parser.add_argument("--metadata", default=None, help="ABIDE metadata CSV file, required with --descriptors.")
+    parser.add_argument("--max-batch-size", type=int, default=256, help="Maximal number of rows per micro-batch.")
+    parser.add_argument("--max-wait-ms", type=float, default=5.0, help="Maximal time to wait for more requests before predicting a micro-batch.")
+    args = parser.parse_args()
+    serve(args.model_file, host=args.host, port=args.port, unix_socket=args.unix_socket, descriptors_file=args.descriptors, subjects_file=args.subjects, metadata_file=args.metadata, max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000.0)
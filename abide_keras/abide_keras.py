@@ -1,47 +1,279 @@
 import os, sys
+import time
+import argparse
 import numpy as np
 import logging
-from keras.models import Sequential
-from keras.layers import Dense
-from abide_data import preproc_data, load_data
+from sklearn.model_selection import train_test_split
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))    # for the shared abide package
+from abide.data import load_data
+from abide.preprocessing import preproc_data, save_model
+from abide.registry import get_backend
+from instrumentation import instrument, stage
 
 APPTAG = "[ABD_KRS] "
 
-def run_nn():
+@instrument()
+def run_nn(model_file=None, use_tf_data=False, batch_size=32, intra_op_threads=None, inter_op_threads=None, benchmark=False, benchmark_batch_sizes=(32, 128, 512), epochs=60, patience=10, target_accuracy=None, checkpoint_dir=None, dtype=None):
+    """
+    Train and evaluate a dense neural network on the ABIDE data.
+
+    Parameters
+    ----------
+    model_file: str, optional
+        If given, the trained network is saved next to this file (same base name, extension '.keras'), and the prediction pipeline (fitted preprocessor, PCA and a reference to the network) is saved to this file, see save_model. It can be served with ../abide_brain_age_sklearn/serve_abide_model.py.
+
+    use_tf_data: bool
+        Whether to feed the network through a tf.data pipeline (cached, shuffled, batched and prefetched, see make_dataset) instead of passing the NumPy arrays to Keras directly.
+
+    batch_size: int
+        Training batch size.
+
+    intra_op_threads: int, optional
+        Size of the TensorFlow thread pool used within single operations. Defaults to TensorFlow's choice.
+
+    inter_op_threads: int, optional
+        Size of the TensorFlow thread pool used to run independent operations in parallel. Defaults to TensorFlow's choice.
+
+    benchmark: bool
+        If True, do not train the model normally, but report training and inference samples/sec for the batch sizes in benchmark_batch_sizes, see benchmark_throughput.
+
+    benchmark_batch_sizes: sequence of int
+        Batch sizes for the benchmark mode.
+
+    epochs: int
+        Maximal number of training epochs. Training stops earlier once the validation accuracy did not improve for patience epochs.
+
+    patience: int
+        Early stopping patience in epochs. A validation set of 20% is split off the training set for this.
+
+    target_accuracy: float, optional
+        If given, the training time until the validation accuracy first reached this value is reported.
+
+    checkpoint_dir: str, optional
+        If given, checkpoints are written to this directory every epoch, and an interrupted run resumes from them.
+
+    dtype: str, optional
+        The float type of the data in all stages, see load_data and preproc_data. Keras computes in float32, so 'float32' also avoids the conversion of the network input, and halves the memory. Defaults to float64.
+    """
 
     logging.basicConfig(level=logging.DEBUG)
 
     ################ Specify data files and load data ####################
 
     data_path = os.path.join("..", "abide_brain_age_sklearn")
-    descriptors_file = os.path.join(data_path, "braindescriptors.csv")
+    descriptors_file = os.path.join(data_path, "braindescriptors.npy")    # binary descriptor store written by gen_braindescriptors.py
+    if not os.path.isfile(descriptors_file):
+        descriptors_file = os.path.join(data_path, "braindescriptors.csv")
     subjects_file = os.path.join(data_path, "subjects.txt")
     metadata_file = os.path.join(data_path, "tools", "Phenotypic_V1_0b_preprocessed1.csv")
 
     logging.info(APPTAG + "Loading data.")
-    descriptors, metadata = load_data(descriptors_file, subjects_file, metadata_file)
+    descriptors, metadata = load_data(descriptors_file, subjects_file, metadata_file, dtype=dtype)
 
     labels = metadata["DX_GROUP"]
-    X_train, X_test, y_train, y_test = preproc_data(descriptors, metadata, labels)
+    X_train, X_test, y_train, y_test, preprocessor, pca = preproc_data(descriptors, metadata, labels, return_transformers=True, dtype=dtype)
     data = (X_train, X_test, y_train, y_test)
+    class_labels, y_train = np.unique(np.asarray(y_train), return_inverse=True)    # the network predicts class indices, saved with the model to map them back to labels
+    y_test = np.searchsorted(class_labels, np.asarray(y_test))
     input_dim = X_train.shape[1]
 
-    model = Sequential()
-    model.add(Dense(units=64, activation='relu', input_dim=input_dim))
-    model.add(Dense(units=10, activation='softmax'))
+    configure_threads(intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)    # must happen before TensorFlow runs any operation
 
-    model.compile(loss='sparse_categorical_crossentropy', optimizer='sgd', metrics=['accuracy'])
+    if benchmark:
+        benchmark_throughput(input_dim, X_train, y_train, X_test, batch_sizes=benchmark_batch_sizes, num_classes=len(class_labels))
+        return
+
+    model = build_model(input_dim, num_classes=len(class_labels))
+    from keras_training import train_model    # imports Keras, so only done once the data is ready
 
-    model.fit(X_train, y_train, epochs=60, batch_size=32)
+    X_fit, X_val, y_fit, y_val = train_test_split(X_train, y_train, test_size=.2, random_state=42, stratify=y_train)    # validation set for early stopping
+    with stage("train", use_tf_data=use_tf_data, batch_size=batch_size) as current:
+        current.add_shape("X_fit", X_fit)
+        if use_tf_data:
+            history, report = train_model(model, make_dataset(X_fit, y_fit, batch_size=batch_size, shuffle=True), validation_data=make_dataset(X_val, y_val, batch_size=128), epochs=epochs, patience=patience, target_accuracy=target_accuracy, checkpoint_dir=checkpoint_dir)
+        else:
+            history, report = train_model(model, X_fit, y_fit, validation_data=(X_val, y_val), epochs=epochs, batch_size=batch_size, patience=patience, target_accuracy=target_accuracy, checkpoint_dir=checkpoint_dir)
+        current.set(epochs_run=report["epochs_run"], time_to_target=report["time_to_target"])
+    with stage("evaluate") as current:
+        current.add_shape("X_test", X_test)
+        if use_tf_data:
+            loss_and_metrics = model.evaluate(make_dataset(X_test, y_test, batch_size=32))
+        else:
+            loss_and_metrics = model.evaluate(X_test, y_test, batch_size=32)
+    logging.info(APPTAG + "Trained with optimizer '%s' and batch size %d for %d epochs in %.1f seconds, time to target accuracy: %s." % (model.optimizer.__class__.__name__, batch_size, report["epochs_run"], report["train_time"], "%.1f seconds" % (report["time_to_target"]) if report["time_to_target"] is not None else "not reached"))
 
-    loss_and_metrics = model.evaluate(X_test, y_test, batch_size=32)
-    
     print(model.metrics_names)
     print(loss_and_metrics)
 
     print("Predicting classes.")
-    classes = model.predict(X_test, batch_size=128)
+    if use_tf_data:
+        classes = model.predict(make_dataset(X_test, batch_size=128))
+    else:
+        classes = model.predict(X_test, batch_size=128)
+
+    if model_file is not None:
+        keras_model_file = os.path.splitext(model_file)[0] + ".keras"
+        model.save(keras_model_file)
+        save_model(model_file, preprocessor, pca, os.path.abspath(keras_model_file), name="keras_dense", classes=class_labels)
+
+
+def build_model(input_dim, num_classes=10):
+    """
+    Create and compile the dense network.
+
+    Parameters
+    ----------
+    input_dim: int
+        Number of input features.
+
+    num_classes: int
+        Number of output units. The training labels must be class indices below this.
+
+    Returns
+    -------
+    keras model
+        The compiled, untrained model.
+    """
+    keras = get_backend("keras")    # Keras is only imported once the data is ready
+    model = keras.models.Sequential()
+    model.add(keras.Input(shape=(input_dim,)))
+    model.add(keras.layers.Dense(units=64, activation='relu'))
+    model.add(keras.layers.Dense(units=num_classes, activation='softmax'))
+
+    model.compile(loss='sparse_categorical_crossentropy', optimizer='sgd', metrics=['accuracy'])
+    return model
+
+
+def configure_threads(intra_op_threads=None, inter_op_threads=None):
+    """
+    Set the sizes of the TensorFlow CPU thread pools. Has to be called before TensorFlow executes its first operation.
+
+    Parameters
+    ----------
+    intra_op_threads: int, optional
+        Threads used to parallelize a single operation, like a matrix multiplication. Unchanged if None.
+
+    inter_op_threads: int, optional
+        Threads used to run independent operations concurrently. Unchanged if None.
+    """
+    tf = get_backend("tensorflow")
+    if intra_op_threads is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    if inter_op_threads is not None:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    logging.info(APPTAG + "TensorFlow thread pools: intra-op %d, inter-op %d (0 means chosen by TensorFlow)." % (tf.config.threading.get_intra_op_parallelism_threads(), tf.config.threading.get_inter_op_parallelism_threads()))
+
+
+def make_dataset(X, y=None, batch_size=32, shuffle=False, seed=42):
+    """
+    Create a tf.data input pipeline from preprocessed matrices.
+
+    The data is converted to float32 once and cached in memory after the first pass, then optionally shuffled every epoch, batched and prefetched so the next batch is prepared while the current one is trained on.
+
+    Parameters
+    ----------
+    X: numpy 2D array
+        The features, one row per subject.
+
+    y: numpy 1D array, optional
+        The labels. Omit for inference.
+
+    batch_size: int
+        The batch size.
+
+    shuffle: bool
+        Whether to shuffle the rows before each epoch (use for training only).
+
+    seed: int
+        Seed for the shuffling.
+
+    Returns
+    -------
+    tf.data.Dataset
+        The batched dataset.
+    """
+    tf = get_backend("tensorflow")
+    X = np.asarray(X, dtype=np.float32)
+    dataset = tf.data.Dataset.from_tensor_slices(X if y is None else (X, np.asarray(y)))
+    dataset = dataset.cache()
+    if shuffle:
+        dataset = dataset.shuffle(X.shape[0], seed=seed, reshuffle_each_iteration=True)
+    return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+def benchmark_throughput(input_dim, X_train, y_train, X_test, batch_sizes=(32, 128, 512), epochs=5, num_classes=10):
+    """
+    Measure training and inference throughput of the network for different batch sizes, with and without the tf.data pipeline.
+
+    For each setting, a fresh model is trained for one warm-up epoch (not timed, includes graph tracing), then for the given number of epochs. Inference is timed on the test set after one warm-up pass.
+
+    Parameters
+    ----------
+    input_dim: int
+        Number of input features.
+
+    X_train, y_train: numpy arrays
+        Training data and class indices, see build_model.
+
+    X_test: numpy 2D array
+        Data used for the inference measurement.
+
+    batch_sizes: sequence of int
+        The batch sizes to test.
+
+    epochs: int
+        Number of timed training epochs.
+
+    num_classes: int
+        Number of output units, see build_model.
+
+    Returns
+    -------
+    list of dict
+        One entry per setting with keys 'input', 'batch_size', 'train_samples_per_sec' and 'predict_samples_per_sec'.
+    """
+    results = []
+    for bs in batch_sizes:
+        for use_tf_data in [False, True]:
+            model = build_model(input_dim, num_classes=num_classes)
+            if use_tf_data:
+                train_data = make_dataset(X_train, y_train, batch_size=bs, shuffle=True)
+                test_data = make_dataset(X_test, batch_size=bs)
+                fit = lambda num_epochs: model.fit(train_data, epochs=num_epochs, verbose=0)
+                predict = lambda: model.predict(test_data, verbose=0)
+            else:
+                fit = lambda num_epochs: model.fit(X_train, y_train, epochs=num_epochs, batch_size=bs, verbose=0)
+                predict = lambda: model.predict(X_test, batch_size=bs, verbose=0)
+
+            fit(1)
+            start = time.perf_counter()
+            fit(epochs)
+            train_rate = X_train.shape[0] * epochs / (time.perf_counter() - start)
+
+            predict()
+            start = time.perf_counter()
+            predict()
+            predict_rate = X_test.shape[0] / (time.perf_counter() - start)
+
+            result = {"input": "tf.data" if use_tf_data else "numpy", "batch_size": bs, "train_samples_per_sec": train_rate, "predict_samples_per_sec": predict_rate}
+            logging.info(APPTAG + "Benchmark: input %-7s batch size %4d: training %10.1f samples/sec, inference %10.1f samples/sec." % (result["input"], bs, train_rate, predict_rate))
+            results.append(result)
+    return results
 
 
 if __name__ == "__main__":
-    run_nn()
+    parser = argparse.ArgumentParser(description="Train a dense neural network on the ABIDE data.")
+    parser.add_argument("--tf-data", action="store_true", help="Feed the network through a tf.data pipeline.")
+    parser.add_argument("--batch-size", type=int, default=32, help="Training batch size.")
+    parser.add_argument("--intra-op-threads", type=int, default=None, help="TensorFlow intra-op thread pool size.")
+    parser.add_argument("--inter-op-threads", type=int, default=None, help="TensorFlow inter-op thread pool size.")
+    parser.add_argument("--benchmark", action="store_true", help="Report training and inference samples/sec for several batch sizes instead of training.")
+    parser.add_argument("--epochs", type=int, default=60, help="Maximal number of training epochs.")
+    parser.add_argument("--patience", type=int, default=10, help="Early stopping patience in epochs.")
+    parser.add_argument("--target-accuracy", type=float, default=None, help="Report the training time until this validation accuracy is reached.")
+    parser.add_argument("--checkpoint-dir", default=None, help="Write checkpoints to this directory and resume from them.")
+    parser.add_argument("--model-file", default=None, help="Save the trained network and the prediction pipeline for serve_abide_model.py to this file.")
+    parser.add_argument("--precision", default=None, choices=["float32", "float64"], help="Float type of the data in all stages, defaults to float64.")
+    args = parser.parse_args()
+    run_nn(model_file=args.model_file, use_tf_data=args.tf_data, batch_size=args.batch_size, intra_op_threads=args.intra_op_threads, inter_op_threads=args.inter_op_threads, benchmark=args.benchmark, epochs=args.epochs, patience=args.patience, target_accuracy=args.target_accuracy, checkpoint_dir=args.checkpoint_dir, dtype=args.precision)
@@ -0,0 +1,5 @@
+"""
+Stage instrumentation for the pipelines in this repository: wall time, CPU time, peak RSS and array shapes per stage, JSON traces and optional cProfile output.
+"""
+
+from .tracing import stage, instrument, get_records, write_trace, enable_tracing, compare_traces, peak_rss_mb
@@ -0,0 +1,8 @@
+import sys
+from .tracing import compare_traces
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python -m instrumentation <old_trace.json> <new_trace.json>")
+        sys.exit(1)
+    compare_traces(sys.argv[1], sys.argv[2])
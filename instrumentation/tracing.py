@@ -0,0 +1,240 @@
+"""
+Stage tracing: wall time, CPU time, peak RSS and array shapes per pipeline stage, written as JSON traces.
+
+Tracing is configured with environment variables, so the existing scripts need no new options:
+
+    PIPELINE_TRACE=trace.json python predict_abide_brainage.py        # write a JSON trace when the process exits
+    PIPELINE_PROFILE=profiles python predict_abide_brainage.py        # also write a cProfile file per top-level stage
+
+Compare two traces to spot regressions with:
+
+    python -m instrumentation old_trace.json new_trace.json
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import cProfile
+import resource
+import functools
+import contextlib
+import logging
+import threading
+
+TRACE_ENV_VAR = "PIPELINE_TRACE"
+PROFILE_ENV_VAR = "PIPELINE_PROFILE"
+
+_records = []
+_state = threading.local()
+_config = {"trace_file": None, "profile_dir": None}
+
+
+def peak_rss_mb():
+    """
+    Get the peak resident set size of the current process in MB.
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024.0 * 1024.0) if sys.platform == "darwin" else maxrss / 1024.0    # bytes on macOS, KB on Linux
+
+
+def _shape(value):
+    shape = getattr(value, "shape", None)
+    if shape is None:
+        return None
+    try:
+        return [int(dim) for dim in shape]
+    except TypeError:
+        return None
+
+
+def _shapes_of(values, prefix):
+    shapes = dict()
+    if isinstance(values, (tuple, list)):
+        for idx, value in enumerate(values):
+            shapes.update(_shapes_of(value, "%s%d_" % (prefix, idx)))
+    else:
+        shape = _shape(values)
+        if shape is not None:
+            shapes[prefix.rstrip("_")] = shape
+    return shapes
+
+
+class Stage():
+    """
+    A running stage, as yielded by the stage context manager. Use it to attach shapes and other information to the record.
+    """
+    def __init__(self, name, parent, info):
+        self.name = name
+        self.path = name if parent is None else parent.path + "/" + name
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.info = dict(info)
+        self.shapes = dict()
+
+    def add_shape(self, name, value):
+        """
+        Record the shape of an array or data frame under the given name.
+        """
+        shape = _shape(value)
+        if shape is not None:
+            self.shapes[name] = shape
+
+    def set(self, **info):
+        """
+        Add JSON-serializable information to the record, like parameters or scores.
+        """
+        self.info.update(info)
+
+
+@contextlib.contextmanager
+def stage(name, **info):
+    """
+    Record wall time, CPU time and peak RSS of a block of code.
+
+    Stages can be nested, the record of an inner stage has the path of all enclosing stages, like 'run_nn/train'. If profiling is enabled, every top-level stage is run under cProfile and the statistics are written to '<profile_dir>/<name>.prof'.
+
+    Parameters
+    ----------
+    name: str
+        The stage name.
+
+    info: keyword arguments
+        JSON-serializable information stored with the record.
+
+    Yields
+    ------
+    Stage
+        Used to add shapes and information to the record.
+    """
+    stack = getattr(_state, "stack", None)
+    if stack is None:
+        stack = _state.stack = []
+    current = Stage(name, stack[-1] if stack else None, info)
+    stack.append(current)
+    profiler = None
+    if _config["profile_dir"] is not None and current.depth == 0:
+        profiler = cProfile.Profile()
+    rss_before = peak_rss_mb()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    status = "ok"
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield current
+    except BaseException:
+        status = "failed"
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        wall_time = time.perf_counter() - wall_start
+        cpu_time = time.process_time() - cpu_start
+        stack.pop()
+        record = {"stage": current.path, "name": name, "depth": current.depth, "status": status, "start": time.time() - wall_time,
+                  "wall_time": wall_time, "cpu_time": cpu_time, "peak_rss_mb": peak_rss_mb(), "peak_rss_increase_mb": peak_rss_mb() - rss_before,
+                  "shapes": current.shapes, "info": current.info, "pid": os.getpid()}
+        if profiler is not None:
+            os.makedirs(_config["profile_dir"], exist_ok=True)
+            record["profile_file"] = os.path.join(_config["profile_dir"], "%s.prof" % (current.path.replace("/", "_")))
+            profiler.dump_stats(record["profile_file"])
+        _records.append(record)
+        logging.debug("Stage '%s' %s: wall time %.3f sec, CPU time %.3f sec, peak RSS %.1f MB (+%.1f MB)." % (current.path, status, wall_time, cpu_time, record["peak_rss_mb"], record["peak_rss_increase_mb"]))
+
+
+def instrument(name=None):
+    """
+    Decorator which runs a function as a stage, see stage. The shapes of array arguments and of the (tuple elements of the) return value are recorded.
+
+    Parameters
+    ----------
+    name: str, optional
+        The stage name. Defaults to the function name.
+    """
+    def decorator(func):
+        stage_name = name if name is not None else func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name) as current:
+                current.shapes.update(_shapes_of(list(args), "arg_"))
+                result = func(*args, **kwargs)
+                current.shapes.update(_shapes_of(result, "result_"))
+            return result
+        return wrapper
+    return decorator
+
+
+def get_records():
+    """
+    Get the records of all finished stages in this process, in order of completion.
+    """
+    return list(_records)
+
+
+def write_trace(trace_file):
+    """
+    Write all stage records of this process to a JSON file, together with the command line and the Python version.
+    """
+    trace = {"argv": sys.argv, "python": sys.version.split()[0], "pid": os.getpid(), "written": time.time(), "stages": get_records()}
+    with open(trace_file, "w") as fh:
+        json.dump(trace, fh, indent=2)
+    logging.info("Wrote trace of %d stages to file '%s'." % (len(trace["stages"]), trace_file))
+
+
+def enable_tracing(trace_file=None, profile_dir=None):
+    """
+    Write a trace when the process exits and/or profile the top-level stages. Called on import with the PIPELINE_TRACE and PIPELINE_PROFILE environment variables.
+
+    Parameters
+    ----------
+    trace_file: str, optional
+        The JSON trace file, see write_trace. Stages are recorded in any case, this only controls the file.
+
+    profile_dir: str, optional
+        Directory for cProfile files of the top-level stages. Profiling is off if None.
+    """
+    if trace_file is not None and _config["trace_file"] is None:
+        pid = os.getpid()
+        atexit.register(lambda: write_trace(_config["trace_file"]) if os.getpid() == pid else None)    # not in forked workers
+    if trace_file is not None:
+        _config["trace_file"] = trace_file
+    _config["profile_dir"] = profile_dir
+
+
+def compare_traces(old_trace_file, new_trace_file):
+    """
+    Compare the stages of two traces and print the change in wall time, CPU time and peak RSS.
+
+    Stages which ran several times are summed up (times) or maximized (peak RSS).
+
+    Returns
+    -------
+    dict
+        Maps a stage path to a dict with keys 'old' and 'new', each a dict with keys 'wall_time', 'cpu_time' and 'peak_rss_mb', or None if the stage is missing in that trace.
+    """
+    def summarize(trace_file):
+        with open(trace_file, "r") as fh:
+            stages = json.load(fh)["stages"]
+        summary = dict()
+        for record in stages:
+            entry = summary.setdefault(record["stage"], {"wall_time": 0.0, "cpu_time": 0.0, "peak_rss_mb": 0.0})
+            entry["wall_time"] += record["wall_time"]
+            entry["cpu_time"] += record["cpu_time"]
+            entry["peak_rss_mb"] = max(entry["peak_rss_mb"], record["peak_rss_mb"])
+        return summary
+
+    old, new = summarize(old_trace_file), summarize(new_trace_file)
+    comparison = dict()
+    print("%-50s %12s %12s %8s %12s %12s" % ("stage", "old wall [s]", "new wall [s]", "ratio", "old RSS [MB]", "new RSS [MB]"))
+    for path in list(old) + [p for p in new if p not in old]:
+        comparison[path] = {"old": old.get(path), "new": new.get(path)}
+        o, n = old.get(path), new.get(path)
+        ratio = "%.2f" % (n["wall_time"] / o["wall_time"]) if o is not None and n is not None and o["wall_time"] > 0 else "-"
+        print("%-50s %12s %12s %8s %12s %12s" % (path, "%.3f" % o["wall_time"] if o else "-", "%.3f" % n["wall_time"] if n else "-", ratio, "%.1f" % o["peak_rss_mb"] if o else "-", "%.1f" % n["peak_rss_mb"] if n else "-"))
+    return comparison
+
+
+enable_tracing(os.environ.get(TRACE_ENV_VAR) or None, os.environ.get(PROFILE_ENV_VAR) or None)
+
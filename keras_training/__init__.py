@@ -0,0 +1,5 @@
+"""
+Shared Keras training driver for the ABIDE and MNIST networks: validation-based early stopping, checkpoints to resume interrupted jobs, and time-to-accuracy reporting.
+"""
+
+from .driver import train_model, TimeToAccuracy
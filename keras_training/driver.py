@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import logging
+import keras
+
+
+class TimeToAccuracy(keras.callbacks.Callback):
+    """
+    Keras callback which records the training time per epoch and the time until a monitored accuracy first reaches a target.
+
+    If a progress file is given, the times are stored in it after every epoch and loaded when training starts, so the times of an interrupted and resumed job add up. The file is removed once training completes.
+
+    Parameters
+    ----------
+    target: float, optional
+        The target accuracy. If None, only the epoch times are recorded.
+
+    monitor: str
+        The metric compared with the target, e.g., 'val_accuracy'.
+
+    progress_file: str, optional
+        JSON file to persist the times across resumed runs.
+    """
+    def __init__(self, target=None, monitor="val_accuracy", progress_file=None):
+        super().__init__()
+        self.target = target
+        self.monitor = monitor
+        self.progress_file = progress_file
+        self.elapsed = 0.0
+        self.epoch_times = []
+        self.time_to_target = None
+        self.epochs_to_target = None
+
+    def on_train_begin(self, logs=None):
+        if self.progress_file is not None and os.path.isfile(self.progress_file):
+            with open(self.progress_file, "r") as fh:
+                progress = json.load(fh)
+            self.elapsed = progress["elapsed"]
+            self.epoch_times = progress["epoch_times"]
+            self.time_to_target = progress["time_to_target"]
+            self.epochs_to_target = progress["epochs_to_target"]
+            logging.info("Resuming time tracking after %d epochs and %.1f seconds of training." % (len(self.epoch_times), self.elapsed))
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        epoch_time = time.perf_counter() - self.epoch_start
+        self.elapsed += epoch_time
+        self.epoch_times.append(epoch_time)
+        value = (logs or {}).get(self.monitor)
+        if self.target is not None and self.time_to_target is None and value is not None and value >= self.target:
+            self.time_to_target = self.elapsed
+            self.epochs_to_target = len(self.epoch_times)
+            logging.info("Reached %s %f >= target %f after %d epochs and %.1f seconds of training." % (self.monitor, value, self.target, self.epochs_to_target, self.time_to_target))
+        if self.progress_file is not None:
+            with open(self.progress_file, "w") as fh:
+                json.dump({"elapsed": self.elapsed, "epoch_times": self.epoch_times, "time_to_target": self.time_to_target, "epochs_to_target": self.epochs_to_target}, fh)
+
+    def on_train_end(self, logs=None):
+        if self.progress_file is not None and os.path.isfile(self.progress_file):
+            os.remove(self.progress_file)
+
+
+def train_model(model, x, y=None, validation_data=None, epochs=100, batch_size=None, patience=5, monitor="val_accuracy", target_accuracy=None, checkpoint_dir=None, checkpoint_every=None, callbacks=None, verbose=1):
+    """
+    Train a compiled Keras model with early stopping, resumable checkpoints and time-to-accuracy tracking.
+
+    Parameters
+    ----------
+    model: keras model
+        The compiled model. It must report the monitored metric, e.g., be compiled with metrics=['accuracy'] to monitor 'val_accuracy'.
+
+    x: numpy array or tf.data.Dataset
+        The training data, passed on to model.fit.
+
+    y: numpy array, optional
+        The training labels. Omit if x is a dataset which yields (features, labels).
+
+    validation_data: tuple or tf.data.Dataset
+        The validation data, used for early stopping and the time-to-accuracy measurement.
+
+    epochs: int
+        Maximal number of epochs.
+
+    batch_size: int, optional
+        Batch size, only used if x is an array.
+
+    patience: int
+        Number of epochs without improvement of the monitored metric after which training stops. The weights of the best epoch are restored. Note that the patience counter restarts when an interrupted job is resumed.
+
+    monitor: str
+        The validation metric used for early stopping and the target accuracy.
+
+    target_accuracy: float, optional
+        Report the training time until the monitored metric first reached this value.
+
+    checkpoint_dir: str, optional
+        Directory for the checkpoints. If given, the training state is saved periodically and an interrupted job resumes from it when called again with the same directory. Removed once training completes.
+
+    checkpoint_every: int, optional
+        Save a checkpoint every this many batches. Defaults to once per epoch.
+
+    callbacks: list of keras callbacks, optional
+        Additional callbacks.
+
+    verbose: int
+        Verbosity, passed on to model.fit.
+
+    Returns
+    -------
+    history: dict
+        The training history, as in History.history.
+
+    report: dict
+        With keys 'epochs_run', 'best_epoch' (1-based), 'best_' + monitor, 'train_time' (seconds, over all resumed runs), 'time_to_target' and 'epochs_to_target' (None if the target was not reached or not given), and 'target_accuracy'.
+    """
+    progress_file = None
+    all_callbacks = [keras.callbacks.EarlyStopping(monitor=monitor, mode="max", patience=patience, restore_best_weights=True)]
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        progress_file = os.path.join(checkpoint_dir, "progress.json")
+        all_callbacks.append(keras.callbacks.BackupAndRestore(os.path.join(checkpoint_dir, "backup"), save_freq=checkpoint_every if checkpoint_every is not None else "epoch"))
+    time_tracker = TimeToAccuracy(target=target_accuracy, monitor=monitor, progress_file=progress_file)
+    all_callbacks.append(time_tracker)
+    all_callbacks.extend(callbacks or [])
+
+    history = model.fit(x, y, validation_data=validation_data, epochs=epochs, batch_size=batch_size, callbacks=all_callbacks, verbose=verbose)
+
+    scores = history.history.get(monitor, [])    # only the epochs of this run if it was resumed
+    best_epoch = int(max(range(len(scores)), key=lambda idx: scores[idx])) if scores else None
+    resumed_epochs = len(time_tracker.epoch_times) - len(scores)
+    report = {"epochs_run": len(time_tracker.epoch_times),
+              "best_epoch": best_epoch + 1 + resumed_epochs if best_epoch is not None else None,
+              "best_" + monitor: scores[best_epoch] if best_epoch is not None else None,
+              "train_time": time_tracker.elapsed,
+              "time_to_target": time_tracker.time_to_target,
+              "epochs_to_target": time_tracker.epochs_to_target,
+              "target_accuracy": target_accuracy}
+    logging.info("Training done: %s" % (json.dumps(report)))
+    return history.history, report
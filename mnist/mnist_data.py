@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+# Local, memory-lean MNIST data store.
+#
+# The images are kept as uint8 .npy files which are memory-mapped. The tf.data input pipeline reads them per
+# batch and only then converts them to float32 and scales them. Create the store once (needs the Keras MNIST
+# file, which is downloaded if it is not in the Keras cache yet), then all later runs work offline:
+#
+#    python mnist_data.py                 # create the store in ./mnist_data
+#    python mnist_data.py --benchmark     # compare load time and peak RSS with the float64 path
+
+import os
+import sys
+import time
+import json
+import argparse
+import subprocess
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))    # for the shared instrumentation package
+from instrumentation import peak_rss_mb
+
+ARRAY_NAMES = ["x_train", "y_train", "x_test", "y_test"]
+
+
+def build_local_store(store_dir="mnist_data", source_file=None):
+    """
+    Create the local MNIST store from the Keras MNIST file.
+
+    Parameters
+    ----------
+    store_dir: str
+        Output directory. One uncompressed uint8 .npy file per array is written to it, see ARRAY_NAMES.
+
+    source_file: str, optional
+        Path to a 'mnist.npz' file as distributed by Keras. Defaults to the file in the Keras cache, which is downloaded if it does not exist yet.
+    """
+    if source_file is None:
+        source_file = os.path.join(os.path.expanduser("~"), ".keras", "datasets", "mnist.npz")
+        if not os.path.isfile(source_file):
+            import tensorflow as tf
+            tf.keras.datasets.mnist.load_data()    # downloads the file into the Keras cache
+    os.makedirs(store_dir, exist_ok=True)
+    with np.load(source_file) as source:
+        for name in ARRAY_NAMES:
+            np.save(os.path.join(store_dir, name + ".npy"), np.ascontiguousarray(source[name], dtype=np.uint8))
+    print("Wrote MNIST store to directory '%s'." % (store_dir))
+
+
+def load_local(store_dir="mnist_data", mmap=True):
+    """
+    Load MNIST from the local store, without network access.
+
+    Parameters
+    ----------
+    store_dir: str
+        The store directory, see build_local_store.
+
+    mmap: bool
+        Whether to memory-map the files instead of reading them into memory.
+
+    Returns
+    -------
+    (x_train, y_train), (x_test, y_test)
+        The uint8 arrays, in the same layout as tf.keras.datasets.mnist.load_data().
+    """
+    for name in ARRAY_NAMES:
+        if not os.path.isfile(os.path.join(store_dir, name + ".npy")):
+            raise IOError("MNIST store file '%s' not found in directory '%s', create the store with build_local_store first." % (name + ".npy", store_dir))
+    arrays = [np.load(os.path.join(store_dir, name + ".npy"), mmap_mode='r' if mmap else None) for name in ARRAY_NAMES]
+    return (arrays[0], arrays[1]), (arrays[2], arrays[3])
+
+
+def make_dataset(x, y, batch_size=32, shuffle=False, seed=42):
+    """
+    Create a tf.data pipeline which reads each batch of images from the (memory-mapped) uint8 arrays and converts it to float32 in range 0..1.
+
+    Only the row indices go through tf.data, which shuffles and batches them. The rows of a batch are then gathered from x and y, so a memory-mapped store is read lazily instead of being copied into one in-memory tensor.
+
+    Parameters
+    ----------
+    x: numpy uint8 array
+        The images.
+
+    y: numpy array
+        The labels.
+
+    batch_size: int
+        The batch size.
+
+    shuffle: bool
+        Whether to shuffle before each epoch.
+
+    seed: int
+        Seed for the shuffling.
+
+    Returns
+    -------
+    tf.data.Dataset
+        Yields (images, labels) batches with float32 images.
+    """
+    import tensorflow as tf
+
+    def read_batch(indices):
+        images, labels = tf.numpy_function(lambda idx: (np.asarray(x[idx]), np.asarray(y[idx])), [indices], [tf.as_dtype(x.dtype), tf.as_dtype(y.dtype)])
+        images.set_shape((None,) + tuple(x.shape[1:]))
+        labels.set_shape((None,) + tuple(y.shape[1:]))
+        return tf.cast(images, tf.float32) / 255.0, labels
+
+    dataset = tf.data.Dataset.range(x.shape[0])
+    if shuffle:
+        dataset = dataset.shuffle(x.shape[0], seed=seed, reshuffle_each_iteration=True)    # shuffles the indices only, 8 bytes per image
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(read_batch, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def _measure_loading(mode, store_dir):
+    """
+    Load the data in the given mode and return the load time and peak RSS. Meant to run in a fresh process.
+    """
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    if mode == "float64":    # the previous approach: everything in memory, scaled as float64
+        (x_train, y_train), (x_test, y_test) = load_local(store_dir, mmap=False)
+        x_train, x_test = x_train / 255.0, x_test / 255.0
+    else:    # memory-mapped uint8, scaled per batch while iterating
+        (x_train, y_train), (x_test, y_test) = load_local(store_dir, mmap=True)
+        for images, labels in make_dataset(x_train, y_train, batch_size=1024):
+            pass
+    return {"mode": mode, "load_time_sec": time.perf_counter() - start, "peak_rss_mb": peak_rss_mb(), "peak_rss_before_mb": rss_before}
+
+
+def benchmark_loading(store_dir="mnist_data"):
+    """
+    Compare load time and peak RSS of the float64 path and the uint8 pipeline, each in a fresh process.
+
+    For the uint8 pipeline, the time includes one full pass over the training set through tf.data, and the peak RSS includes TensorFlow itself, which is imported before the measurement starts.
+    """
+    results = []
+    for mode in ["float64", "uint8"]:
+        code = "import sys, json\nsys.path.insert(0, %s)\nimport mnist_data\n%sprint(json.dumps(mnist_data._measure_loading(%s, %s)))" % (repr(os.path.dirname(os.path.abspath(__file__))), "import tensorflow\n" if mode == "uint8" else "", repr(mode), repr(os.path.abspath(store_dir)))
+        output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print("%-8s load time %.2f sec, peak RSS %.1f MB (%.1f MB before loading)" % (result["mode"], result["load_time_sec"], result["peak_rss_mb"], result["peak_rss_before_mb"]))
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create the local MNIST store, or benchmark loading from it.")
+    parser.add_argument("--store-dir", default="mnist_data", help="The store directory.")
+    parser.add_argument("--source-file", default=None, help="Keras 'mnist.npz' file. Defaults to the Keras cache.")
+    parser.add_argument("--benchmark", action="store_true", help="Compare load time and peak RSS of the float64 path and the uint8 pipeline.")
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark_loading(args.store_dir)
+    else:
+        build_local_store(args.store_dir, source_file=args.source_file)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+#
+# Export a trained MNIST model for CPU inference and compare the exported variants.
+#
+# The Keras model is converted to TFLite, optionally with post-training quantization (float16 weights, or int8
+# weights and activations calibrated on training images), and all variants are run on the test set in batches:
+#
+#    python mnist_tensorflow_keras.py --model-file mnist.keras
+#    python mnist_export.py mnist.keras --export-dir mnist_export --batch-sizes 1 32 256
+
+import os
+import time
+import argparse
+import logging
+import numpy as np
+import tensorflow as tf
+
+from mnist_data import load_local
+
+QUANTIZATIONS = ["none", "float16", "int8"]
+
+
+def export_tflite(model, export_file, quantization="none", representative_images=None, num_calibration_batches=100):
+    """
+    Convert a Keras model to a TFLite file.
+
+    Parameters
+    ----------
+    model: keras model
+        The trained model.
+
+    export_file: str
+        Path of the TFLite file to write.
+
+    quantization: str
+        One of QUANTIZATIONS. 'none' keeps float32, 'float16' stores the weights as float16, and 'int8' quantizes weights and activations to int8. Inputs and outputs stay float32 in all cases.
+
+    representative_images: numpy uint8 array, optional
+        Images used to calibrate the activation ranges, required for 'int8'. Typically some training images.
+
+    num_calibration_batches: int
+        Number of single images from representative_images used for the calibration.
+
+    Returns
+    -------
+    int
+        The size of the written file in bytes.
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError("Invalid quantization '%s', must be one of: %s" % (quantization, ", ".join(QUANTIZATIONS)))
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        if representative_images is None:
+            raise ValueError("Quantization 'int8' requires representative_images for the calibration.")
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([np.asarray(image[np.newaxis], dtype=np.float32) / 255.0] for image in representative_images[:num_calibration_batches])
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    tflite_model = converter.convert()
+    with open(export_file, "wb") as fh:
+        fh.write(tflite_model)
+    logging.info("Exported model with quantization '%s' to file '%s' (%.1f KB)." % (quantization, export_file, len(tflite_model) / 1024.0))
+    return len(tflite_model)
+
+
+class TFLiteModel():
+    """
+    A TFLite model which predicts batches of uint8 images, on CPU.
+
+    Parameters
+    ----------
+    model_file: str
+        Path to a TFLite file written by export_tflite.
+
+    num_threads: int, optional
+        Number of CPU threads used by the interpreter. Defaults to TFLite's choice.
+
+    The XNNPACK delegate is used if it supports the model, otherwise the built-in TFLite kernels.
+    """
+    def __init__(self, model_file, num_threads=None):
+        self.model_file = model_file
+        self.num_threads = num_threads
+        self.use_xnnpack = True
+        self._create_interpreter()
+
+    def _create_interpreter(self):
+        resolver = tf.lite.experimental.OpResolverType.AUTO if self.use_xnnpack else tf.lite.experimental.OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+        self.interpreter = tf.lite.Interpreter(model_path=self.model_file, num_threads=self.num_threads, experimental_op_resolver_type=resolver)
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.batch_size = None
+
+    def predict(self, images):
+        """
+        Predict the class probabilities for a batch of images.
+
+        Parameters
+        ----------
+        images: numpy uint8 array
+            The images, shape (batch size, 28, 28).
+
+        Returns
+        -------
+        numpy 2D array
+            The class probabilities, one row per image.
+        """
+        if images.shape[0] != self.batch_size:    # re-allocating the tensors is expensive, so only done when the batch size changes
+            self.interpreter.resize_tensor_input(self.input_index, [images.shape[0], 28, 28])
+            self.interpreter.allocate_tensors()
+            self.batch_size = images.shape[0]
+        self.interpreter.set_tensor(self.input_index, np.asarray(images, dtype=np.float32) / 255.0)
+        try:
+            self.interpreter.invoke()
+        except RuntimeError as e:
+            if not self.use_xnnpack:
+                raise
+            logging.warning("XNNPACK delegate failed for model '%s', falling back to the built-in kernels: %s" % (self.model_file, str(e)))
+            self.use_xnnpack = False    # some TensorFlow versions cannot delegate all int8 ops to XNNPACK
+            self._create_interpreter()
+            return self.predict(images)
+        return self.interpreter.get_tensor(self.output_index)
+
+
+def predict_batched(predict_fn, x, batch_size):
+    """
+    Predict all images in batches and time every batch.
+
+    Parameters
+    ----------
+    predict_fn: callable
+        Takes a uint8 image batch and returns the class probabilities.
+
+    x: numpy uint8 array
+        The images.
+
+    batch_size: int
+        The batch size. The last batch may be smaller.
+
+    Returns
+    -------
+    predictions: numpy 1D array
+        The predicted classes.
+
+    batch_times: list of float
+        Time in seconds for each batch.
+    """
+    predictions = []
+    batch_times = []
+    for start in range(0, x.shape[0], batch_size):
+        batch = x[start:start + batch_size]
+        batch_start = time.perf_counter()
+        probabilities = predict_fn(batch)
+        batch_times.append(time.perf_counter() - batch_start)
+        predictions.append(np.argmax(probabilities, axis=1))
+    return np.concatenate(predictions), batch_times
+
+
+def benchmark_inference(keras_model, tflite_files, x_test, y_test, batch_sizes=(1, 32, 256), num_threads=None):
+    """
+    Compare latency, throughput and accuracy of the Keras model and its TFLite exports on the test set.
+
+    Every setting is warmed up with one batch before the timed pass over the whole test set.
+
+    Parameters
+    ----------
+    keras_model: keras model
+        The float32 Keras model, the reference.
+
+    tflite_files: dict
+        Maps a quantization name to a TFLite file, see export_tflite.
+
+    x_test, y_test: numpy arrays
+        The uint8 test images and labels.
+
+    batch_sizes: sequence of int
+        The batch sizes to test.
+
+    num_threads: int, optional
+        Number of CPU threads for the TFLite interpreters.
+
+    Returns
+    -------
+    list of dict
+        One entry per model and batch size with keys 'model', 'batch_size', 'accuracy', 'latency_ms_p50', 'latency_ms_p99' (per batch) and 'images_per_sec'.
+    """
+    predictors = [("keras", lambda batch: keras_model(np.asarray(batch, dtype=np.float32) / 255.0, training=False).numpy())]
+    for quantization, tflite_file in tflite_files.items():
+        predictors.append(("tflite_" + quantization, TFLiteModel(tflite_file, num_threads=num_threads).predict))
+
+    results = []
+    for name, predict_fn in predictors:
+        for batch_size in batch_sizes:
+            predict_fn(x_test[:batch_size])
+            start = time.perf_counter()
+            predictions, batch_times = predict_batched(predict_fn, x_test, batch_size)
+            total_time = time.perf_counter() - start
+            batch_times = np.array(batch_times) * 1000.0
+            result = {"model": name, "batch_size": batch_size, "accuracy": float(np.mean(predictions == np.asarray(y_test))),
+                      "latency_ms_p50": float(np.percentile(batch_times, 50)), "latency_ms_p99": float(np.percentile(batch_times, 99)),
+                      "images_per_sec": x_test.shape[0] / total_time}
+            logging.info("%-15s batch size %4d: accuracy %.4f, latency p50 %.3f ms p99 %.3f ms per batch, %10.1f images/sec." % (name, batch_size, result["accuracy"], result["latency_ms_p50"], result["latency_ms_p99"], result["images_per_sec"]))
+            results.append(result)
+    return results
+
+
+def export_and_benchmark(keras_model_file, export_dir="mnist_export", data_dir="mnist_data", quantizations=QUANTIZATIONS, batch_sizes=(1, 32, 256), num_threads=None):
+    """
+    Export a saved Keras MNIST model to TFLite with the given quantizations and compare all variants on the test set.
+
+    Parameters
+    ----------
+    keras_model_file: str
+        The trained model, saved by run_mnist in mnist_tensorflow_keras.py.
+
+    export_dir: str
+        Output directory for the TFLite files, named 'mnist_<quantization>.tflite'.
+
+    data_dir: str
+        The local MNIST store, see mnist_data.py. The first training images calibrate the int8 quantization.
+
+    quantizations: sequence of str
+        The quantizations to export, see QUANTIZATIONS.
+
+    batch_sizes: sequence of int
+        The batch sizes for the comparison.
+
+    num_threads: int, optional
+        Number of CPU threads for the TFLite interpreters.
+
+    Returns
+    -------
+    list of dict
+        The comparison, see benchmark_inference. TFLite entries also have the key 'file_size_kb'.
+    """
+    keras_model = tf.keras.models.load_model(keras_model_file)
+    (x_train, y_train), (x_test, y_test) = load_local(data_dir)
+    os.makedirs(export_dir, exist_ok=True)
+    tflite_files = {}
+    file_sizes = {}
+    for quantization in quantizations:
+        tflite_files[quantization] = os.path.join(export_dir, "mnist_%s.tflite" % (quantization))
+        file_sizes["tflite_" + quantization] = export_tflite(keras_model, tflite_files[quantization], quantization=quantization, representative_images=x_train) / 1024.0
+    results = benchmark_inference(keras_model, tflite_files, x_test, y_test, batch_sizes=batch_sizes, num_threads=num_threads)
+    for result in results:
+        if result["model"] in file_sizes:
+            result["file_size_kb"] = file_sizes[result["model"]]
+
+    print("%-15s %6s %9s %12s %12s %14s %10s" % ("model", "batch", "accuracy", "p50 [ms]", "p99 [ms]", "images/sec", "size [KB]"))
+    for result in results:
+        print("%-15s %6d %9.4f %12.3f %12.3f %14.1f %10s" % (result["model"], result["batch_size"], result["accuracy"], result["latency_ms_p50"], result["latency_ms_p99"], result["images_per_sec"], "%.1f" % (result["file_size_kb"]) if "file_size_kb" in result else "-"))
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Export a trained MNIST model to TFLite and compare the float and quantized variants on CPU.")
+    parser.add_argument("model_file", help="Keras model file, written by mnist_tensorflow_keras.py --model-file.")
+    parser.add_argument("--export-dir", default="mnist_export", help="Output directory for the TFLite files.")
+    parser.add_argument("--data-dir", default="mnist_data", help="Local MNIST store, create it with mnist_data.py.")
+    parser.add_argument("--quantizations", nargs="+", default=QUANTIZATIONS, choices=QUANTIZATIONS, help="The quantizations to export.")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 32, 256], help="Batch sizes for the comparison.")
+    parser.add_argument("--num-threads", type=int, default=None, help="Number of CPU threads for the TFLite interpreters.")
+    args = parser.parse_args()
+    export_and_benchmark(args.model_file, export_dir=args.export_dir, data_dir=args.data_dir, quantizations=args.quantizations, batch_sizes=args.batch_sizes, num_threads=args.num_threads)
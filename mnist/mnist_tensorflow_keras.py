@@ -1,33 +1,98 @@
 #!/usr/bin/env python
 
+import os
+import sys
+import time
+import argparse
+import logging
 import tensorflow as tf
 
-mnist = tf.keras.datasets.mnist
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))    # for the shared keras_training and instrumentation packages
+from keras_training import train_model
+from instrumentation import peak_rss_mb
+from mnist_data import load_local, make_dataset
 
-(x_train, y_train),(x_test, y_test) = mnist.load_data()
 
-x_train, x_test = x_train / 255.0, x_test / 255.0    # scale image intensities to range 0..1
+def run_mnist(epochs=10, batch_size=32, optimizer='adam', patience=3, target_accuracy=None, checkpoint_dir=None, data_dir="mnist_data", model_file=None):
+    """
+    Train and evaluate the dense network on MNIST.
 
+    Parameters
+    ----------
+    epochs: int
+        Maximal number of epochs. Training stops earlier once the validation accuracy did not improve for patience epochs.
 
-model = tf.keras.models.Sequential([
-  tf.keras.layers.Flatten(input_shape=(28, 28)),
-  tf.keras.layers.Dense(512, activation=tf.nn.relu),
-  tf.keras.layers.Dropout(0.2),
-  tf.keras.layers.Dense(512, activation=tf.nn.relu),
-  tf.keras.layers.Dropout(0.2),
-  tf.keras.layers.Dense(256, activation=tf.nn.relu),
-  tf.keras.layers.Dropout(0.2),
-  tf.keras.layers.Dense(10, activation=tf.nn.softmax)
-])
+    batch_size: int
+        Training batch size.
 
-model.compile(optimizer='adam',
-              loss='sparse_categorical_crossentropy',
-              metrics=['accuracy'])
+    optimizer: str
+        Name of the Keras optimizer.
 
-callbacks = [tf.keras.callbacks.TensorBoard(log_dir='./logs', profile_batch=0)]
+    patience: int
+        Early stopping patience in epochs. The last 10000 training images are used as the validation set.
 
-hist = model.fit(x_train, y_train, epochs=10, callbacks=callbacks)
-model.evaluate(x_test, y_test)
+    target_accuracy: float, optional
+        If given, the training time until the validation accuracy first reached this value is reported.
 
+    checkpoint_dir: str, optional
+        If given, checkpoints are written to this directory every epoch, and an interrupted run resumes from them.
 
-print(hist.history)
+    data_dir: str
+        The local MNIST store, see mnist_data.py. The images stay memory-mapped uint8 and are read and scaled to range 0..1 as float32 per batch, see make_dataset.
+
+    model_file: str, optional
+        If given, the trained model is saved to this '.keras' file. It can be exported for CPU inference with mnist_export.py.
+    """
+    start = time.perf_counter()
+    (x_train, y_train),(x_test, y_test) = load_local(data_dir)
+    logging.info("Loaded MNIST from local store '%s' in %.3f seconds, peak RSS %.1f MB." % (data_dir, time.perf_counter() - start, peak_rss_mb()))
+
+    x_train, x_val = x_train[:-10000], x_train[-10000:]    # validation set for early stopping
+    y_train, y_val = y_train[:-10000], y_train[-10000:]
+    train_data = make_dataset(x_train, y_train, batch_size=batch_size, shuffle=True)
+    val_data = make_dataset(x_val, y_val, batch_size=1024)
+    test_data = make_dataset(x_test, y_test, batch_size=1024)
+
+
+    model = tf.keras.models.Sequential([
+      tf.keras.layers.Flatten(input_shape=(28, 28)),
+      tf.keras.layers.Dense(512, activation='relu'),
+      tf.keras.layers.Dropout(0.2),
+      tf.keras.layers.Dense(512, activation='relu'),
+      tf.keras.layers.Dropout(0.2),
+      tf.keras.layers.Dense(256, activation='relu'),
+      tf.keras.layers.Dropout(0.2),
+      tf.keras.layers.Dense(10, activation='softmax')
+    ])
+
+    model.compile(optimizer=optimizer,
+                  loss='sparse_categorical_crossentropy',
+                  metrics=['accuracy'])
+
+    callbacks = [tf.keras.callbacks.TensorBoard(log_dir='./logs', profile_batch=0)]
+
+    history, report = train_model(model, train_data, validation_data=val_data, epochs=epochs, patience=patience, target_accuracy=target_accuracy, checkpoint_dir=checkpoint_dir, callbacks=callbacks)
+    model.evaluate(test_data)
+    logging.info("Peak RSS after training: %.1f MB." % (peak_rss_mb()))
+    if model_file is not None:
+        model.save(model_file)
+
+
+    print(history)
+    print("Optimizer '%s', batch size %d: %s" % (optimizer, batch_size, report))
+    return model, report
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Train a dense neural network on MNIST.")
+    parser.add_argument("--epochs", type=int, default=10, help="Maximal number of training epochs.")
+    parser.add_argument("--batch-size", type=int, default=32, help="Training batch size.")
+    parser.add_argument("--optimizer", default="adam", help="Keras optimizer name.")
+    parser.add_argument("--patience", type=int, default=3, help="Early stopping patience in epochs.")
+    parser.add_argument("--target-accuracy", type=float, default=None, help="Report the training time until this validation accuracy is reached.")
+    parser.add_argument("--checkpoint-dir", default=None, help="Write checkpoints to this directory and resume from them.")
+    parser.add_argument("--data-dir", default="mnist_data", help="Local MNIST store, create it with mnist_data.py.")
+    parser.add_argument("--model-file", default=None, help="Save the trained model to this '.keras' file.")
+    args = parser.parse_args()
+    run_mnist(epochs=args.epochs, batch_size=args.batch_size, optimizer=args.optimizer, patience=args.patience, target_accuracy=args.target_accuracy, checkpoint_dir=args.checkpoint_dir, data_dir=args.data_dir, model_file=args.model_file)
@@ -0,0 +1,19 @@
+import os
+import sys
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))    # for the shared abide package
+from abide.synthetic import generate_metadata, generate_descriptors, descriptor_names
+
+
+@pytest.fixture
+def synthetic_data():
+    """
+    Factory for synthetic ABIDE-shaped data without all-NaN columns: call it with the numbers of subjects and descriptors to get the descriptors dataframe and the metadata.
+    """
+    def make(num_subjects, num_descriptors):
+        metadata = generate_metadata(num_subjects)
+        descriptors = pd.DataFrame(generate_descriptors(metadata, num_descriptors, all_nan_fraction=0.0), columns=descriptor_names(num_descriptors))
+        return descriptors, metadata
+    return make
@@ -0,0 +1,21 @@
+import os
+import time
+import numpy as np
+from abide.knn_index import build_index, add_to_index, load_index, prune_index_dir
+
+
+def test_prune_index_dir(tmp_path):
+    rng = np.random.RandomState(0)
+    old_dirs = [build_index(os.path.join(tmp_path, "old%d" % (idx)), rng.rand(100, 3), rng.randint(2, size=100)) for idx in range(2)]
+    added_dir = add_to_index(old_dirs[1], rng.rand(5, 3), rng.randint(2, size=5))    # refers to the tree of old1
+    recent_dir = build_index(os.path.join(tmp_path, "recent"), rng.rand(100, 3), rng.randint(2, size=100))
+    two_days_ago = time.time() - 2 * 86400
+    for index_dir in old_dirs + [added_dir]:
+        os.utime(index_dir, (two_days_ago, two_days_ago))
+
+    assert prune_index_dir(str(tmp_path), max_age_days=30) == []
+    deleted = prune_index_dir(str(tmp_path), max_age_days=1)
+    assert sorted(deleted) == sorted(old_dirs + [added_dir])    # old1 only once added_dir, which refers to it, is gone
+    assert os.listdir(tmp_path) == ["recent"]
+    assert prune_index_dir(str(tmp_path), max_size_mb=0) == []    # recently used
+    load_index(recent_dir)
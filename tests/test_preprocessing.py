@@ -0,0 +1,31 @@
+import numpy as np
+from abide.preprocessing import preproc_data, fit_feature_filter
+
+
+def test_incremental_pca_with_fewer_features_than_components(synthetic_data):
+    descriptors, metadata = synthetic_data(1500, 40)
+    for batch_size in [1000, 300]:
+        X_train, X_test, y_train, y_test, preprocessor, pca = preproc_data(descriptors.copy(), metadata, metadata["DX_GROUP"], cache_dir=None, pca_mode="incremental", pca_batch_size=batch_size, return_transformers=True)
+        num_features = len(preprocessor.get_feature_names_out())
+        assert num_features < batch_size
+        assert pca.n_components_ == num_features
+        assert X_train.shape == (900, num_features)
+        assert X_test.shape == (600, num_features)
+
+
+def test_feature_filter_sizes_use_column_dtypes(synthetic_data):
+    descriptors, _ = synthetic_data(200, 40)
+    descriptors.iloc[:, 0] = 1.0    # constant, dropped by the variance filter
+    for dtype in [np.float64, np.float32]:
+        _, report = fit_feature_filter(descriptors.astype(dtype))
+        itemsize = np.dtype(dtype).itemsize
+        assert report["mb_before"] == 200 * 40 * itemsize / 1024.0 / 1024.0
+        assert report["mb_after"] == 200 * report["columns_after"] * itemsize / 1024.0 / 1024.0
+        assert report["columns_after"] < 40
+
+
+def test_feature_filter_keeps_numerical_covariates(synthetic_data):
+    descriptors, metadata = synthetic_data(300, 40)
+    for feature_filter in [None, {"max_nan_share": 0.5}]:
+        *_, preprocessor, _ = preproc_data(descriptors.copy(), metadata, metadata["DX_GROUP"], cache_dir=None, return_transformers=True, feature_filter=feature_filter)
+        assert any(name.endswith("AGE_AT_SCAN") for name in preprocessor.get_feature_names_out())
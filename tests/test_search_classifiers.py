@@ -0,0 +1,40 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "abide_brain_age_sklearn"))    # for search_classifiers.py
+from abide.preprocessing import preproc_data
+from abide.registry import classifier_names
+from search_classifiers import search_classifiers, get_search_spaces
+
+APPROXIMATIONS = ["Nystroem SVM", "Random Fourier SVM", "Sparse Gaussian Process"]
+
+
+@pytest.fixture
+def preprocessed_data(synthetic_data):
+    descriptors, metadata = synthetic_data(300, 40)
+    return preproc_data(descriptors, metadata, metadata["DX_GROUP"], cache_dir=None)
+
+
+def test_all_registered_classifiers_have_search_spaces():
+    assert set(classifier_names(include_optional=True)) <= set(get_search_spaces().keys())
+
+
+def test_search_kernel_approximations(preprocessed_data):
+    leaderboard = search_classifiers(preprocessed_data, classifier_names=APPROXIMATIONS, n_candidates=4, kfold=3, n_jobs=1)
+    assert set(leaderboard["classifier"]) == set(APPROXIMATIONS)
+    assert np.all(np.isfinite(leaderboard["cv_mean"]))
+    assert np.sum(np.isfinite(leaderboard["test_score"])) == len(APPROXIMATIONS)    # one test score per classifier
+
+
+def test_search_persistent_knn(preprocessed_data, tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))    # keep the index directories out of the user cache
+    leaderboard = search_classifiers(preprocessed_data, classifier_names=["Persistent KNN"], n_candidates=4, kfold=3, n_jobs=1)
+    assert np.all(np.isfinite(leaderboard["cv_mean"]))
+    assert os.listdir(os.path.join(tmp_path, "abide", "knn_index"))
+
+
+def test_persistent_knn_is_optional():
+    assert "Persistent KNN" not in classifier_names()
+    assert "Persistent KNN" in classifier_names(include_optional=True)
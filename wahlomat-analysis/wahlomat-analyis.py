@@ -7,6 +7,7 @@
 # written by Tim Schaefer
 
 import os
+import sys
 import json
 import numpy as np
 import pandas as pd
@@ -15,24 +16,19 @@ import matplotlib.pyplot as plt
 from sklearn.cluster import KMeans
 from matplotlib.colors import LinearSegmentedColormap
 from matplotlib import rcParams
+from wahlomat_data import build_answer_matrix, ANSWER_LUT, MISSING_ANSWER
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))    # for the shared instrumentation package
+from instrumentation import instrument, stage
 rcParams.update({'figure.autolayout': True})
 
+@instrument()
 def wahlomat_analysis():
     merged_df, all_data, raw_data = load_data()
     #export_data(df, 'data_merged.csv')
     num_parties = all_data["party"].shape[0]
     num_statements = all_data["statement"].shape[0]
     print("Received data on %d parties, all of which answered %d different statements." % (num_parties, num_statements))
-    answers = np.zeros((num_parties, num_statements), dtype=np.int)
-
-    for o in raw_data["opinion"]:
-        #print(o)
-        party_idx = o["party"]
-        statement_idx = o["statement"]
-        answers[party_idx][statement_idx] = o["answer"]
-
-    #print(answers)
-    a_f = fix_answer_values(answers)
+    a_f = build_answer_matrix(all_data["party"]["id"].values, all_data["statement"]["id"].values, all_data["opinion"]["party"].values, all_data["opinion"]["statement"].values, all_data["opinion"]["answer"].values)    # already in fixed encoding, see fix_answer_values
     #print(a_f)
 
     party_names = [p["name"] for p in raw_data["party"]]
@@ -47,7 +43,8 @@ def wahlomat_analysis():
     myColors = ((0.0, 1.0, 0.0, 1.0), (0.5, 0.5, 0.5, 1.0), (1.0, 0.0, 0.0, 1.0))
     cmap = LinearSegmentedColormap.from_list('Custom', myColors, len(myColors))
 
-    g = sns.clustermap(a_f, xticklabels=statement_short_labels, yticklabels=party_names, cmap=cmap)
+    with stage("clustermap"):
+        g = sns.clustermap(a_f, xticklabels=statement_short_labels, yticklabels=party_names, cmap=cmap)
     g.fig.suptitle('Clustering von Parteien nach ihren Antworten auf Wahlomat-Fragen')
     #g.set_axis_labels(['x label', 'y label'])
     #g.set(xlabel='my x label', ylabel='my y label')
@@ -62,13 +59,10 @@ def wahlomat_analysis():
 
 def fix_answer_values(answers):
     """
-    The answer values are encoded 0 for "yes", 1 for "no", and 2 for "no opinion. This makes no sense for clustering, as "no opinion" should be in the middle. So switch the values for "no" and no opinion."
+    The answer values are encoded 0 for "yes", 1 for "no", and 2 for "no opinion. This makes no sense for clustering, as "no opinion" should be in the middle. So switch the values for "no" and no opinion." Missing answers (MISSING_ANSWER) stay missing.
     """
-    answers_fixed = answers.copy()
-    answers_fixed = np.where(answers_fixed==1, 3, answers_fixed)    # move "no" away temporarily
-    answers_fixed = np.where(answers_fixed==2, 1, answers_fixed)    # set "no opinion" value to 1
-    answers_fixed = np.where(answers_fixed==3, 2, answers_fixed)    # set temporary value 3 (meaning "no") to 2
-    return answers_fixed
+    answers = np.asarray(answers)
+    return np.where(answers == MISSING_ANSWER, MISSING_ANSWER, ANSWER_LUT[answers]).astype(ANSWER_LUT.dtype)    # single lookup instead of three full-array passes, without indexing ANSWER_LUT[-1] for missing answers
 
 
 
@@ -77,6 +71,7 @@ def export_data(df, file_name):
     print("Data exported to CSV file '%s'." % (file_name))
 
 
+@instrument()
 def load_data():
     """
     Load the data from the JSON files and return them in one merged data frame.
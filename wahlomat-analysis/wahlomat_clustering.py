@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+#
+# Headless clustering of parties and statements across many Wahl-o-mat elections.
+#
+# All elections from the cache file written by wahlomat_data.py are stacked into one sparse matrix with a row per party
+# (parties with the same name in different elections share a row) and a column per statement of any election. Statements
+# a party did not answer are missing, and distances are computed only over the statements both sides answered. The
+# distances and hierarchical linkages are cached, so changing the figure style only redraws the plots:
+#
+#    python wahlomat_clustering.py --output-dir clustering
+#    python wahlomat_clustering.py --output-dir clustering --kmeans 8
+#
+# This is a python3 script.
+
+import os
+import time
+import json
+import hashlib
+import argparse
+import numpy as np
+import scipy.sparse
+from scipy.cluster.hierarchy import linkage, leaves_list
+
+from wahlomat_data import load_elections, MISSING_ANSWER
+
+# Points for two answers in fixed encoding (0 "yes", 1 "no opinion", 2 "no"), like in the Wahl-o-mat: 2 for the same answer, 1 if one is neutral, 0 for opposite answers.
+ANSWER_POINTS = 2 - np.abs(np.arange(3)[:, np.newaxis] - np.arange(3)[np.newaxis, :])
+
+
+def stack_elections(elections, min_answers=1):
+    """
+    Stack the answer matrices of several elections into one sparse matrix.
+
+    Parameters
+    ----------
+    elections: dict
+        The elections, as returned by wahlomat_data.load_elections.
+
+    min_answers: int
+        Drop parties which answered fewer statements than this in total.
+
+    Returns
+    -------
+    answers: scipy.sparse.csr_matrix
+        One row per party name and one column per statement. Stored values are the fixed-encoding answers plus 1 (so 1 "yes", 2 "no opinion", 3 "no"), missing answers are not stored.
+
+    party_names: list of str
+        The row labels.
+
+    statement_labels: list of str
+        The column labels, prefixed with the election name, like '2019/europa: Tempolimit'.
+    """
+    party_rows = dict()
+    rows, cols, values = [], [], []
+    statement_labels = []
+    for name in sorted(elections):
+        election = elections[name]
+        answers = election["answers"]
+        row_keys = []
+        for party in election["party_names"]:
+            row_keys.append(party if party not in row_keys else "%s (%s)" % (party, name))    # keep rows unique if a name occurs twice in one election
+        row_idx = np.array([party_rows.setdefault(key, len(party_rows)) for key in row_keys], dtype=np.int64)
+        party_idx, statement_idx = np.nonzero(answers != MISSING_ANSWER)
+        rows.append(row_idx[party_idx])
+        cols.append(statement_idx + len(statement_labels))
+        values.append(answers[party_idx, statement_idx].astype(np.int8) + 1)
+        statement_labels.extend("%s: %s" % (name, label) for label in election["statement_labels"])
+    stacked = scipy.sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape=(len(party_rows), len(statement_labels)), dtype=np.int8)
+    party_names = [None] * len(party_rows)
+    for party, idx in party_rows.items():
+        party_names[idx] = party
+
+    keep = np.flatnonzero(stacked.getnnz(axis=1) >= min_answers)
+    return stacked[keep], [party_names[idx] for idx in keep], statement_labels
+
+
+def one_hot(answers):
+    """
+    One-hot encode a sparse answer matrix from stack_elections: column 3 * j + k is 1 if the answer in column j is k (fixed encoding).
+    """
+    coo = answers.tocoo()
+    return scipy.sparse.csr_matrix((np.ones(coo.nnz, dtype=np.float32), (coo.row, 3 * coo.col + coo.data.astype(np.int64) - 1)), shape=(answers.shape[0], 3 * answers.shape[1]))
+
+
+def answer_distances(answers, min_common=1):
+    """
+    Compute the distances between the rows of a sparse answer matrix, over the columns both rows have answers in.
+
+    The distance is 1 minus the Wahl-o-mat agreement: 0 if all common answers are equal, 1 if all of them are opposite. Uses sparse matrix products only, so it scales with the number of stored answers.
+
+    Parameters
+    ----------
+    answers: scipy.sparse matrix
+        As returned by stack_elections. Use the transpose to compute distances between statements.
+
+    min_common: int
+        Pairs with fewer common answers get the maximal distance 1.
+
+    Returns
+    -------
+    numpy 2D float64 array
+        The symmetric distance matrix, with zeros on the diagonal.
+    """
+    answers = scipy.sparse.csr_matrix(answers)
+    encoded = one_hot(answers)
+    points_per_answer = encoded @ scipy.sparse.kron(scipy.sparse.identity(answers.shape[1], format="csr"), scipy.sparse.csr_matrix(ANSWER_POINTS.astype(np.float32)), format="csr")
+    points = (encoded @ points_per_answer.T).toarray()
+    answered = answers.copy()
+    answered.data = np.ones_like(answered.data, dtype=np.float32)
+    common = (answered @ answered.T).toarray()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        distances = np.where(common >= min_common, 1.0 - points / (2.0 * common), 1.0)
+    distances = (distances + distances.T) / 2.0    # remove float asymmetry
+    np.fill_diagonal(distances, 0.0)
+    return distances
+
+
+def condensed(distances):
+    """
+    Convert a square distance matrix to the condensed form used by scipy's linkage.
+    """
+    return distances[np.triu_indices(distances.shape[0], k=1)]
+
+
+def _cache_key(answers, labels, method):
+    h = hashlib.sha1()
+    coo = scipy.sparse.coo_matrix(answers)
+    for arr in [np.array(coo.shape), coo.row, coo.col, coo.data]:
+        h.update(np.ascontiguousarray(arr).tobytes())
+    h.update(json.dumps([labels, method]).encode("utf-8"))
+    return h.hexdigest()
+
+
+def cached_linkage(answers, labels, method="average", cache_dir="clustering_cache"):
+    """
+    Compute the distances between the rows of an answer matrix and their hierarchical clustering, or load them from the cache.
+
+    Parameters
+    ----------
+    answers: scipy.sparse matrix
+        As returned by stack_elections, or its transpose.
+
+    labels: list of str
+        The row labels, part of the cache key.
+
+    method: str
+        The linkage method, see scipy.cluster.hierarchy.linkage. Methods which require Euclidean distances ('ward', 'centroid', 'median') are not meaningful here.
+
+    cache_dir: str
+        Directory for the cache files. The key is computed from the matrix content, the labels and the method.
+
+    Returns
+    -------
+    distances: numpy 2D array
+        The distances, see answer_distances.
+
+    link: numpy 2D array
+        The linkage matrix.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_file = os.path.join(cache_dir, "linkage_%s.npz" % (_cache_key(answers, labels, method)))
+    if os.path.isfile(cache_file):
+        with np.load(cache_file, allow_pickle=False) as cache:
+            return cache["distances"], cache["linkage"]
+    start = time.perf_counter()
+    distances = answer_distances(answers)
+    link = linkage(condensed(distances), method=method)
+    np.savez(cache_file, distances=distances, linkage=link)
+    print("Computed distances and '%s' linkage of %d rows in %.2f seconds, cached in file '%s'." % (method, answers.shape[0], time.perf_counter() - start, cache_file))
+    return distances, link
+
+
+def kmeans_clusters(answers, n_clusters=8, batch_size=1024, random_state=0):
+    """
+    Cluster the rows of a sparse answer matrix with mini-batch k-means on the one-hot encoded answers, for matrices too large for a hierarchical clustering.
+
+    Returns
+    -------
+    numpy 1D int array
+        The cluster of each row.
+    """
+    from sklearn.cluster import MiniBatchKMeans
+    model = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size, random_state=random_state, n_init=3)
+    return model.fit_predict(one_hot(answers))
+
+
+def plot_dendrogram(link, labels, output_file, title="", max_labels=200):
+    """
+    Draw a dendrogram to a file, without a display.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from scipy.cluster.hierarchy import dendrogram
+    fig, ax = plt.subplots(figsize=(10, max(4, 0.18 * min(len(labels), max_labels))))
+    dendrogram(link, labels=labels, orientation="left", ax=ax, no_labels=len(labels) > max_labels, leaf_font_size=7)
+    ax.set_title(title)
+    fig.savefig(output_file, bbox_inches="tight", dpi=150)
+    plt.close(fig)
+
+
+def plot_answer_matrix(answers, party_names, party_order, statement_order, output_file, title=""):
+    """
+    Draw the answer matrix with rows and columns in the given order to a file, without a display. Missing answers are white.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import ListedColormap
+    dense = answers[party_order][:, statement_order].toarray().astype(np.float32)
+    dense[dense == 0] = np.nan
+    cmap = ListedColormap([(0.0, 1.0, 0.0, 1.0), (0.5, 0.5, 0.5, 1.0), (1.0, 0.0, 0.0, 1.0)])    # yes=green, dunno=gray, no=red, like wahlomat-analyis.py
+    cmap.set_bad((1.0, 1.0, 1.0, 1.0))
+    fig, ax = plt.subplots(figsize=(min(40, 4 + 0.02 * dense.shape[1]), max(4, 0.15 * dense.shape[0])))
+    ax.imshow(dense, aspect="auto", interpolation="nearest", cmap=cmap, vmin=1, vmax=3)
+    if dense.shape[0] <= 200:
+        ax.set_yticks(np.arange(dense.shape[0]))
+        ax.set_yticklabels([party_names[idx] for idx in party_order], fontsize=6)
+    ax.set_xlabel("Statement")
+    ax.set_title(title)
+    fig.savefig(output_file, bbox_inches="tight", dpi=150)
+    plt.close(fig)
+
+
+def run_clustering(cache_file="elections.npz", output_dir="clustering", method="average", min_answers=10, n_clusters=None, cache_dir="clustering_cache"):
+    """
+    Cluster parties and statements of all elections and save the figures.
+
+    Parameters
+    ----------
+    cache_file: str
+        The election cache written by wahlomat_data.py.
+
+    output_dir: str
+        Output directory for the figures and the cluster assignments.
+
+    method: str
+        The linkage method for the hierarchical clustering.
+
+    min_answers: int
+        Ignore parties with fewer answers than this, see stack_elections.
+
+    n_clusters: int, optional
+        If given, the parties are also clustered with mini-batch k-means into this many clusters, and the assignment is written to 'party_clusters.csv'.
+
+    cache_dir: str
+        Directory for the cached distances and linkages.
+    """
+    elections = load_elections(cache_file)
+    answers, party_names, statement_labels = stack_elections(elections, min_answers=min_answers)
+    print("Stacked %d elections into a sparse matrix of %d parties x %d statements with %d answers (%.1f%% filled)." % (len(elections), answers.shape[0], answers.shape[1], answers.nnz, 100.0 * answers.nnz / max(1, answers.shape[0] * answers.shape[1])))
+
+    party_distances, party_linkage = cached_linkage(answers, party_names, method=method, cache_dir=cache_dir)
+    statement_distances, statement_linkage = cached_linkage(answers.T.tocsr(), statement_labels, method=method, cache_dir=cache_dir)
+
+    os.makedirs(output_dir, exist_ok=True)
+    plot_dendrogram(party_linkage, party_names, os.path.join(output_dir, "party_dendrogram.png"), title="Parteien über %d Wahlen" % (len(elections)))
+    plot_answer_matrix(answers, party_names, leaves_list(party_linkage), leaves_list(statement_linkage), os.path.join(output_dir, "answers_clustered.png"), title="Antworten, nach Clustern sortiert")
+    if n_clusters is not None:
+        clusters = kmeans_clusters(answers, n_clusters=n_clusters)
+        with open(os.path.join(output_dir, "party_clusters.csv"), "w") as fh:
+            fh.write("party\tcluster\n")
+            for party, cluster in zip(party_names, clusters):
+                fh.write("%s\t%d\n" % (party, cluster))
+    print("Figures written to directory '%s'." % (output_dir))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cluster parties and statements across all Wahl-o-mat elections and save the figures.")
+    parser.add_argument("--cache-file", default="elections.npz", help="Election cache written by wahlomat_data.py.")
+    parser.add_argument("--output-dir", default="clustering", help="Output directory for the figures.")
+    parser.add_argument("--method", default="average", help="Linkage method, e.g. 'average', 'complete' or 'single'.")
+    parser.add_argument("--min-answers", type=int, default=10, help="Ignore parties with fewer answers.")
+    parser.add_argument("--kmeans", type=int, default=None, metavar="N_CLUSTERS", help="Also cluster the parties with mini-batch k-means.")
+    parser.add_argument("--cache-dir", default="clustering_cache", help="Directory for the cached distances and linkages.")
+    args = parser.parse_args()
+    run_clustering(args.cache_file, args.output_dir, method=args.method, min_answers=args.min_answers, n_clusters=args.kmeans, cache_dir=args.cache_dir)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+#
+# Batch loading of all Wahl-o-mat elections in the qual-o-mat-data repository.
+#
+# Finds every election under qual-o-mat-data/data/<year>/<election>, builds the party x statement answer matrix of
+# each one in parallel processes, and stores all of them in a single .npz cache file, which loads in milliseconds:
+#
+#    python wahlomat_data.py --num-workers 4
+#
+# This is a python3 script.
+
+import os
+import glob
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+DATA_KEYS = ["answer", "opinion", "party", "statement"]
+
+# The raw answer values are 0 for "yes", 1 for "no" and 2 for "no opinion". Map them to 0 "yes", 1 "no opinion" and 2 "no",
+# so "no opinion" is in the middle for clustering. Index the table with the raw values.
+ANSWER_LUT = np.array([0, 2, 1], dtype=np.int8)
+MISSING_ANSWER = -1
+
+
+def find_elections(data_root=os.path.join("qual-o-mat-data", "data")):
+    """
+    Find all elections in the qual-o-mat-data repository.
+
+    Parameters
+    ----------
+    data_root: str
+        The 'data' directory of the qual-o-mat-data repository, see get_data.bash.
+
+    Returns
+    -------
+    list of str
+        The election directories, sorted. Only directories which contain all files in DATA_KEYS are returned.
+    """
+    election_dirs = sorted(glob.glob(os.path.join(data_root, "*", "*")))
+    return [ed for ed in election_dirs if all(os.path.isfile(os.path.join(ed, dk + ".json")) for dk in DATA_KEYS)]
+
+
+def election_name(election_dir):
+    """
+    Get the name of an election, like '2019/europa', from its directory.
+    """
+    return "/".join(os.path.normpath(election_dir).split(os.sep)[-2:])
+
+
+def build_answer_matrix(party_ids, statement_ids, opinion_parties, opinion_statements, opinion_answers):
+    """
+    Build the party x statement answer matrix with a single scatter and remap the values with ANSWER_LUT.
+
+    Parameters
+    ----------
+    party_ids: numpy 1D int array
+        The IDs of the parties, in row order.
+
+    statement_ids: numpy 1D int array
+        The IDs of the statements, in column order.
+
+    opinion_parties, opinion_statements, opinion_answers: numpy 1D int arrays
+        One entry per opinion: the party ID, statement ID and raw answer value.
+
+    Returns
+    -------
+    numpy 2D int8 array
+        The answers, encoded 0 for "yes", 1 for "no opinion" and 2 for "no". Combinations without an opinion are MISSING_ANSWER.
+    """
+    party_index = np.full(int(party_ids.max()) + 1, -1, dtype=np.int64)    # maps an ID to its row, IDs are small integers
+    party_index[party_ids] = np.arange(party_ids.shape[0])
+    statement_index = np.full(int(statement_ids.max()) + 1, -1, dtype=np.int64)
+    statement_index[statement_ids] = np.arange(statement_ids.shape[0])
+
+    answers = np.full((party_ids.shape[0], statement_ids.shape[0]), MISSING_ANSWER, dtype=np.int8)
+    answers[party_index[opinion_parties], statement_index[opinion_statements]] = ANSWER_LUT[opinion_answers]
+    return answers
+
+
+def load_election(election_dir):
+    """
+    Load one election and build its answer matrix.
+
+    Parameters
+    ----------
+    election_dir: str
+        The election directory, containing the JSON files in DATA_KEYS.
+
+    Returns
+    -------
+    dict
+        With keys 'election' (see election_name), 'answers' (see build_answer_matrix), 'party_names' and 'statement_labels'.
+    """
+    raw_data = dict()
+    for dk in DATA_KEYS:
+        with open(os.path.join(election_dir, dk + ".json"), "r") as fh:
+            raw_data[dk] = json.load(fh)
+    opinions = raw_data["opinion"]
+    answers = build_answer_matrix(np.array([p["id"] for p in raw_data["party"]], dtype=np.int64),
+                                  np.array([s["id"] for s in raw_data["statement"]], dtype=np.int64),
+                                  np.array([o["party"] for o in opinions], dtype=np.int64),
+                                  np.array([o["statement"] for o in opinions], dtype=np.int64),
+                                  np.array([o["answer"] for o in opinions], dtype=np.int64))
+    return {"election": election_name(election_dir), "answers": answers,
+            "party_names": [p["name"] for p in raw_data["party"]],
+            "statement_labels": [s.get("label", s["text"]) for s in raw_data["statement"]]}
+
+
+def elections_fingerprint(election_dirs):
+    """
+    Compute a fingerprint of the election files from their paths, mtimes and sizes.
+    """
+    h = hashlib.sha1()
+    for ed in election_dirs:
+        for dk in DATA_KEYS:
+            st = os.stat(os.path.join(ed, dk + ".json"))
+            h.update(("%s/%s:%d:%d;" % (election_name(ed), dk, st.st_mtime_ns, st.st_size)).encode("utf-8"))
+    return h.hexdigest()
+
+
+def save_elections(cache_file, elections, fingerprint):
+    """
+    Save loaded elections to a single uncompressed .npz file.
+
+    The matrices are stored flattened and concatenated, with per-election offsets and shapes, so no pickling is needed.
+
+    Parameters
+    ----------
+    cache_file: str
+        The output file.
+
+    elections: list of dict
+        Elections as returned by load_election.
+
+    fingerprint: str
+        The fingerprint of the source files, see elections_fingerprint.
+    """
+    shapes = np.array([e["answers"].shape for e in elections], dtype=np.int64).reshape(-1, 2)
+    np.savez(cache_file,
+             elections=np.array([e["election"] for e in elections], dtype=str),
+             shapes=shapes,
+             answers=np.concatenate([e["answers"].ravel() for e in elections]) if elections else np.zeros(0, dtype=np.int8),
+             party_names=np.array([name for e in elections for name in e["party_names"]], dtype=str),
+             statement_labels=np.array([label for e in elections for label in e["statement_labels"]], dtype=str),
+             fingerprint=np.array(fingerprint))
+
+
+def load_elections(cache_file):
+    """
+    Load all elections from a cache file written by save_elections.
+
+    Returns
+    -------
+    dict
+        Maps the election name (see election_name) to a dict with keys 'answers', 'party_names' and 'statement_labels', as returned by load_election. The matrices are views into one array.
+    """
+    with np.load(cache_file, allow_pickle=False) as cache:
+        names, shapes, answers, party_names, statement_labels = [cache[key] for key in ["elections", "shapes", "answers", "party_names", "statement_labels"]]
+    answer_offsets = np.concatenate([[0], np.cumsum(shapes[:, 0] * shapes[:, 1])])
+    party_offsets = np.concatenate([[0], np.cumsum(shapes[:, 0])])
+    statement_offsets = np.concatenate([[0], np.cumsum(shapes[:, 1])])
+    elections = dict()
+    for idx, name in enumerate(names):
+        elections[str(name)] = {"answers": answers[answer_offsets[idx]:answer_offsets[idx + 1]].reshape(shapes[idx]),
+                                "party_names": party_names[party_offsets[idx]:party_offsets[idx + 1]].tolist(),
+                                "statement_labels": statement_labels[statement_offsets[idx]:statement_offsets[idx + 1]].tolist()}
+    return elections
+
+
+def build_election_cache(data_root=os.path.join("qual-o-mat-data", "data"), cache_file="elections.npz", num_workers=1):
+    """
+    Load all elections in parallel and write them to the cache file, unless it is up to date already.
+
+    Parameters
+    ----------
+    data_root: str
+        The 'data' directory of the qual-o-mat-data repository.
+
+    cache_file: str
+        The cache file, see save_elections.
+
+    num_workers: int
+        Number of processes used to load the elections.
+
+    Returns
+    -------
+    dict
+        The elections, see load_elections.
+    """
+    election_dirs = find_elections(data_root)
+    if not election_dirs:
+        raise IOError("No elections found under directory '%s', run get_data.bash first." % (data_root))
+    fingerprint = elections_fingerprint(election_dirs)
+    if os.path.isfile(cache_file):
+        with np.load(cache_file, allow_pickle=False) as cache:
+            cached_fingerprint = str(cache["fingerprint"])
+        if cached_fingerprint == fingerprint:
+            print("Election cache '%s' is up to date." % (cache_file))
+            return load_elections(cache_file)
+
+    start = time.perf_counter()
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            elections = list(executor.map(load_election, election_dirs))
+    else:
+        elections = [load_election(ed) for ed in election_dirs]
+    save_elections(cache_file, elections, fingerprint)
+    print("Loaded %d elections with %d workers in %.2f seconds, wrote cache file '%s'." % (len(elections), num_workers, time.perf_counter() - start, cache_file))
+    return load_elections(cache_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the answer matrices of all Wahl-o-mat elections and cache them in one file.")
+    parser.add_argument("--data-root", default=os.path.join("qual-o-mat-data", "data"), help="The 'data' directory of the qual-o-mat-data repository.")
+    parser.add_argument("--cache-file", default="elections.npz", help="The cache file.")
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count(), help="Number of processes.")
+    args = parser.parse_args()
+    elections = build_election_cache(args.data_root, args.cache_file, num_workers=args.num_workers)
+    start = time.perf_counter()
+    load_elections(args.cache_file)
+    print("Loading %d elections from the cache takes %.1f ms." % (len(elections), (time.perf_counter() - start) * 1000.0))
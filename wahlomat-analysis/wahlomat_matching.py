@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+#
+# Score voter answer profiles against all parties of an election, like the Wahl-o-mat does.
+#
+# Per statement, a voter gets 2 points if the party gave the same answer, 1 point if one of them is neutral and the
+# other is not, and 0 points for opposite answers. Statements the voter skipped do not count, and weighted statements
+# count with their weight (the Wahl-o-mat doubles them). The agreement is the sum of points divided by the maximum.
+#
+# Answers use the fixed encoding from fix_answer_values: 0 "yes", 1 "no opinion", 2 "no", so the points are 2 - |voter - party|.
+# Benchmark with synthetic profiles:
+#
+#    python wahlomat_matching.py --num-profiles 2000000
+#
+# This is a python3 script.
+
+import os
+import time
+import argparse
+import numpy as np
+
+SKIPPED = -1    # voter answer for a skipped statement, also used for missing party answers (see MISSING_ANSWER in wahlomat_data.py)
+
+
+def party_points(answers):
+    """
+    Compute the points a voter gets for each possible answer, per party and statement.
+
+    Parameters
+    ----------
+    answers: numpy 2D int array
+        The party x statement answer matrix in fixed encoding, see fix_answer_values. Missing answers are SKIPPED.
+
+    Returns
+    -------
+    points: numpy 2D float32 array
+        Shape (3 * num_statements, num_parties). Row 3 * s + k holds the points for answer k to statement s.
+
+    answered: numpy 2D float32 array
+        Shape (num_statements, num_parties), 1 where the party answered the statement.
+    """
+    answers = np.asarray(answers)
+    possible = np.arange(3)
+    points = 2 - np.abs(possible[np.newaxis, np.newaxis, :] - answers[:, :, np.newaxis])    # parties x statements x answers
+    answered = answers != SKIPPED
+    points = np.where(answered[:, :, np.newaxis], points, 0)
+    return points.reshape(answers.shape[0], -1).T.astype(np.float32), answered.T.astype(np.float32)
+
+
+def score_voters(points, answered, voters, weights=None):
+    """
+    Compute the agreement of voter profiles with all parties in two matrix products.
+
+    Parameters
+    ----------
+    points, answered: numpy 2D float32 arrays
+        The party data, see party_points.
+
+    voters: numpy 2D int array
+        One voter profile per row, one column per statement, with values 0, 1, 2 (fixed encoding) or SKIPPED.
+
+    weights: numpy 1D or 2D array, optional
+        Statement weights, either one per statement for all voters or one row per voter. Defaults to 1 for all statements.
+
+    Returns
+    -------
+    numpy 2D float32 array
+        The agreement in range 0..1, one row per voter and one column per party. NaN if the voter skipped all statements the party answered.
+    """
+    voters = np.asarray(voters)
+    num_voters, num_statements = voters.shape
+    if weights is None:
+        weights = np.ones(num_statements, dtype=np.float32)
+    weights = np.broadcast_to(np.asarray(weights, dtype=np.float32), (num_voters, num_statements))
+    weighted_answers = np.zeros((num_voters, num_statements, 3), dtype=np.float32)    # one-hot encoded voter answers, scaled by the weights
+    voter_idx, statement_idx = np.nonzero(voters != SKIPPED)
+    weighted_answers[voter_idx, statement_idx, voters[voter_idx, statement_idx]] = weights[voter_idx, statement_idx]
+    scored = weighted_answers.reshape(num_voters, -1) @ points
+    max_points = 2.0 * (weighted_answers.sum(axis=2) @ answered)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(max_points > 0, scored / max_points, np.nan).astype(np.float32)
+
+
+def iter_scores(answers, voters, weights=None, chunk_size=65536):
+    """
+    Score voter profiles against all parties in chunks, so arbitrarily many profiles can be streamed with bounded memory.
+
+    Parameters
+    ----------
+    answers: numpy 2D int array
+        The party x statement answer matrix in fixed encoding, see fix_answer_values.
+
+    voters: numpy 2D int array or iterable of them
+        The voter profiles, see score_voters. Can be a (memory-mapped) array, which is processed chunk_size rows at a time, or an iterable yielding blocks of profiles.
+
+    weights: numpy 1D or 2D array, optional
+        Statement weights, see score_voters. A 2D array must have one row per voter, in the same order as the profiles.
+
+    chunk_size: int
+        Number of profiles scored in one pass.
+
+    Yields
+    ------
+    start: int
+        Index of the first voter in the chunk.
+
+    scores: numpy 2D float32 array
+        The agreement of the voters in the chunk with all parties, see score_voters.
+    """
+    points, answered = party_points(answers)
+    if isinstance(voters, np.ndarray):
+        voters = [voters]    # chunked below
+    start = 0
+    for block in voters:
+        for block_start in range(0, block.shape[0], chunk_size):
+            chunk = block[block_start:block_start + chunk_size]
+            chunk_weights = weights
+            if weights is not None and np.ndim(weights) == 2:
+                chunk_weights = weights[start:start + chunk.shape[0]]
+            yield start, score_voters(points, answered, chunk, chunk_weights)
+            start += chunk.shape[0]
+
+
+def best_parties(answers, voters, weights=None, chunk_size=65536):
+    """
+    Find the party with the highest agreement for each voter.
+
+    Returns
+    -------
+    best: numpy 1D int array
+        The row index of the best matching party, per voter.
+
+    agreement: numpy 1D float32 array
+        The agreement with that party.
+    """
+    best = []
+    agreement = []
+    for start, scores in iter_scores(answers, voters, weights=weights, chunk_size=chunk_size):
+        scores = np.nan_to_num(scores, nan=-1.0)
+        best.append(np.argmax(scores, axis=1))
+        agreement.append(scores[np.arange(scores.shape[0]), best[-1]])
+    return np.concatenate(best), np.concatenate(agreement)
+
+
+def random_profiles(num_voters, num_statements, skip_probability=0.1, seed=0):
+    """
+    Create synthetic voter profiles with random answers, skipping each statement with the given probability.
+    """
+    rng = np.random.default_rng(seed)
+    voters = rng.integers(0, 3, size=(num_voters, num_statements), dtype=np.int8)
+    voters[rng.random((num_voters, num_statements)) < skip_probability] = SKIPPED
+    return voters
+
+
+def _reference_scores(answers, voters, weights):
+    """
+    Straightforward per-voter, per-party loop, used to validate the vectorized scoring in the benchmark.
+    """
+    scores = np.full((voters.shape[0], answers.shape[0]), np.nan, dtype=np.float32)
+    for v in range(voters.shape[0]):
+        for p in range(answers.shape[0]):
+            points = max_points = 0.0
+            for s in range(answers.shape[1]):
+                if voters[v, s] != SKIPPED and answers[p, s] != SKIPPED:
+                    points += weights[s] * (2 - abs(int(voters[v, s]) - int(answers[p, s])))
+                    max_points += weights[s] * 2
+            if max_points > 0:
+                scores[v, p] = points / max_points
+    return scores
+
+
+def benchmark_matching(answers, num_voters=1000000, chunk_sizes=(4096, 65536), seed=0):
+    """
+    Measure the scoring throughput on synthetic voter profiles for several chunk sizes.
+
+    Every other statement is weighted double. The vectorized scores are first checked against _reference_scores on some profiles.
+
+    Parameters
+    ----------
+    answers: numpy 2D int array
+        The party x statement answer matrix in fixed encoding.
+
+    num_voters: int
+        Number of synthetic profiles to score per setting.
+
+    chunk_sizes: sequence of int
+        The chunk sizes to test.
+
+    Returns
+    -------
+    list of dict
+        One entry per chunk size with keys 'chunk_size', 'seconds' and 'profiles_per_minute'.
+    """
+    num_statements = answers.shape[1]
+    weights = np.where(np.arange(num_statements) % 2 == 0, 2.0, 1.0)
+    voters = random_profiles(num_voters, num_statements, seed=seed)
+
+    check_voters = voters[:200]
+    vectorized = score_voters(*party_points(answers), check_voters, weights)
+    if not np.allclose(vectorized, _reference_scores(answers, check_voters, weights), equal_nan=True, atol=1e-5):
+        raise ValueError("Vectorized scores differ from the reference implementation.")
+
+    results = []
+    for chunk_size in chunk_sizes:
+        start = time.perf_counter()
+        for _ in iter_scores(answers, voters, weights=weights, chunk_size=chunk_size):
+            pass
+        seconds = time.perf_counter() - start
+        results.append({"chunk_size": chunk_size, "seconds": seconds, "profiles_per_minute": num_voters / seconds * 60.0})
+        print("Chunk size %6d: scored %d profiles against %d parties on %d statements in %.2f seconds, %.1f million profiles per minute." % (chunk_size, num_voters, answers.shape[0], num_statements, seconds, results[-1]["profiles_per_minute"] / 1e6))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark scoring synthetic voter profiles against the parties of an election.")
+    parser.add_argument("--cache-file", default="elections.npz", help="Election cache written by wahlomat_data.py. Random party answers are used if it does not exist.")
+    parser.add_argument("--election", default="2019/europa", help="The election to use from the cache file.")
+    parser.add_argument("--num-profiles", type=int, default=1000000, help="Number of synthetic voter profiles.")
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[4096, 65536], help="Chunk sizes to test.")
+    args = parser.parse_args()
+    if os.path.isfile(args.cache_file):
+        from wahlomat_data import load_elections
+        answers = load_elections(args.cache_file)[args.election]["answers"]
+    else:
+        print("Election cache '%s' not found, using random answers of 40 parties to 38 statements." % (args.cache_file))
+        answers = random_profiles(40, 38, skip_probability=0.0, seed=1)
+    benchmark_matching(answers, num_voters=args.num_profiles, chunk_sizes=args.chunk_sizes)